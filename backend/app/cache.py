@@ -0,0 +1,278 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+# Кэш вопрос -> SQL
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", 1024))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 24 * 3600))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "")  # пусто — только память
+LLM_CACHE_DISK_SIZE = int(os.getenv("LLM_CACHE_DISK_SIZE", 100_000))
+
+# Кэш результатов SQL
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+_MISS = object()
+
+
+class LRUCache:
+    """Потокобезопасный LRU с TTL (ttl <= 0 — без срока жизни)."""
+
+    def __init__(self, max_items: int, ttl: float = 0):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISS)
+            if item is _MISS:
+                return default
+            value, expires = item
+            if expires and expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any):
+        expires = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_items:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    """Дисковый уровень кэша: key/value в отдельном SQLite-файле."""
+
+    def __init__(self, path: str, max_items: int, ttl: float = 0):
+        self.path = path
+        self.max_items = max_items
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)")
+        self._conn.commit()
+
+    def get(self, key: str, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            if self.ttl > 0 and row[1] + self.ttl < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return default
+            self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            self._writes += 1
+            # Вытесняем пачкой, а не на каждой записи
+            if self._writes % 100 == 0:
+                self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float):
+        if self.ttl > 0:
+            self._conn.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+        self._conn.execute(
+            "DELETE FROM cache WHERE key IN ("
+            " SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_items,),
+        )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+# Только знаки препинания на краях слов: операторы сравнения, %, минус и точка
+# внутри числа меняют смысл вопроса ("> 100" и "< 100", "1.5%", "-5")
+_PUNCT = re.compile(r"(?:^|(?<=\s))[?!.,;:]+|[?!.,;:]+(?=\s|$)")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """Регистр, пробелы и концевая пунктуация — остальное входит в ключ как есть."""
+    q = _SPACES.sub(" ", question.casefold()).strip()
+    return _SPACES.sub(" ", _PUNCT.sub("", q)).strip()
+
+
+class TranslationCache:
+    """Кэш перевода вопрос -> SQL. Ключ включает отпечаток схемы БД,
+    поэтому после миграции старые записи просто перестают находиться."""
+
+    def __init__(self, memory: LRUCache, disk: Optional[SQLiteCache] = None):
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(question: str, schema_fingerprint: str) -> str:
+        raw = f"{schema_fingerprint}\x00{normalize_question(question)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, question: str, schema_fingerprint: str) -> Optional[str]:
+        key = self.key(question, schema_fingerprint)
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, question: str, schema_fingerprint: str, value: str):
+        key = self.key(question, schema_fingerprint)
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self.memory),
+            "evictions": self.memory.evictions,
+            "expirations": self.memory.expirations,
+        }
+        if self.disk is not None:
+            stats["disk_size"] = len(self.disk)
+        return stats
+
+
+def estimate_rows_size(rows: List[Dict[str, Any]]) -> int:
+    """Грубая оценка занимаемой памяти: считаем по первой строке и умножаем."""
+    if not rows:
+        return 64
+    first = rows[0]
+    row_size = sys.getsizeof(first) + sum(sys.getsizeof(v) for v in first.values())
+    return 64 + row_size * len(rows)
+
+
+class ResultCache:
+    """Кэш результатов запросов, ограниченный по памяти (LRU по байтам).
+    Каждая запись хранит токен версии БД; при несовпадении запись выбрасывается."""
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+    def get(self, sql: str, version: Hashable) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            item = self._data.get(sql)
+            if item is None:
+                self.misses += 1
+                return None
+            rows, item_version, size = item
+            if item_version != version:
+                del self._data[sql]
+                self.bytes -= size
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(sql)
+            self.hits += 1
+            return rows
+
+    def set(self, sql: str, version: Hashable, rows: List[Dict[str, Any]]):
+        size = estimate_rows_size(rows)
+        # Слишком большие результаты не кэшируем, чтобы не вымывать всё остальное
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            old = self._data.pop(sql, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._data[sql] = (rows, version, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._data:
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "evictions": self.evictions,
+            "size": len(self._data),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def make_translation_cache() -> TranslationCache:
+    disk = SQLiteCache(LLM_CACHE_PATH, LLM_CACHE_DISK_SIZE, LLM_CACHE_TTL) if LLM_CACHE_PATH else None
+    return TranslationCache(LRUCache(LLM_CACHE_SIZE, LLM_CACHE_TTL), disk)
@@ -1,24 +1,406 @@
+import hashlib
+import os
+import queue
 import sqlite3
-from typing import List, Dict, Any
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Dict, Any, Optional
 
-DB_PATH = "../data/app.db"  # путь относительно backend/
+from app import governor, metrics, rollups, schema_catalog
+from app.workload import recorder as workload
 
+DB_ENGINE = os.getenv("DB_ENGINE", "sqlite")  # sqlite | postgres (см. app/pg_engine.py)
+DB_PATH = os.getenv("DB_PATH", "../data/app.db")  # путь относительно backend/
+
+# Пул read-only соединений
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 1024 * 1024))
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", -64000))  # < 0 — размер в KiB
+DB_STMT_CACHE = int(os.getenv("DB_STMT_CACHE", 256))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", 30))
+DB_FETCH_BATCH = int(os.getenv("DB_FETCH_BATCH", 200))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Ограниченный пул read-only соединений SQLite (mode=ro)."""
+
+    def __init__(self, path: str, size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        # LIFO: чаще отдаём "тёплые" соединения с прогретым page cache
+        self._idle: "queue.LifoQueue" = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self._stats = {
+            "acquired": 0,
+            "waits": 0,
+            "wait_time_s": 0.0,
+            "health_check_failures": 0,
+            "discarded": 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(
+            uri,
+            uri=True,
+            timeout=30,
+            check_same_thread=False,  # соединение переходит между потоками threadpool'а
+            cached_statements=DB_STMT_CACHE,
+        )
+        conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+        conn.execute(f"PRAGMA cache_size={int(DB_CACHE_SIZE)}")
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def _healthy(self, conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self) -> sqlite3.Connection:
+        if self._closed:
+            raise RuntimeError("connection pool is closed")
+        try:
+            conn, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+                last_used = time.monotonic()
+            else:
+                started = time.monotonic()
+                try:
+                    conn, last_used = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise PoolTimeout(f"no free DB connection after {self.timeout}s")
+                with self._lock:
+                    self._stats["waits"] += 1
+                    self._stats["wait_time_s"] += time.monotonic() - started
+
+        # Проверяем соединения, которые долго простаивали
+        if time.monotonic() - last_used > DB_HEALTH_CHECK_INTERVAL and not self._healthy(conn):
+            with self._lock:
+                self._stats["health_check_failures"] += 1
+            self._discard(conn)
+            with self._lock:
+                self._created += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        with self._lock:
+            self._stats["acquired"] += 1
+        return conn
+
+    def release(self, conn: sqlite3.Connection, broken: bool = False):
+        if broken or self._closed:
+            self._discard(conn)
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put_nowait((conn, time.monotonic()))
+
+    def _discard(self, conn: sqlite3.Connection):
+        with self._lock:
+            self._created -= 1
+            self._stats["discarded"] += 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+        except sqlite3.DatabaseError as e:
+            # Ошибки SQL (синтаксис, нет таблицы) соединение не портят
+            broken = not isinstance(e, (sqlite3.OperationalError, sqlite3.ProgrammingError))
+            raise
+        finally:
+            self.release(conn, broken=broken)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            idle = self._idle.qsize()
+            return {
+                "size": self.size,
+                "open": self._created,
+                "idle": idle,
+                "in_use": self._created - idle,
+                **self._stats,
+            }
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+_pg = None
+
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.Lock()
+
+# Отдельное соединение для PRAGMA data_version: значение сравнимо только
+# в рамках одного соединения и меняется, когда коммитит кто-то другой
+_watcher: Optional[sqlite3.Connection] = None
+_watcher_lock = threading.Lock()
+_write_generation = 0
+
+# schema_version -> отпечаток схемы
+_fingerprints: Dict[int, str] = {}
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH)
+    return _pool
+
+
+def get_pg():
+    global _pg
+    if _pg is None:
+        with _pool_lock:
+            if _pg is None:
+                # psycopg2 нужен только для Postgres — импортируем лениво
+                from app.pg_engine import PostgresEngine
+                _pg = PostgresEngine()
+    return _pg
+
+
+def pool_stats() -> Dict[str, Any]:
+    if DB_ENGINE == "postgres":
+        return get_pg().stats()
+    return get_pool().stats()
+
+
+def close_pool():
+    global _pool, _pg, _writer, _watcher
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        if _pg is not None:
+            _pg.close()
+            _pg = None
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+    with _watcher_lock:
+        if _watcher is not None:
+            _watcher.close()
+            _watcher = None
+
+
+def _mtime_ns(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def data_version() -> Optional[tuple]:
+    """Токен версии данных: меняется после любого коммита в БД — нашего
+    (execute_db), чужого процесса или подмены файла целиком.
+    Для Postgres надёжного дешёвого аналога нет — None (кэш результатов не используется)."""
+    global _watcher
+    if DB_ENGINE == "postgres":
+        return None
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = get_pool()._connect()
+        version = _watcher.execute("PRAGMA data_version").fetchone()[0]
+    return (version, _write_generation, _mtime_ns(DB_PATH), _mtime_ns(DB_PATH + "-wal"))
+
+
+def schema_fingerprint() -> str:
+    """Хэш DDL всех объектов БД. PRAGMA schema_version меняется при любой
+    миграции, поэтому сам DDL перечитываем только когда он сдвинулся."""
+    if DB_ENGINE == "postgres":
+        return get_pg().schema_fingerprint()
+    with get_pool().connection() as conn:
+        version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        fp = _fingerprints.get(version)
+        if fp is None:
+            ddl = conn.execute(
+                "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY type, name"
+            ).fetchall()
+            fp = hashlib.sha1(repr(ddl).encode("utf-8")).hexdigest()[:16]
+            _fingerprints.clear()
+            _fingerprints[version] = fp
+    return fp
+
+
+def _introspect() -> List[schema_catalog.Table]:
+    if DB_ENGINE == "postgres":
+        return schema_catalog.introspect_postgres(get_pg())
+    with get_pool().connection() as conn:
+        return schema_catalog.introspect_sqlite(conn)
+
+
+def schema_prompt(question: str) -> schema_catalog.SchemaPrompt:
+    """Описание таблиц, относящихся к вопросу, в пределах бюджета токенов (см. app.schema_catalog).
+    Интроспекция — только при смене схемы или раз в SCHEMA_STATS_TTL."""
+    return schema_catalog.catalog.prompt(question, schema_fingerprint(), _introspect)
+
+
+def prepare_sql(sql: str, max_rows: int, params: tuple = ()) -> str:
+    """Pre-flight проверка плана + LIMIT (см. app.governor.preflight)."""
+    if DB_ENGINE == "postgres":
+        return get_pg().prepare(sql, max_rows, params)
+    with get_pool().connection() as conn:
+        return governor.preflight(conn, sql, max_rows, params)
+
+
+def rewrite_rollup(sql: str) -> Optional[rollups.RollupRewrite]:
+    """Агрегат, который можно ответить из rollup-таблицы (см. app.rollups), или None."""
+    if DB_ENGINE == "postgres" or not rollups.ROLLUP_REWRITE:
+        return None
+    version = data_version()
+    with get_pool().connection() as conn:
+        return rollups.rewriter.rewrite(conn, sql, version)
+
+
+def refresh_rollups(rebuild: bool = False) -> List[Dict[str, Any]]:
+    if DB_ENGINE == "postgres":
+        return []
+    return rollups.refresh_db(DB_PATH, rebuild)
+
+
+@metrics.timed("query_db")
 def query_db(sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute(sql, params)
-    rows = cur.fetchall()
-    cols = rows[0].keys() if rows else []
-    result = [dict(row) for row in rows]
-    cur.close()
-    conn.close()
-    return result
+    if DB_ENGINE == "postgres":
+        with workload.track(None, "backend", DB_ENGINE, sql, params) as rec:
+            rows = get_pg().query(sql, params)
+            rec["rows"] = len(rows)
+        return rows
+    with get_pool().connection() as conn, governor.Budget(conn), \
+            workload.track(conn, "backend", os.path.abspath(DB_PATH), sql, params) as rec:
+        cur = conn.execute(sql, params)
+        try:
+            cols = [d[0] for d in cur.description] if cur.description else []
+            rows = [dict(zip(cols, row)) for row in cur.fetchall()]
+            rec["rows"] = len(rows)
+            return rows
+        finally:
+            cur.close()
+
+
+class QueryStream:
+    """Результат запроса, читаемый пачками через fetchmany. Держит соединение
+    из пула, пока не дочитан до конца или не закрыт явно."""
+
+    def __init__(self, sql: str, params: tuple = (), batch_size: int = DB_FETCH_BATCH):
+        self.batch_size = batch_size
+        self._conn = None
+        self._pool = get_pool()
+        conn = self._pool.acquire()
+        # Бюджет действует до закрытия потока, включая все fetchmany
+        self._budget = governor.Budget(conn).start()
+        try:
+            self._cur = conn.execute(sql, params)
+        except Exception as e:
+            self._budget.stop()
+            self._pool.release(conn)
+            self._budget.check(e)
+            raise
+        self._conn = conn
+        self.columns = [d[0] for d in self._cur.description] if self._cur.description else []
+
+    def __iter__(self):
+        try:
+            while True:
+                try:
+                    rows = self._cur.fetchmany(self.batch_size)
+                except sqlite3.OperationalError as e:
+                    self._budget.check(e)
+                    raise
+                if not rows:
+                    break
+                yield rows
+        finally:
+            self.close()
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        try:
+            self._budget.stop()
+            self._cur.close()
+        finally:
+            self._pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # Страховка на случай, если поток так и не начали читать
+        self.close()
+
+
+@metrics.timed("stream_db")  # до первой пачки: выполнение запроса, без чтения потока
+def stream_db(sql: str, params: tuple = ()):
+    """Потоковый результат: .columns и итерация пачками строк-кортежей."""
+    if DB_ENGINE == "postgres":
+        return get_pg().stream(sql, params)
+    return QueryStream(sql, params)
+
 
 def execute_db(sql: str, params: tuple = ()):
-    conn = sqlite3.connect(DB_PATH, timeout=30)
-    cur = conn.cursor()
-    cur.execute(sql, params)
-    conn.commit()
-    cur.close()
-    conn.close()
+    if DB_ENGINE == "postgres":
+        return get_pg().execute(sql, params)
+    # Записи идут через одно постоянное соединение (SQLite всё равно сериализует writer'ов)
+    global _writer, _write_generation
+    with _writer_lock:
+        if _writer is None:
+            _writer = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+        cur = _writer.cursor()
+        try:
+            cur.execute(sql, params)
+            _writer.commit()
+        except Exception:
+            _writer.rollback()
+            raise
+        finally:
+            cur.close()
+            _write_generation += 1
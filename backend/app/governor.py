@@ -0,0 +1,325 @@
+"""Бюджеты на выполнение SQL: дедлайн и лимит шагов VM через progress handler,
+сторожевой interrupt(), предварительная проверка EXPLAIN QUERY PLAN и
+корректная подстановка LIMIT. Модуль без зависимостей от FastAPI —
+его же использует бот (tg_miniapp/bot/botai.py)."""
+import heapq
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+QUERY_TIMEOUT = float(os.getenv("QUERY_TIMEOUT", 5))
+QUERY_MAX_STEPS = int(os.getenv("QUERY_MAX_STEPS", 200_000_000))
+PROGRESS_INTERVAL = int(os.getenv("QUERY_PROGRESS_INTERVAL", 10_000))  # инструкций VM между проверками
+
+# Что делать с полным сканом большой таблицы без индекса: reject | limit | off
+SCAN_POLICY = os.getenv("SCAN_POLICY", "limit")
+SCAN_MAX_ROWS = int(os.getenv("SCAN_MAX_ROWS", 1_000_000))
+SCAN_DOWN_LIMIT = int(os.getenv("SCAN_DOWN_LIMIT", 100))
+TABLE_ROWS_TTL = 300  # сколько секунд верим оценке размера таблицы
+
+
+class QueryRejected(Exception):
+    pass
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+_metrics_lock = threading.Lock()
+METRICS: Dict[str, int] = {
+    "queries": 0,
+    "timeouts": 0,
+    "step_limits": 0,
+    "rejected_scans": 0,
+    "down_limited": 0,
+}
+
+
+def _count(name: str):
+    with _metrics_lock:
+        METRICS[name] += 1
+
+
+def stats() -> Dict[str, int]:
+    with _metrics_lock:
+        return dict(METRICS)
+
+
+# ------------------------------- LIMIT -------------------------------
+
+_TOKEN = re.compile(
+    r"""(?P<ws>\s+)
+      | (?P<line_comment>--[^\n]*)
+      | (?P<block_comment>/\*.*?(?:\*/|$))
+      | (?P<string>'(?:[^']|'')*'?)
+      | (?P<quoted>"(?:[^"]|"")*"?|`[^`]*`?|\[[^\]]*\]?)
+      | (?P<lparen>\()
+      | (?P<rparen>\))
+      | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+      | (?P<number>\d+(?:\.\d*)?)
+      | (?P<other>.)""",
+    re.S | re.X,
+)
+
+
+def top_level_tokens(sql: str) -> List[Tuple[str, str]]:
+    """Токены вне скобок, строк и комментариев: [(kind, text), ...]."""
+    depth = 0
+    out = []
+    for m in _TOKEN.finditer(sql):
+        kind = m.lastgroup
+        if kind == "lparen":
+            depth += 1
+        elif kind == "rparen":
+            depth = max(0, depth - 1)
+        elif depth == 0 and kind not in ("ws", "line_comment", "block_comment"):
+            out.append((kind, m.group()))
+    return out
+
+
+def _ends_with_line_comment(sql: str) -> bool:
+    last = None
+    for m in _TOKEN.finditer(sql):
+        if m.lastgroup != "ws":
+            last = m.lastgroup
+    return last == "line_comment"
+
+
+def _strip_tail(sql: str) -> str:
+    sql = sql.rstrip()
+    while sql.endswith(";"):
+        sql = sql[:-1].rstrip()
+    return sql
+
+
+def apply_limit(sql: str, max_rows: int) -> str:
+    """Гарантирует, что запрос вернёт не больше max_rows строк.
+    Без LIMIT верхнего уровня просто дописываем его; если LIMIT уже есть, но
+    он больше/сложнее (OFFSET, выражение) — оборачиваем запрос в подзапрос."""
+    sql = _strip_tail(sql)
+    tokens = top_level_tokens(sql)
+    words = [t.upper() for k, t in tokens if k == "word"]
+    if "LIMIT" not in words:
+        # Хвостовой "-- комментарий" съел бы LIMIT
+        sep = "\n" if _ends_with_line_comment(sql) else " "
+        return f"{sql}{sep}LIMIT {max_rows}"
+    idx = next(i for i, (k, t) in enumerate(tokens) if k == "word" and t.upper() == "LIMIT")
+    tail = tokens[idx + 1:]
+    if len(tail) == 1 and tail[0][0] == "number" and tail[0][1].isdigit() and int(tail[0][1]) <= max_rows:
+        return sql
+    # Алиас обязателен для Postgres < 16 ("subquery in FROM must have an alias"), SQLite его тоже понимает
+    return f"SELECT * FROM ({sql}) AS _q LIMIT {max_rows}"
+
+
+# ------------------------- EXPLAIN QUERY PLAN -------------------------
+
+_SCAN = re.compile(r"^SCAN (?:TABLE )?([A-Za-z_][A-Za-z0-9_]*)(?: AS \w+)?$")
+_table_rows: Dict[Tuple[str, str], Tuple[float, int]] = {}
+
+
+def _db_key(conn: sqlite3.Connection) -> str:
+    row = conn.execute("PRAGMA database_list").fetchone()
+    return row[2] if row else ""
+
+
+def estimate_rows(conn: sqlite3.Connection, table: str) -> int:
+    """Дешёвая оценка числа строк: sqlite_stat1 (после ANALYZE) или MAX(rowid).
+    COUNT(*) не используем — это сам по себе полный проход по таблице."""
+    key = (_db_key(conn), table)
+    cached = _table_rows.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    rows = 0
+    try:
+        stat = conn.execute(
+            "SELECT stat FROM sqlite_stat1 WHERE tbl = ? AND idx IS NULL", (table,)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        stat = None
+    if stat:
+        rows = int(str(stat[0]).split()[0])
+    else:
+        try:
+            rows = conn.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0] or 0
+        except sqlite3.OperationalError:  # WITHOUT ROWID, view и т.п.
+            rows = 0
+    _table_rows[key] = (time.monotonic() + TABLE_ROWS_TTL, rows)
+    return rows
+
+
+def full_scans(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> List[str]:
+    plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    tables = []
+    for row in plan:
+        m = _SCAN.match(row[-1])
+        if m:
+            tables.append(m.group(1))
+    return tables
+
+
+def preflight(conn: sqlite3.Connection, sql: str, max_rows: int, params: tuple = ()) -> str:
+    """Проверяет план и возвращает финальный SQL с LIMIT.
+    Полный скан большой таблицы без индекса — отказ или урезанный LIMIT (SCAN_POLICY)."""
+    limit = max_rows
+    if SCAN_POLICY != "off":
+        plan_sql = _strip_tail(sql)
+        big = [t for t in full_scans(conn, plan_sql, params) if estimate_rows(conn, t) > SCAN_MAX_ROWS]
+        if big:
+            if SCAN_POLICY == "reject":
+                _count("rejected_scans")
+                raise QueryRejected(f"full scan of large table(s) without index: {', '.join(big)}")
+            _count("down_limited")
+            limit = min(limit, SCAN_DOWN_LIMIT)
+    return apply_limit(sql, limit)
+
+
+def _pg_seq_scans(node: dict, out: List[str]):
+    if node.get("Node Type") == "Seq Scan" and node.get("Relation Name"):
+        out.append(node["Relation Name"])
+    for child in node.get("Plans", ()):
+        _pg_seq_scans(child, out)
+
+
+def preflight_pg(cur, sql: str, max_rows: int, params: tuple = ()) -> str:
+    """То же, что preflight, для Postgres: Seq Scan из EXPLAIN (FORMAT JSON),
+    размер таблицы — по pg_class.reltuples (оценка планировщика)."""
+    limit = max_rows
+    if SCAN_POLICY != "off":
+        cur.execute("EXPLAIN (FORMAT JSON) " + _strip_tail(sql), params or None)
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scans: List[str] = []
+        _pg_seq_scans(plan[0]["Plan"], scans)
+        big = []
+        for table in scans:
+            cur.execute("SELECT reltuples FROM pg_class WHERE relname = %s", (table,))
+            row = cur.fetchone()
+            if row and row[0] > SCAN_MAX_ROWS:
+                big.append(table)
+        if big:
+            if SCAN_POLICY == "reject":
+                _count("rejected_scans")
+                raise QueryRejected(f"full scan of large table(s) without index: {', '.join(big)}")
+            _count("down_limited")
+            limit = min(limit, SCAN_DOWN_LIMIT)
+    return apply_limit(sql, limit)
+
+
+# ------------------------------ Бюджет ------------------------------
+
+class _Watchdog:
+    """Один фоновый поток на процесс: по истечении дедлайна зовёт
+    conn.interrupt(). Нужен для долгих операций (сортировка), между которыми
+    progress handler может не вызываться."""
+
+    def __init__(self):
+        self._heap: list = []
+        self._active: Dict[int, sqlite3.Connection] = {}
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def watch(self, conn: sqlite3.Connection, deadline: float) -> int:
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sql-watchdog", daemon=True)
+                self._thread.start()
+            token = next(self._ids)
+            self._active[token] = conn
+            heapq.heappush(self._heap, (deadline, token))
+            self._cond.notify()
+        return token
+
+    def unwatch(self, token: int):
+        with self._cond:
+            self._active.pop(token, None)
+
+    def _run(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][1] not in self._active:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, token = self._heap[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                conn = self._active.pop(token, None)
+                if conn is not None:
+                    try:
+                        conn.interrupt()
+                    except sqlite3.ProgrammingError:  # соединение уже закрыто
+                        pass
+
+
+_watchdog = _Watchdog()
+
+
+class Budget:
+    """Ограничение времени и числа шагов VM для запросов на соединении.
+
+        with Budget(conn):
+            rows = conn.execute(sql).fetchall()
+    """
+
+    def __init__(self, conn: sqlite3.Connection, timeout: float = QUERY_TIMEOUT,
+                 max_steps: int = QUERY_MAX_STEPS):
+        self.conn = conn
+        self.timeout = timeout
+        self.max_steps = max_steps
+        self.steps = 0
+        self.reason: Optional[str] = None
+        self._deadline = 0.0
+        self._token: Optional[int] = None
+
+    def _progress(self) -> int:
+        self.steps += PROGRESS_INTERVAL
+        if time.monotonic() > self._deadline:
+            self.reason = "timeout"
+            return 1
+        if self.steps > self.max_steps:
+            self.reason = "steps"
+            return 1
+        return 0
+
+    def start(self):
+        _count("queries")
+        self._deadline = time.monotonic() + self.timeout
+        self.conn.set_progress_handler(self._progress, PROGRESS_INTERVAL)
+        self._token = _watchdog.watch(self.conn, self._deadline)
+        return self
+
+    def stop(self):
+        if self._token is not None:
+            _watchdog.unwatch(self._token)
+            self._token = None
+            self.conn.set_progress_handler(None, PROGRESS_INTERVAL)
+
+    def check(self, error: BaseException):
+        """Переводит 'interrupted' от SQLite в BudgetExceeded с причиной."""
+        if isinstance(error, sqlite3.OperationalError) and "interrupt" in str(error).lower():
+            reason = self.reason or "timeout"  # без reason — сработал watchdog
+            _count("timeouts" if reason == "timeout" else "step_limits")
+            if reason == "timeout":
+                raise BudgetExceeded(f"query exceeded {self.timeout:g}s time budget") from error
+            raise BudgetExceeded(f"query exceeded {self.max_steps} VM steps budget") from error
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        if exc is not None:
+            self.check(exc)
+        return False
@@ -0,0 +1,273 @@
+"""Офлайн-советник по индексам для SQLite по журналу нагрузки (app.workload).
+
+1. Из журнала берутся самые дорогие запросы (частота x время) к выбранной БД.
+2. В их планах ищутся полные сканы (SCAN t) и сортировки во временном B-tree
+   (USE TEMP B-TREE FOR ORDER BY / GROUP BY / DISTINCT).
+3. Для таких таблиц из текста запроса достаются колонки: равенства/IN, затем
+   диапазон, затем ORDER BY / GROUP BY; плюс покрывающий вариант со всеми
+   колонками таблицы, которые встречаются в запросе.
+4. Нагрузка проигрывается до и после: кандидаты создаются в транзакции,
+   запросы выполняются повторно (с бюджетом governor), используемые индексы
+   видно по планам. Без --apply транзакция откатывается, с --apply остаются
+   только индексы, которые реально попали в планы.
+
+    python -m app.index_advisor --log workload.jsonl --db ../data/app.db --out advisor.json
+    python -m app.index_advisor --log workload.jsonl --db ../data/app.db --apply
+
+Запускать на копии БД или при остановленных backend/боте: создание индексов пишет
+в файл, а бот открывает базы Spider как immutable."""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import statistics
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from app import governor
+from app.workload import explain, load
+
+MAX_INDEX_COLUMNS = 6
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$")  # без USING INDEX — полный проход
+_TEMP_BTREE = re.compile(r"USE TEMP B-TREE FOR (ORDER BY|GROUP BY|DISTINCT|RIGHT PART OF ORDER BY|LAST TERM OF ORDER BY)")
+_INDEX_USED = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+_KEYWORDS = {"ON", "WHERE", "JOIN", "LEFT", "RIGHT", "INNER", "OUTER", "CROSS", "FULL", "NATURAL", "GROUP",
+             "ORDER", "LIMIT", "HAVING", "UNION", "EXCEPT", "INTERSECT", "USING", "WINDOW", "AS", "SET"}
+_FROM = re.compile(r"\b(?:FROM|JOIN)\s+[\"`\[]?(\w+)[\"`\]]?(?:\s+(?:AS\s+)?[\"`\[]?(\w+)[\"`\]]?)?", re.I)
+_REF = r"(?:[\"`\[]?(\w+)[\"`\]]?\s*\.\s*)?[\"`\[]?(\w+)[\"`\]]?"
+_EQ = re.compile(_REF + r"\s*(?:==?|\bIN\b|\bIS\b)", re.I)
+_EQ_RHS = re.compile(r"(?<![<>!])=\s*" + _REF, re.I)
+_RANGE = re.compile(_REF + r"\s*(?:<=|>=|<|>|\bBETWEEN\b|\bLIKE\b)", re.I)
+_CLAUSE = re.compile(r"\b(WHERE|ON|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|JOIN|LEFT|INNER|CROSS|UNION|SELECT|FROM)\b", re.I)
+
+
+class QueryShape:
+    """Разбор SQL эвристиками: какие колонки каких таблиц в равенствах, диапазонах,
+    сортировке и вообще упоминаются. Ошибки разбора не страшны — выгоду кандидата
+    всё равно проверяет повторный прогон."""
+
+    def __init__(self, sql: str, columns: Dict[str, List[str]]):
+        self.aliases: Dict[str, str] = {}
+        for table, alias in _FROM.findall(sql):
+            if table.lower() in columns:
+                self.aliases[table.lower()] = table.lower()
+                if alias and alias.upper() not in _KEYWORDS:
+                    self.aliases[alias.lower()] = table.lower()
+        self.tables = sorted(set(self.aliases.values()))
+        self.columns = {t: {c.lower() for c in columns[t]} for t in self.tables}
+        sections = self._sections(sql)
+        where = " ".join(sections.get("WHERE", []) + sections.get("ON", []))
+        self.eq = self._refs(_EQ, where) + self._refs(_EQ_RHS, where)
+        self.range = self._refs(_RANGE, where)
+        self.order = self._refs(re.compile(_REF), " ".join(sections.get("ORDER BY", [])))
+        self.group = self._refs(re.compile(_REF), " ".join(sections.get("GROUP BY", [])))
+        self.used = self._refs(re.compile(_REF), sql)
+
+    @staticmethod
+    def _sections(sql: str) -> Dict[str, List[str]]:
+        out: Dict[str, List[str]] = defaultdict(list)
+        parts = _CLAUSE.split(sql)
+        for i in range(1, len(parts) - 1, 2):
+            out[" ".join(parts[i].upper().split())].append(parts[i + 1])
+        return out
+
+    def _resolve(self, qualifier: str, column: str) -> Optional[Tuple[str, str]]:
+        column = column.lower()
+        if qualifier:
+            table = self.aliases.get(qualifier.lower())
+            return (table, column) if table and column in self.columns[table] else None
+        owners = [t for t in self.tables if column in self.columns[t]]
+        return (owners[0], column) if len(owners) == 1 else None
+
+    def _refs(self, pattern, text: str) -> List[Tuple[str, str]]:
+        out = []
+        for m in pattern.finditer(text):
+            ref = self._resolve(m.group(1), m.group(2))
+            if ref and ref not in out:
+                out.append(ref)
+        return out
+
+    def candidates(self, table: str, sort: bool) -> List[Tuple[str, ...]]:
+        def cols(refs):
+            return [c for t, c in refs if t == table]
+
+        eq = cols(self.eq)
+        rng = [c for c in cols(self.range) if c not in eq][:1]
+        key = eq + rng
+        out = []
+        if sort:
+            order = [c for c in cols(self.order) or cols(self.group) if c not in eq]
+            if order:
+                out.append(tuple(eq + order))
+        if key:
+            out.append(tuple(key))
+        used = [c for c in cols(self.used) if c not in key]
+        for k in list(out):
+            covering = tuple(k) + tuple(c for c in used if c not in k)
+            if len(k) < len(covering) <= MAX_INDEX_COLUMNS:
+                out.append(covering)
+        return [c[:MAX_INDEX_COLUMNS] for c in out]
+
+
+def index_name(table: str, columns: Tuple[str, ...]) -> str:
+    return f"adv_{table}_{'_'.join(columns)}"[:60]
+
+
+def problems(plan: List[str], aliases: Dict[str, str]) -> Tuple[List[str], bool]:
+    """-> (таблицы с полным сканом, есть ли сортировка во временном B-tree).
+    Новые SQLite пишут в плане алиас ("SCAN o"), старые — "SCAN TABLE orders AS o"."""
+    scans, sort = [], False
+    for line in plan:
+        line = line.strip()
+        m = _SCAN.match(line)
+        if m:
+            name = (m.group(2) or m.group(1)).lower()
+            scans.append(aliases.get(name, name))
+        if _TEMP_BTREE.search(line):
+            sort = True
+    return scans, sort
+
+
+def replay(conn: sqlite3.Connection, queries: List[dict], repeat: int, timeout: float) -> Dict[str, dict]:
+    out = {}
+    for q in queries:
+        times, error = [], None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            try:
+                with governor.Budget(conn, timeout=timeout):
+                    conn.execute(q["sql"], q["params"]).fetchall()
+            except (sqlite3.Error, governor.BudgetExceeded) as e:
+                error = f"{type(e).__name__}: {e}"
+                break
+            times.append((time.perf_counter() - started) * 1000)
+        out[q["sql"]] = {"ms": statistics.median(times) if times else None, "error": error,
+                         "plan": explain(conn, q["sql"], q["params"])}
+    return out
+
+
+def advise(records: List[dict], db: str, top: int = 50, repeat: int = 3, timeout: float = 30,
+           apply: bool = False) -> dict:
+    db_abs = os.path.abspath(db)
+    groups: Dict[str, dict] = {}
+    for r in records:
+        if r.get("error") or os.path.abspath(r.get("db") or "") != db_abs:
+            continue
+        g = groups.setdefault(r["sql"], {"sql": r["sql"], "params": tuple(r.get("params") or ()),
+                                         "count": 0, "total_ms": 0.0, "plan": r.get("plan")})
+        g["count"] += 1
+        g["total_ms"] += r.get("ms") or 0.0
+    queries = sorted(groups.values(), key=lambda g: g["total_ms"], reverse=True)[:top]
+
+    conn = sqlite3.connect(db_abs, isolation_level=None)
+    try:
+        tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        columns = {t.lower(): [c[1] for c in conn.execute(f'PRAGMA table_info("{t}")')] for t in tables}
+        existing = {tuple(c[2] for c in conn.execute(f'PRAGMA index_info("{i[1]}")'))
+                    for t in tables for i in conn.execute(f'PRAGMA index_list("{t}")')}
+
+        # Кандидаты — по текущему плану (он мог измениться с момента записи)
+        candidates: Dict[Tuple[str, Tuple[str, ...]], List[str]] = defaultdict(list)
+        scan_counts, sorts = Counter(), 0
+        for q in queries:
+            try:
+                q["plan"] = explain(conn, q["sql"], q["params"])
+            except sqlite3.Error:
+                continue
+            shape = QueryShape(q["sql"], columns)
+            scans, sort = problems(q["plan"], shape.aliases)
+            for t in scans:
+                scan_counts[t] += q["count"]
+            sorts += q["count"] if sort else 0
+            for t in shape.tables:
+                if t in scans or sort:
+                    for cols in shape.candidates(t, sort):
+                        if cols not in existing:
+                            candidates[(t, cols)].append(q["sql"])
+
+        before = replay(conn, queries, repeat, timeout)
+        conn.execute("BEGIN")
+        created = {}
+        for (table, cols), _ in sorted(candidates.items(), key=lambda kv: -len(kv[1])):
+            name = index_name(table, cols)
+            if name in created:
+                continue
+            conn.execute(f'CREATE INDEX "{name}" ON "{table}"({", ".join(cols)})')
+            created[name] = (table, cols)
+        if created:
+            conn.execute("ANALYZE")
+        after = replay(conn, queries, repeat, timeout)
+
+        used: Dict[str, List[str]] = defaultdict(list)
+        for sql, res in after.items():
+            for line in res["plan"]:
+                for name in _INDEX_USED.findall(line):
+                    if name in created:
+                        used[name].append(sql)
+        if apply:
+            for name in created:
+                if name not in used:
+                    conn.execute(f'DROP INDEX "{name}"')
+            conn.execute("COMMIT")
+        else:
+            conn.execute("ROLLBACK")
+    finally:
+        conn.close()
+
+    weight = {q["sql"]: q["count"] for q in queries}
+
+    def workload_ms(res):
+        return sum(weight[s] * (r["ms"] or 0.0) for s, r in res.items())
+
+    # Выигрыш запроса делим поровну между новыми индексами в его плане
+    shares = Counter(s for sqls in used.values() for s in sqls)
+    per_index = []
+    for name, sqls in used.items():
+        table, cols = created[name]
+        saved = sum(weight[s] * ((before[s]["ms"] or 0) - (after[s]["ms"] or 0)) / shares[s] for s in sqls)
+        per_index.append({"name": name, "table": table, "columns": list(cols),
+                          "ddl": f"CREATE INDEX {name} ON {table}({', '.join(cols)});",
+                          "queries": len(sqls), "est_saved_ms": round(saved, 2)})
+    per_index.sort(key=lambda x: -x["est_saved_ms"])
+    return {
+        "db": db_abs, "queries": len(queries), "records": sum(weight.values()),
+        "full_scans": dict(scan_counts), "temp_btree_sorts": sorts,
+        "candidates": len(created), "proposed": per_index, "applied": apply,
+        "workload_ms_before": round(workload_ms(before), 2), "workload_ms_after": round(workload_ms(after), 2),
+        "per_query": [{"sql": q["sql"], "count": q["count"], "before_ms": before[q["sql"]]["ms"],
+                       "after_ms": after[q["sql"]]["ms"], "error": after[q["sql"]]["error"],
+                       "plan_before": before[q["sql"]]["plan"], "plan_after": after[q["sql"]]["plan"]}
+                      for q in queries],
+    }
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="index advisor for SQLite driven by the workload log")
+    ap.add_argument("--log", default=os.getenv("WORKLOAD_LOG", "workload.jsonl"))
+    ap.add_argument("--db", action="append", help="файл БД (можно несколько); по умолчанию — все из журнала")
+    ap.add_argument("--top", type=int, default=50, help="сколько самых дорогих запросов разбирать")
+    ap.add_argument("--repeat", type=int, default=3, help="прогонов каждого запроса до/после")
+    ap.add_argument("--timeout", type=float, default=30, help="бюджет на один прогон, секунд")
+    ap.add_argument("--apply", action="store_true", help="оставить индексы, которые попали в планы")
+    ap.add_argument("--out", default="", help="JSON-отчёт")
+    args = ap.parse_args()
+
+    records = load(args.log)
+    dbs = args.db or sorted({r["db"] for r in records if r.get("db") and os.path.isfile(r["db"])})
+    reports = []
+    for db in dbs:
+        rep = advise(records, db, args.top, args.repeat, args.timeout, args.apply)
+        reports.append(rep)
+        print(f"{rep['db']}: {rep['queries']} queries ({rep['records']} runs), full scans {rep['full_scans']}, "
+              f"temp b-tree sorts {rep['temp_btree_sorts']}")
+        print(f"  workload {rep['workload_ms_before']:.1f} ms -> {rep['workload_ms_after']:.1f} ms "
+              f"with {len(rep['proposed'])}/{rep['candidates']} candidate indexes"
+              f"{' (applied)' if args.apply else ''}")
+        for ix in rep["proposed"]:
+            print(f"  {ix['ddl']:<80} saves ~{ix['est_saved_ms']:.1f} ms over {ix['queries']} queries")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
@@ -1,40 +1,65 @@
+import asyncio
 import os
+import random
+import time
 import requests
 import json
+import httpx
+from typing import Optional
 from dotenv import load_dotenv
 
+from app import db_utils, metrics
+
 load_dotenv()
 OPENROUTER_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENROUTER_DEFAULT_URL = "https://openrouter.ai/api/v1/chat/completions"
+# Любой OpenAI-совместимый endpoint, например локальная заглушка для нагрузочных тестов (app.llm_stub)
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", OPENROUTER_DEFAULT_URL)
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o-mini")
 
-def ask_model(question: str) -> str:
-    if not OPENROUTER_KEY:
-        raise Exception("OpenRouter API key is not set in environment variables")
+# Асинхронный клиент: общий keep-alive пул соединений к OpenRouter
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 10))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 16))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_BACKOFF = float(os.getenv("LLM_BACKOFF", 0.5))
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
 
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
+
+class LLMTimeout(Exception):
+    pass
+
+
+def _headers() -> dict:
+    if not OPENROUTER_KEY:
+        if OPENROUTER_URL == OPENROUTER_DEFAULT_URL:
+            raise Exception("OpenRouter API key is not set in environment variables")
+        return {"Content-Type": "application/json"}  # свой endpoint может быть без ключа
+    return {
         "Authorization": f"Bearer {OPENROUTER_KEY}",
         "Content-Type": "application/json"
     }
 
+
+def _payload(question: str) -> dict:
+    # Только таблицы, относящиеся к вопросу, и в пределах LLM_SCHEMA_TOKENS — промпт короткий
+    schema = db_utils.schema_prompt(question)
+    dialect = "PostgreSQL" if db_utils.DB_ENGINE == "postgres" else "SQLite"
     prompt = f"""
-Convert this user request to a SQL SELECT query for a database table `students`.
+Convert this user request to a SQL SELECT query for a {dialect} database.
+Tables (column TYPE, PK, -> foreign key, [sample values], min..max dates, -- row count):
+{schema.text}
 Only return the SQL query.
 User request: "{question}"
 Ensure the query starts with SELECT.
     """
+    return {
+        "model": LLM_MODEL,
+        "messages": [{"role": "user", "content": prompt}]
+    }
 
-    response = requests.post(
-        url,
-        headers=headers,
-        data=json.dumps({
-            "model": "gpt-4o-mini",
-            "messages": [{"role": "user", "content": prompt}]
-        }),
-        timeout=10
-    )
 
-    response.raise_for_status()
-    data = response.json()
+def _parse(data: dict) -> str:
     sql = data["choices"][0]["message"]["content"].strip()
 
     # Проверяем, что SQL начинается с SELECT
@@ -42,3 +67,81 @@ Ensure the query starts with SELECT.
         raise Exception(f"Unsafe SQL generated by model: {sql}")
 
     return sql
+
+
+@metrics.timed("ask_model")
+def ask_model(question: str) -> str:
+    response = requests.post(
+        OPENROUTER_URL,
+        headers=_headers(),
+        data=json.dumps(_payload(question)),
+        timeout=LLM_TIMEOUT
+    )
+
+    response.raise_for_status()
+    return _parse(response.json())
+
+
+_client: Optional[httpx.AsyncClient] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client, _semaphore
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=LLM_TIMEOUT,
+            limits=httpx.Limits(max_connections=LLM_CONCURRENCY, max_keepalive_connections=LLM_CONCURRENCY),
+        )
+        _semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    return _client
+
+
+async def aclose():
+    global _client, _semaphore
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        _semaphore = None
+
+
+@metrics.timed("ask_model")
+async def ask_model_async(question: str, deadline: float) -> str:
+    """Как ask_model, но без блокировки event loop. deadline — time.monotonic(),
+    после которого перестаём ретраить и отдаём LLMTimeout."""
+    client = _get_client()
+    headers = _headers()
+    # Каталог схемы ходит в БД при первой сборке и после миграций — не в event loop
+    payload = await asyncio.to_thread(_payload, question)
+    attempt = 0
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise LLMTimeout("LLM deadline exceeded")
+        try:
+            async with _semaphore:
+                response = await client.post(
+                    OPENROUTER_URL,
+                    headers=headers,
+                    json=payload,
+                    timeout=min(LLM_TIMEOUT, remaining),
+                )
+            if response.status_code not in _RETRY_STATUSES:
+                response.raise_for_status()
+                return _parse(response.json())
+            error = httpx.HTTPStatusError(
+                f"OpenRouter returned {response.status_code}", request=response.request, response=response
+            )
+        except httpx.TimeoutException as e:
+            error = LLMTimeout(f"LLM request timed out: {e}")
+        except httpx.TransportError as e:
+            error = e
+
+        if attempt >= LLM_MAX_RETRIES:
+            raise error
+        # Экспоненциальный backoff с джиттером, но не дольше оставшегося бюджета
+        delay = LLM_BACKOFF * (2 ** attempt) * (0.5 + random.random())
+        if time.monotonic() + delay >= deadline:
+            raise error
+        attempt += 1
+        await asyncio.sleep(delay)
@@ -0,0 +1,191 @@
+"""Локальная заглушка OpenRouter для нагрузочных тестов /ask (см. app.loadgen).
+
+OpenAI-совместимый POST /api/v1/chat/completions: по тексту промпта находит
+вопрос из смеси (students — для data/app.db, bi — для БД из
+data/generate_bi_data.py, или свой JSON) и отдаёт заготовленный SQL.
+Латентность — логнормальная (медиана --latency-ms, разброс --sigma), ошибки —
+с заданными долями: HTTP-статус (--error-status, по умолчанию 503 — backend его
+ретраит), ответ не-SELECT (--bad-sql-rate) и зависание дольше LLM_TIMEOUT
+(--hang-rate). Параметры меняются на лету через POST /config, счётчики — GET /stats.
+
+    python -m app.llm_stub --port 8090 --mix students --latency-ms 700 --sigma 0.4 --error-rate 0.02
+    OPENROUTER_URL=http://127.0.0.1:8090/api/v1/chat/completions uvicorn app.main:app"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+from typing import Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+STUDENTS_MIX = [
+    {"question": "Покажи всех студентов", "sql": "SELECT * FROM students", "weight": 3},
+    {"question": "Сколько студентов на каждой специальности?",
+     "sql": "SELECT major, COUNT(*) AS students FROM students GROUP BY major ORDER BY students DESC", "weight": 4},
+    {"question": "Средний возраст студентов по специальностям",
+     "sql": "SELECT major, AVG(age) AS avg_age FROM students GROUP BY major", "weight": 3},
+    {"question": "Студенты старше 22 лет",
+     "sql": "SELECT name, age, major FROM students WHERE age > 22 ORDER BY age DESC", "weight": 2},
+    {"question": "Самый молодой студент", "sql": "SELECT name, age FROM students ORDER BY age LIMIT 1", "weight": 1},
+    {"question": "Сколько всего студентов?", "sql": "SELECT COUNT(*) AS total FROM students", "weight": 2},
+]
+
+BI_MIX = [
+    {"question": "Выручка по категориям товаров",
+     "sql": "SELECT p.category, SUM(oi.quantity * oi.unit_price) AS revenue FROM order_items oi "
+            "JOIN products p ON p.id = oi.product_id GROUP BY p.category ORDER BY revenue DESC", "weight": 4},
+    {"question": "Выручка по городам за март 2024",
+     "sql": "SELECT c.city, SUM(o.total_amount) AS revenue FROM orders o JOIN customers c ON c.id = o.customer_id "
+            "WHERE o.created_at >= '2024-03-01' AND o.created_at < '2024-04-01' GROUP BY c.city", "weight": 3},
+    {"question": "Маржа по месяцам",
+     "sql": "SELECT strftime('%Y-%m', o.created_at) AS month, SUM(o.total_amount - o.cost_of_goods) AS margin "
+            "FROM orders o GROUP BY month ORDER BY month", "weight": 3},
+    {"question": "Топ-10 клиентов по сумме заказов",
+     "sql": "SELECT c.name, SUM(o.total_amount) AS total FROM orders o JOIN customers c ON c.id = o.customer_id "
+            "GROUP BY c.id, c.name ORDER BY total DESC LIMIT 10", "weight": 2},
+    {"question": "Последние 20 заказов",
+     "sql": "SELECT id, created_at, total_amount, status FROM orders ORDER BY created_at DESC LIMIT 20", "weight": 2},
+    {"question": "Остатки на складах по категориям",
+     "sql": "SELECT p.category, i.warehouse, SUM(i.quantity) AS stock FROM inventory i "
+            "JOIN products p ON p.id = i.product_id GROUP BY p.category, i.warehouse", "weight": 1},
+]
+
+MIXES = {"students": STUDENTS_MIX, "bi": BI_MIX}
+DEFAULT_SQL = "SELECT COUNT(*) AS total FROM students"
+BAD_ANSWER = "Sorry, I can't help with that request."
+
+
+def load_mix(name_or_path: str) -> List[Dict]:
+    """students | bi | путь к JSON-списку {"question", "sql", "weight"}."""
+    if name_or_path in MIXES:
+        return MIXES[name_or_path]
+    with open(name_or_path, "r", encoding="utf-8") as f:
+        mix = json.load(f)
+    for item in mix:
+        item.setdefault("weight", 1)
+    return mix
+
+
+class StubConfig:
+    FIELDS = ("latency_ms", "sigma", "error_rate", "error_status", "bad_sql_rate", "hang_rate", "hang_s")
+
+    def __init__(self, latency_ms: float = 700, sigma: float = 0.4, error_rate: float = 0.0,
+                 error_status: int = 503, bad_sql_rate: float = 0.0, hang_rate: float = 0.0, hang_s: float = 30):
+        self.latency_ms = latency_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.bad_sql_rate = bad_sql_rate
+        self.hang_rate = hang_rate
+        self.hang_s = hang_s
+
+    def update(self, values: Dict):
+        for k, v in values.items():
+            if k in self.FIELDS:
+                setattr(self, k, type(getattr(self, k))(v))
+
+    def as_dict(self) -> Dict:
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+
+class Stub:
+    def __init__(self, mix: List[Dict], config: StubConfig, seed: int = 0):
+        # Длинные вопросы первыми: "Сколько всего студентов?" не должен совпасть с более коротким
+        self.answers = sorted(((m["question"].casefold(), m["sql"]) for m in mix), key=lambda x: -len(x[0]))
+        self.config = config
+        self.rng = random.Random(seed)
+        self.counts: Dict[str, int] = {"requests": 0, "ok": 0, "error": 0, "bad_sql": 0, "hang": 0, "unknown": 0}
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def answer(self, prompt: str) -> str:
+        prompt = prompt.casefold()
+        for question, sql in self.answers:
+            if question in prompt:
+                return sql
+        self.counts["unknown"] += 1
+        return DEFAULT_SQL
+
+    def latency(self) -> float:
+        c = self.config
+        return c.latency_ms / 1000 * math.exp(c.sigma * self.rng.gauss(0, 1)) if c.sigma > 0 else c.latency_ms / 1000
+
+    async def complete(self, body: Dict):
+        c = self.config
+        self.counts["requests"] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            roll = self.rng.random()
+            await asyncio.sleep(self.latency())
+            if roll < c.error_rate:
+                self.counts["error"] += 1
+                return JSONResponse({"error": {"message": "stub error", "code": c.error_status}}, status_code=c.error_status)
+            roll -= c.error_rate
+            if roll < c.hang_rate:
+                self.counts["hang"] += 1
+                await asyncio.sleep(c.hang_s)
+            elif roll < c.hang_rate + c.bad_sql_rate:
+                self.counts["bad_sql"] += 1
+                return self._completion(body, BAD_ANSWER)
+            prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+            self.counts["ok"] += 1
+            return self._completion(body, self.answer(prompt))
+        finally:
+            self.in_flight -= 1
+
+    @staticmethod
+    def _completion(body: Dict, content: str) -> Dict:
+        return {
+            "id": f"stub-{uuid.uuid4().hex[:12]}", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+
+def create_app(stub: Stub) -> FastAPI:
+    app = FastAPI(title="LLM stub")
+
+    @app.post("/api/v1/chat/completions")
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        return await stub.complete(await request.json())
+
+    @app.get("/stats")
+    def stats():
+        return {"config": stub.config.as_dict(), "counts": stub.counts,
+                "in_flight": stub.in_flight, "max_in_flight": stub.max_in_flight}
+
+    @app.post("/config")
+    async def config(request: Request):
+        stub.config.update(await request.json())
+        return stub.config.as_dict()
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    ap = argparse.ArgumentParser(description="OpenRouter stand-in with canned SQL and tunable latency/errors")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8090)
+    ap.add_argument("--mix", default="students", help="students | bi | путь к JSON")
+    ap.add_argument("--latency-ms", type=float, default=700, help="медиана латентности")
+    ap.add_argument("--sigma", type=float, default=0.4, help="разброс логнормального распределения (0 — фиксированная)")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--error-status", type=int, default=503)
+    ap.add_argument("--bad-sql-rate", type=float, default=0.0, help="доля ответов не-SELECT")
+    ap.add_argument("--hang-rate", type=float, default=0.0, help="доля зависших ответов")
+    ap.add_argument("--hang-s", type=float, default=30)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    cfg = StubConfig(args.latency_ms, args.sigma, args.error_rate, args.error_status,
+                     args.bad_sql_rate, args.hang_rate, args.hang_s)
+    uvicorn.run(create_app(Stub(load_mix(args.mix), cfg, args.seed)), host=args.host, port=args.port, log_level="warning")
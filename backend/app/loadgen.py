@@ -0,0 +1,345 @@
+"""Нагрузочный генератор для POST /ask.
+
+Два режима:
+  --rps R          — открытая модель: запросы уходят по расписанию (равномерно или
+                     --poisson), латентность считается от запланированного момента,
+                     так что отставание самого генератора не прячет очередь на сервере;
+  --concurrency C  — закрытая модель: C клиентов шлют запрос сразу после ответа.
+Вопросы выбираются из смеси с весами (те же, что отдаёт app.llm_stub);
+--unique F — доля вопросов с уникальным суффиксом, чтобы они шли мимо кэша перевода.
+
+Отчёт: пропускная способность, перцентили латентности (всего и по вопросам),
+ошибки по классам и — по разнице /metrics до и после прогона — время стадий на
+сервере и доля LLM / БД во времени /ask. JSON пишется с сортировкой ключей,
+чтобы его можно было диффить между версиями; --compare сравнивает с прошлым
+отчётом и завершается с кодом 1, если что-то ухудшилось больше допуска.
+С несколькими воркерами uvicorn /metrics отдаёт счётчики одного процесса —
+для разбивки по стадиям запускайте backend с одним воркером.
+
+    python -m app.llm_stub --port 8090 &
+    OPENROUTER_URL=http://127.0.0.1:8090/api/v1/chat/completions uvicorn app.main:app --port 8000 &
+    python -m app.loadgen --rps 20 --duration 60 --unique 0.5 --out load_rps20.json
+    python -m app.loadgen --rps 20 --duration 60 --unique 0.5 --out new.json --compare load_rps20.json"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from app.llm_stub import load_mix
+from app.metrics import Histogram
+
+# Стадии из app.metrics, которые относятся к LLM и к БД
+LLM_STAGES = ("ask_model",)
+DB_STAGES = ("prepare_sql", "query_db", "stream_db")
+
+_SAMPLE = re.compile(r'^(\w+?)_stage_seconds_(bucket|sum|count)\{([^}]*)\} (\S+)$')
+_COUNTER = re.compile(r'^(\w+?)_(cache_requests|sql_rejected|rollup_rewrites)_total\{([^}]*)\} (\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def percentiles(xs: List[float]) -> Dict[str, float]:
+    if not xs:
+        return {"n": 0}
+    xs = sorted(xs)
+
+    def p(q):
+        return round(xs[min(len(xs) - 1, max(0, int(round(q / 100 * (len(xs) - 1)))))], 1)
+
+    return {"n": len(xs), "p50": p(50), "p90": p(90), "p95": p(95), "p99": p(99),
+            "max": round(xs[-1], 1), "mean": round(sum(xs) / len(xs), 1)}
+
+
+# ------------------------------ метрики сервера ------------------------------
+
+def parse_metrics(text: str) -> Tuple[Dict[str, dict], Dict[str, float]]:
+    """Текст /metrics -> ({stage: {"buckets": {le: n}, "sum": s, "count": n}}, {"cache.translation.hit": n, ...})."""
+    stages: Dict[str, dict] = defaultdict(lambda: {"buckets": {}, "sum": 0.0, "count": 0})
+    counters: Dict[str, float] = {}
+    for line in text.splitlines():
+        m = _SAMPLE.match(line)
+        if m:
+            labels = dict(_LABEL.findall(m.group(3)))
+            s = stages[labels.get("stage", "")]
+            value = float(m.group(4))
+            if m.group(2) == "bucket":
+                s["buckets"][labels["le"]] = value
+            elif m.group(2) == "sum":
+                s["sum"] = value
+            else:
+                s["count"] = value
+            continue
+        m = _COUNTER.match(line)
+        if m:
+            labels = [v for _, v in _LABEL.findall(m.group(3))]
+            counters[".".join([m.group(2)] + [v for v in labels if v])] = float(m.group(4))
+    return dict(stages), counters
+
+
+def stage_delta(before: Dict[str, dict], after: Dict[str, dict]) -> Dict[str, dict]:
+    """Стадии за время прогона: разница кумулятивных гистограмм -> count / mean / перцентили."""
+    out = {}
+    for stage, a in sorted(after.items()):
+        b = before.get(stage, {"buckets": {}, "sum": 0.0, "count": 0})
+        count = int(a["count"] - b["count"])
+        if count <= 0:
+            continue
+        bounds = sorted((float(le) for le in a["buckets"] if le != "+Inf"))
+        cumulative = [a["buckets"].get("%g" % le, 0) - b["buckets"].get("%g" % le, 0) for le in bounds]
+        cumulative.append(count)
+        counts = [c - (cumulative[i - 1] if i else 0) for i, c in enumerate(cumulative)]
+        # Максимум за прогон неизвестен — берём верхнюю границу последней непустой корзины
+        last = max(i for i, c in enumerate(counts) if c > 0)
+        maximum = bounds[last] if last < len(bounds) else (bounds[-1] if bounds else 0.0)
+        hist = Histogram("loadgen", "", buckets=bounds)
+        total = a["sum"] - b["sum"]
+        out[stage] = {
+            "count": count, "sum_s": round(total, 3), "mean_ms": round(total / count * 1000, 1),
+            **{f"p{int(q * 100)}_ms": round(hist.quantile(q, counts, count, maximum) * 1000, 1) for q in (0.5, 0.95, 0.99)},
+        }
+    return out
+
+
+def time_split(stages: Dict[str, dict]) -> Dict[str, float]:
+    total = stages.get("ask", {}).get("sum_s", 0.0)
+    if not total:
+        return {}
+    llm = sum(stages.get(s, {}).get("sum_s", 0.0) for s in LLM_STAGES)
+    db = sum(stages.get(s, {}).get("sum_s", 0.0) for s in DB_STAGES)
+    return {"llm": round(llm / total, 3), "db": round(db / total, 3), "other": round(max(0.0, total - llm - db) / total, 3)}
+
+
+# --------------------------------- нагрузка ---------------------------------
+
+class LoadRun:
+    def __init__(self, url: str, mix: List[Dict], unique: float, use_cache: bool, fmt: str,
+                 timeout: float, max_inflight: int, seed: int):
+        self.url = url.rstrip("/")
+        self.mix = mix
+        self.weights = [m.get("weight", 1) for m in mix]
+        self.unique = unique
+        self.use_cache = use_cache
+        self.fmt = fmt
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        self.rng = random.Random(seed)
+        self.client: Optional[httpx.AsyncClient] = None
+        self.results: List[Tuple[str, float, str]] = []  # (вопрос, мс, исход)
+        self.dropped = 0
+        self._seq = 0
+
+    def _question(self) -> Tuple[str, str]:
+        item = self.rng.choices(self.mix, weights=self.weights)[0]
+        q = item["question"]
+        if self.unique and self.rng.random() < self.unique:
+            self._seq += 1
+            q = f"{q} #{self._seq}-{self.rng.randrange(1 << 30)}"
+        return item["question"], q
+
+    async def send(self, scheduled: float):
+        label, question = self._question()
+        body = {"question": question, "use_cache": self.use_cache, "format": self.fmt}
+        try:
+            resp = await self.client.post(self.url + "/ask", json=body)
+            await resp.aread()
+            outcome = "ok" if resp.status_code == 200 else f"http_{resp.status_code}"
+        except httpx.TimeoutException:
+            outcome = "timeout"
+        except httpx.TransportError as e:
+            outcome = f"transport_{type(e).__name__}"
+        self.results.append((label, (time.perf_counter() - scheduled) * 1000, outcome))
+
+    async def open_loop(self, rps: float, duration: float, poisson: bool):
+        start = time.perf_counter()
+        tasks = set()
+        t = start
+        while t - start < duration:
+            delay = t - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if len(tasks) >= self.max_inflight:
+                self.dropped += 1
+            else:
+                task = asyncio.create_task(self.send(t))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            t += self.rng.expovariate(rps) if poisson else 1.0 / rps
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def closed_loop(self, concurrency: int, duration: float, requests: int):
+        end = time.perf_counter() + duration
+        issued = 0
+
+        async def worker():
+            nonlocal issued
+            while time.perf_counter() < end and (not requests or issued < requests):
+                issued += 1
+                await self.send(time.perf_counter())
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    async def fetch_metrics(self) -> Optional[str]:
+        try:
+            resp = await self.client.get(self.url + "/metrics")
+            return resp.text if resp.status_code == 200 else None
+        except httpx.HTTPError:
+            return None
+
+    async def run(self, args) -> Dict:
+        limits = httpx.Limits(max_connections=max(self.max_inflight, args.concurrency or 0),
+                              max_keepalive_connections=max(self.max_inflight, args.concurrency or 0))
+        async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+            self.client = client
+
+            async def phase(duration, requests=0):
+                if args.rps:
+                    await self.open_loop(args.rps, duration, args.poisson)
+                else:
+                    await self.closed_loop(args.concurrency, duration, requests)
+
+            if args.warmup > 0:
+                await phase(args.warmup)
+                self.results.clear()
+                self.dropped = 0
+            before = await self.fetch_metrics()
+            started = time.perf_counter()
+            await phase(args.duration, args.requests)
+            wall = time.perf_counter() - started
+            after = await self.fetch_metrics()
+        return self.report(args, wall, before, after)
+
+    def report(self, args, wall: float, before: Optional[str], after: Optional[str]) -> Dict:
+        outcomes = Counter(o for _, _, o in self.results)
+        n = len(self.results)
+        ok_ms = [ms for _, ms, o in self.results if o == "ok"]
+        by_question = {}
+        for m in self.mix:
+            rows = [(ms, o) for q, ms, o in self.results if q == m["question"]]
+            if rows:
+                ok = [ms for ms, o in rows if o == "ok"]
+                by_question[m["question"]] = {"n": len(rows), "ok": len(ok),
+                                              **{k: v for k, v in percentiles(ok).items() if k in ("p50", "p95")}}
+        report = {
+            "config": {"mode": "rps" if args.rps else "concurrency", "rps": args.rps, "poisson": args.poisson,
+                       "concurrency": None if args.rps else args.concurrency, "duration_s": args.duration,
+                       "unique": self.unique, "use_cache": self.use_cache, "format": self.fmt, "mix": args.mix,
+                       "timeout_s": self.timeout, "seed": args.seed},
+            "requests": n,
+            "dropped": self.dropped,
+            "throughput_rps": round(n / wall, 2) if wall else 0.0,
+            "ok_rps": round(len(ok_ms) / wall, 2) if wall else 0.0,
+            "error_rate": round(1 - len(ok_ms) / n, 4) if n else 0.0,
+            "outcomes": dict(sorted(outcomes.items())),
+            "latency_ms": percentiles(ok_ms),
+            "latency_all_ms": percentiles([ms for _, ms, _ in self.results]),
+            "by_question": by_question,
+        }
+        if before is not None and after is not None:
+            stages_b, counters_b = parse_metrics(before)
+            stages_a, counters_a = parse_metrics(after)
+            stages = stage_delta(stages_b, stages_a)
+            report["server"] = {
+                "stages": stages,
+                "time_split": time_split(stages),
+                "counters": {k: v - counters_b.get(k, 0) for k, v in sorted(counters_a.items())
+                             if v - counters_b.get(k, 0)},
+            }
+        report["meta"] = {"url": self.url, "wall_s": round(wall, 2), "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                          "git": _git_rev()}
+        return report
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# --------------------------------- сравнение ---------------------------------
+
+def compare(old: Dict, new: Dict, tolerance: float) -> List[str]:
+    """-> строки с регрессиями. Латентность и время стадий — рост больше tolerance
+    (относительно), пропускная способность — падение больше tolerance, доля ошибок —
+    рост больше чем на 1 процентный пункт."""
+    lines, regressions = [], []
+    changed = sorted(k for k in set(old.get("config", {})) | set(new.get("config", {}))
+                     if old.get("config", {}).get(k) != new.get("config", {}).get(k))
+    if changed:
+        lines.append(f"  note: run configs differ in {', '.join(changed)}")
+
+    def check(name, a, b, higher_is_better=False, absolute=None):
+        if a is None or b is None:
+            return
+        change = (b - a) / a if a else (0.0 if b == a else float("inf"))
+        worse = (a - b if higher_is_better else b - a) > (absolute if absolute is not None else tolerance * abs(a))
+        mark = "REGRESSION" if worse else ""
+        lines.append(f"  {name:<40} {a:>10} -> {b:<10} {change:+.1%} {mark}")
+        if worse:
+            regressions.append(name)
+
+    check("throughput_rps", old.get("throughput_rps"), new.get("throughput_rps"), higher_is_better=True)
+    check("error_rate", old.get("error_rate"), new.get("error_rate"), absolute=0.01)
+    for p in ("p50", "p95", "p99"):
+        check(f"latency_ms.{p}", old.get("latency_ms", {}).get(p), new.get("latency_ms", {}).get(p))
+    old_stages = old.get("server", {}).get("stages", {})
+    for stage, s in sorted(new.get("server", {}).get("stages", {}).items()):
+        if stage in old_stages:
+            check(f"stage.{stage}.p95_ms", old_stages[stage].get("p95_ms"), s.get("p95_ms"))
+    print("\n".join(lines))
+    return regressions
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="load generator for POST /ask")
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--mix", default="students", help="students | bi | путь к JSON (как у app.llm_stub)")
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--rps", type=float, default=0, help="открытая модель: запросов в секунду")
+    mode.add_argument("--concurrency", type=int, default=8, help="закрытая модель: параллельных клиентов")
+    ap.add_argument("--poisson", action="store_true", help="пуассоновский поток вместо равномерного (для --rps)")
+    ap.add_argument("--duration", type=float, default=30, help="секунд")
+    ap.add_argument("--requests", type=int, default=0, help="закрытая модель: остановиться после N запросов")
+    ap.add_argument("--warmup", type=float, default=0, help="секунд прогрева, в отчёт не входят")
+    ap.add_argument("--unique", type=float, default=0.0, help="доля вопросов мимо кэша перевода")
+    ap.add_argument("--no-result-cache", action="store_true", help="use_cache=false в запросах")
+    ap.add_argument("--format", default="json")
+    ap.add_argument("--timeout", type=float, default=60)
+    ap.add_argument("--max-inflight", type=int, default=1000, help="открытая модель: сверх этого запросы отбрасываются")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", default="loadtest.json")
+    ap.add_argument("--compare", default="", help="прошлый отчёт: вывести разницу, код 1 при регрессии")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="допустимое ухудшение, доля")
+    args = ap.parse_args()
+
+    runner = LoadRun(args.url, load_mix(args.mix), args.unique, not args.no_result_cache, args.format,
+                     args.timeout, args.max_inflight, args.seed)
+    report = asyncio.run(runner.run(args))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+
+    lat = report["latency_ms"]
+    print(f"{report['requests']} requests  {report['throughput_rps']} rps  ok {report['ok_rps']} rps  "
+          f"errors {report['error_rate']:.2%}  dropped {report['dropped']}  outcomes={report['outcomes']}")
+    if lat["n"]:
+        print(f"  latency ms  p50 {lat['p50']}  p95 {lat['p95']}  p99 {lat['p99']}  max {lat['max']}")
+    split = report.get("server", {}).get("time_split")
+    if split:
+        print(f"  /ask time   llm {split['llm']:.0%}  db {split['db']:.0%}  other {split['other']:.0%}")
+    print(f"report -> {args.out}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"compare with {args.compare}:")
+        if compare(baseline, report, args.tolerance):
+            sys.exit(1)
@@ -1,14 +1,33 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+import asyncio
 import json
-import re
-from app.llm import ask_model
-from app.db_utils import query_db
+import logging
+import os
+import time
+from app import llm
+from app.llm import ask_model_async, LLMTimeout
+from app.db_utils import query_db, prepare_sql, stream_db, pool_stats, close_pool, schema_fingerprint, data_version, \
+    rewrite_rollup, refresh_rollups
+from app.cache import make_translation_cache, ResultCache, TranslationCache
+from app.singleflight import SingleFlight
+from app import streaming
+from app import governor
+from app import metrics
+from app import rollups
+from app import schema_catalog
+from app.governor import QueryRejected, BudgetExceeded
+from app.safety import validate_sql
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
 load_dotenv()
 
+ASK_DEADLINE = float(os.getenv("ASK_DEADLINE", 25))  # общий бюджет на один /ask, секунды
+MAX_ROWS = int(os.getenv("MAX_ROWS", 1000))
+
 app = FastAPI(title="BI-GPT Backend")
 
 app.add_middleware(
@@ -19,22 +38,94 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+translation_cache = make_translation_cache()
+result_cache = ResultCache()
+llm_flight = SingleFlight()
+
 class AskRequest(BaseModel):
     question: str
+    use_cache: bool = True  # False — выполнить запрос заново, минуя кэш результатов
+    # json — как раньше; columnar/ndjson/arrow — потоковая выдача без кэша результатов
+    format: str = "json"
+
+STREAM_FORMATS = {"columnar": "application/json", "ndjson": streaming.NDJSON, "arrow": streaming.ARROW_STREAM}
+
+async def refresh_rollups_forever():
+    # Инкрементальное обновление сводок; ошибки не роняют backend, следующая попытка — через период
+    while True:
+        try:
+            await run_in_threadpool(refresh_rollups)
+        except Exception:
+            logging.exception("rollup refresh failed")
+        await asyncio.sleep(rollups.ROLLUP_REFRESH_S)
 
-# Простая проверка безопасности SQL
-def safe_sql(sql: str) -> bool:
-    forbidden = ["insert", "update", "delete", "drop", "alter", "create"]
-    sql_lower = sql.lower()
-    return sql_lower.startswith("select") and not any(f in sql_lower for f in forbidden)
+@app.on_event("startup")
+async def startup():
+    if rollups.ROLLUP_REFRESH_S > 0:
+        app.state.rollup_task = asyncio.create_task(refresh_rollups_forever())
+
+@app.on_event("shutdown")
+async def shutdown():
+    task = getattr(app.state, "rollup_task", None)
+    if task is not None:
+        task.cancel()
+    await llm.aclose()
+    close_pool()
 
 @app.get("/ping")
 def ping():
     return {"status": "ok"}
 
+@app.get("/stats")
+def stats():
+    return {"db_pool": pool_stats(), "translation_cache": translation_cache.stats(),
+            "result_cache": result_cache.stats(),
+            "llm_singleflight": llm_flight.stats(),
+            "governor": governor.stats(),
+            "rollups": rollups.rewriter.stats(),
+            "schema_catalog": schema_catalog.catalog.stats(),
+            "stages": metrics.snapshot(), "counters": metrics.counters()}
+
+@app.get("/metrics")
+def prometheus_metrics():
+    # Латентность стадий и счётчики в текстовом формате Prometheus
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+def run_query(sql: str, use_cache: bool):
+    version = data_version()
+    if version is None:  # движок не умеет отслеживать изменения — без кэша
+        return query_db(sql)
+    if not use_cache:  # запрос отказался от кэша — не читаем и не вытесняем чужие записи
+        return query_db(sql)
+    rows = result_cache.get(sql, version)
+    metrics.cache_lookup("result", rows is not None)
+    if rows is None:
+        rows = query_db(sql)
+        result_cache.set(sql, version, rows)
+    return rows
+
 @app.post("/ask")
-def ask(req: AskRequest):
-    raw = ask_model(req.question)
+@metrics.timed("ask")
+async def ask(req: AskRequest):
+    if req.format != "json" and req.format not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {req.format}")
+    if req.format == "arrow" and streaming.pa is None:
+        raise HTTPException(status_code=400, detail="Arrow output requires pyarrow")
+    deadline = time.monotonic() + ASK_DEADLINE
+    fingerprint = await run_in_threadpool(schema_fingerprint)
+    raw = translation_cache.get(req.question, fingerprint)
+    cached = raw is not None
+    metrics.cache_lookup("translation", cached)
+    if not cached:
+        # Одинаковые вопросы "в полёте" ждут один и тот же вызов LLM
+        key = TranslationCache.key(req.question, fingerprint)
+        try:
+            raw = await llm_flight.do(key, lambda: ask_model_async(req.question, deadline))
+        except LLMTimeout as e:
+            raise HTTPException(status_code=504, detail=str(e))
+        except Exception as e:
+            # Провайдер ответил ошибкой после всех ретраев или вернул не SELECT
+            raise HTTPException(status_code=502, detail=f"LLM error: {e}")
 
     # Попробуем распарсить JSON
     try:
@@ -48,17 +139,62 @@ def ask(req: AskRequest):
     if not sql:
         raise HTTPException(status_code=400, detail="No SQL generated by model")
 
-    # Проверка безопасности
-    if not safe_sql(sql):
-        raise HTTPException(status_code=400, detail="Unsafe SQL: only SELECT queries allowed")
+    # Проверка безопасности; дальше работаем с каноническим текстом (он же ключ кэша результатов)
+    with metrics.timer("validate_sql"):
+        verdict = validate_sql(sql)
+    if not verdict.ok:
+        metrics.rejected("unsafe")
+        raise HTTPException(status_code=400, detail=f"Unsafe SQL: {verdict.reason}")
+    sql = verdict.sql
+
+    # Кэшируем только ответы, прошедшие проверку
+    if not cached:
+        translation_cache.set(req.question, fingerprint, raw)
 
-    # Добавляем LIMIT, если его нет
-    if "limit" not in sql.lower():
-        sql = re.sub(r";\s*$", "", sql)  # убираем ; на конце
-        sql += " LIMIT 1000"
+    # Агрегат по заказам, который можно ответить из rollup-таблицы с тем же результатом
+    source_sql = sql
+    with metrics.timer("rollup_rewrite"):
+        rewrite = await run_in_threadpool(rewrite_rollup, sql)
+    if rewrite is not None:
+        sql = rewrite.sql
 
+    # Проверка плана (полные сканы больших таблиц) и LIMIT верхнего уровня
     try:
-        rows = query_db(sql)
+        with metrics.timer("prepare_sql"):
+            sql = await run_in_threadpool(prepare_sql, sql, MAX_ROWS)
+    except QueryRejected as e:
+        metrics.rejected("plan")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if req.format in STREAM_FORMATS:
+        try:
+            # Запрос выполняем до начала ответа, чтобы ошибка SQL стала 500, а не оборванным потоком
+            stream = await run_in_threadpool(stream_db, sql)
+        except BudgetExceeded as e:
+            metrics.rejected("budget")
+            raise HTTPException(status_code=504, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        header = {"sql": sql, "explain": explain}
+        if rewrite is not None:
+            header.update(rollup=rewrite.rollup, source_sql=source_sql)
+        if req.format == "ndjson":
+            body = streaming.ndjson_stream(stream, header)
+        elif req.format == "columnar":
+            body = streaming.columnar_stream(stream, header)
+        else:
+            body = streaming.arrow_stream(stream)
+        return StreamingResponse(body, media_type=STREAM_FORMATS[req.format])
+
+    try:
+        rows = await run_in_threadpool(run_query, sql, req.use_cache)
+        if rewrite is not None:
+            return {"sql": sql, "explain": explain, "data": rows, "rollup": rewrite.rollup, "source_sql": source_sql}
         return {"sql": sql, "explain": explain, "data": rows}
+    except BudgetExceeded as e:
+        metrics.rejected("budget")
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,248 @@
+"""Лёгкие метрики без внешних зависимостей: гистограммы латентности по стадиям
+(LLM, проверка SQL, выполнение, ASR, генерация T5, рендер) и счётчики
+(попадания в кэши, отклонённый SQL). Backend отдаёт их в текстовом формате
+Prometheus на /metrics, бот — сводкой с перцентилями по /stats.
+Наблюдение — это bisect по границам корзин и короткий lock, поэтому метрики
+можно держать включёнными в проде (METRICS_ENABLED=0 — выключить совсем).
+Модуль без зависимостей от FastAPI — его же использует бот."""
+import bisect
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, List, Optional, Sequence, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "bi")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Секунды: от 1 мс (кэш, проверка SQL) до минуты (длинные голосовые)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = f"{METRICS_PREFIX}_{name}" if METRICS_PREFIX else name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series: Dict[LabelValues, object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _labels(self, key: LabelValues, extra: str = "") -> str:
+        parts = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+    def values(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._series)
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{self._labels(key)} {value:g}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                # [счётчики по корзинам (+Inf последней), сумма, количество, максимум]
+                s = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0, 0.0]
+            s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+            if value > s[3]:
+                s[3] = value
+
+    def snapshot(self) -> Dict[LabelValues, Tuple[List[int], float, int, float]]:
+        with self._lock:
+            return {k: (list(s[0]), s[1], s[2], s[3]) for k, s in self._series.items()}
+
+    def quantile(self, q: float, counts: List[int], total: int, maximum: float) -> float:
+        """Оценка квантиля по корзинам с линейной интерполяцией (как histogram_quantile),
+        но не больше реального максимума — иначе при малом числе наблюдений p50 > max."""
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, c in enumerate(counts):
+            if c and seen + c >= rank:
+                if i >= len(self.buckets):
+                    return maximum
+                lower = self.buckets[i - 1] if i else 0.0
+                return min(maximum, lower + (self.buckets[i] - lower) * (rank - seen) / c)
+            seen += c
+        return maximum
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        for key, (counts, total_sum, count, _) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = 'le="%g"' % bound
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total_sum:.6f}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+
+_registry_lock = threading.Lock()
+REGISTRY: Dict[str, _Metric] = {}
+
+
+def _register(cls, name: str, *args, **kwargs):
+    with _registry_lock:
+        metric = REGISTRY.get(name)
+        if metric is None:
+            metric = REGISTRY[name] = cls(name, *args, **kwargs)
+        return metric
+
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _register(Counter, name, help, labelnames)
+
+
+def histogram(name: str, help: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, help, labelnames, buckets)
+
+
+STAGE_SECONDS = histogram("stage_seconds", "Latency of request stages in seconds", ("stage",))
+STAGE_ERRORS = counter("stage_errors_total", "Stage calls that raised an exception", ("stage",))
+CACHE_REQUESTS = counter("cache_requests_total", "Cache lookups by cache and result (hit/miss)", ("cache", "result"))
+SQL_REJECTED = counter("sql_rejected_total", "SQL refused by safety check, plan check or execution budget", ("reason",))
+ROLLUP_REWRITES = counter("rollup_rewrites_total", "Aggregate queries by rollup and result (hit/stale/no_match)", ("rollup", "result"))
+
+
+# ------------------------------- API для кода -------------------------------
+
+@contextmanager
+def timer(stage: str):
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+def timed(stage: str):
+    """Декоратор: timer(stage) вокруг функции или корутины."""
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def cache_lookup(cache: str, hit: bool):
+    if METRICS_ENABLED:
+        CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def rollup_lookup(rollup: str, result: str):
+    if METRICS_ENABLED:
+        ROLLUP_REWRITES.inc(rollup=rollup, result=result)
+
+
+def rejected(reason: str):
+    # reason — из короткого фиксированного набора (unsafe / plan / budget), не текст ошибки
+    if METRICS_ENABLED:
+        SQL_REJECTED.inc(reason=reason)
+
+
+# ---------------------------------- выдача ----------------------------------
+
+def render() -> str:
+    with _registry_lock:
+        metrics = list(REGISTRY.values())
+    lines = []
+    for m in metrics:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+def snapshot(hist: Optional[Histogram] = None) -> Dict[str, dict]:
+    """Сводка по стадиям для /stats: количество, ошибки, mean/p50/p95/p99/max в мс."""
+    hist = hist or STAGE_SECONDS
+    errors = STAGE_ERRORS.values()
+    out = {}
+    for key, (counts, total_sum, count, maximum) in sorted(hist.snapshot().items()):
+        stage = key[0] if key else ""
+        out[stage] = {
+            "count": count,
+            "errors": int(errors.get(key, 0)),
+            "mean_ms": round(total_sum / count * 1000, 1) if count else 0.0,
+            **{f"p{int(q * 100)}_ms": round(hist.quantile(q, counts, count, maximum) * 1000, 1) for q in (0.5, 0.95, 0.99)},
+            "max_ms": round(maximum * 1000, 1),
+        }
+    return out
+
+
+def counters() -> Dict[str, Dict[str, float]]:
+    """Счётчики кэшей, отклонённого SQL и rollup в плоском виде: {"cache": {"translation.hit": 3}, ...}."""
+    return {
+        "cache": {".".join(k): v for k, v in sorted(CACHE_REQUESTS.values().items())},
+        "sql_rejected": {k[0]: v for k, v in sorted(SQL_REJECTED.values().items())},
+        "rollup": {".".join(k).lstrip("."): v for k, v in sorted(ROLLUP_REWRITES.values().items())},
+    }
@@ -0,0 +1,1028 @@
+"""Rollup-таблицы для типовых BI-агрегатов и переписывание запросов на них.
+
+Объявленные сводки (ROLLUPS) хранятся в той же БД и обновляются инкрементально:
+новые заказы берутся по высокой воде orders.id (id > hwm), их агрегаты
+добавляются в rollup через UPSERT. Состояние — в таблице rollup_state.
+UPDATE/DELETE таблиц фактов и справочников (категория товара, город клиента)
+отмечают триггеры — версия в rollup_lookup_changes; пока она не совпадает со
+снимком, сводка не используется, а обновление пересобирает её с нуля.
+Холостое обновление ничего не пишет.
+
+Переписывание в /ask консервативное: SQL переводится на rollup, только если
+ответ заведомо тот же самый:
+  - FROM — внутренние джойны ровно по внешним ключам из определения сводки
+    (подмножество её таблиц, включая таблицу фактов);
+  - вне агрегатов — только колонки-измерения (и дата через date()/strftime()/
+    substr() или сравнение created_at >= / < 'YYYY-MM-DD');
+  - агрегаты — SUM/TOTAL/AVG/COUNT объявленных мер, COUNT(*), MIN/MAX измерений;
+  - подзапросы, DISTINCT, оконные функции, внешние джойны — не трогаем;
+  - сводка полная (покрывает все строки таблицы фактов) и свежая (max(id) фактов
+    и версии изменений совпадают с моментом обновления).
+Новые заказы добавляются инкрементально, правки и удаления — пересборкой.
+Равенство точное для целых и с точностью до порядка суммирования для
+вещественных значений. Только SQLite.
+
+    python -m app.rollups --db ../data/app.db            # инкрементально
+    python -m app.rollups --db ../data/app.db --rebuild  # с нуля
+    python -m app.rollups --db ../data/app.db --status
+
+В backend: ROLLUP_REWRITE=0 — не переписывать, ROLLUP_REFRESH_S>0 — фоновое
+обновление с этим периодом."""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Set, Tuple
+
+from app import metrics
+
+ROLLUP_REWRITE = os.getenv("ROLLUP_REWRITE", "1") == "1"
+ROLLUP_REFRESH_S = float(os.getenv("ROLLUP_REFRESH_S", 0))
+STATE_TABLE = "rollup_state"
+CHANGES_TABLE = "rollup_lookup_changes"  # версии таблиц, их поднимают триггеры UPDATE/DELETE
+ROLLUP_ALIAS = "r"
+
+
+class Measure(NamedTuple):
+    name: str
+    expr: str                # выражение для обновления (алиасы из Rollup.source)
+    forms: Tuple[str, ...]   # как оно выглядит в запросе: table.column, без пробелов
+
+
+class Rollup(NamedTuple):
+    name: str
+    source: str                             # FROM-часть обновления с алиасами
+    hwm: Tuple[str, str]                    # монотонный id — высокая вода: (table.column, алиас.колонка в source)
+    root: str                               # таблица фактов: одна её строка = единица в n
+    edges: FrozenSet[FrozenSet[str]]        # внешние ключи {table.col, table.col}
+    dims: Tuple[Tuple[str, str, str], ...]  # (колонка rollup, table.column, выражение обновления)
+    day: str                                # table.column метки времени -> измерение day
+    measures: Tuple[Measure, ...]
+    watch: Tuple[str, ...]                  # таблицы фактов: max(id) сверяется со снимком
+    lookups: Tuple[Tuple[str, Tuple[str, ...]], ...]  # справочники: (таблица, колонки под триггером)
+
+    @property
+    def tables(self) -> Set[str]:
+        return {ref.split(".")[0] for edge in self.edges for ref in edge}
+
+    @property
+    def columns(self) -> List[str]:
+        cols = [d[0] for d in self.dims] + ["n"]
+        for m in self.measures:
+            cols += [m.name, m.name + "_n"]
+        return cols
+
+
+def _edge(a: str, b: str) -> FrozenSet[str]:
+    return frozenset((a, b))
+
+
+ROLLUPS = (
+    Rollup(
+        name="rollup_daily_sales",
+        source="order_items oi JOIN orders o ON o.id = oi.order_id "
+               "JOIN products p ON p.id = oi.product_id JOIN customers c ON c.id = o.customer_id",
+        hwm=("orders.id", "o.id"),
+        root="order_items",
+        edges=frozenset({_edge("order_items.order_id", "orders.id"),
+                         _edge("order_items.product_id", "products.id"),
+                         _edge("orders.customer_id", "customers.id")}),
+        dims=(("day", "orders.created_at", "date(o.created_at)"),
+              ("category", "products.category", "p.category"),
+              ("city", "customers.city", "c.city")),
+        day="orders.created_at",
+        measures=(
+            Measure("quantity", "oi.quantity", ("order_items.quantity",)),
+            Measure("revenue", "oi.quantity * oi.unit_price",
+                    ("order_items.quantity*order_items.unit_price", "order_items.unit_price*order_items.quantity")),
+            Measure("cost", "oi.quantity * oi.unit_cost",
+                    ("order_items.quantity*order_items.unit_cost", "order_items.unit_cost*order_items.quantity")),
+            Measure("margin", "oi.quantity * (oi.unit_price - oi.unit_cost)",
+                    ("order_items.quantity*(order_items.unit_price-order_items.unit_cost)",
+                     "(order_items.unit_price-order_items.unit_cost)*order_items.quantity")),
+            Measure("unit_price", "oi.unit_price", ("order_items.unit_price",)),
+        ),
+        watch=("orders", "order_items"),
+        lookups=(("products", ("category",)), ("customers", ("city",))),
+    ),
+    Rollup(
+        name="rollup_daily_orders",
+        source="orders o JOIN customers c ON c.id = o.customer_id",
+        hwm=("orders.id", "o.id"),
+        root="orders",
+        edges=frozenset({_edge("orders.customer_id", "customers.id")}),
+        dims=(("day", "orders.created_at", "date(o.created_at)"),
+              ("city", "customers.city", "c.city"),
+              ("status", "orders.status", "o.status")),
+        day="orders.created_at",
+        measures=(
+            Measure("revenue", "o.total_amount", ("orders.total_amount",)),
+            Measure("cost", "o.cost_of_goods", ("orders.cost_of_goods",)),
+            Measure("margin", "o.total_amount - o.cost_of_goods", ("orders.total_amount-orders.cost_of_goods",)),
+        ),
+        watch=("orders",),
+        lookups=(("customers", ("city",)),),
+    ),
+)
+
+
+def definition_hash(rollup: Rollup) -> str:
+    # repr(frozenset) зависит от PYTHONHASHSEED — рёбра сортируем
+    fields = rollup._replace(edges=sorted(sorted(e) for e in rollup.edges))
+    return hashlib.sha1(repr(tuple(fields)).encode("utf-8")).hexdigest()[:16]
+
+
+# ------------------------------- обновление -------------------------------
+
+def _table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def source_state(conn: sqlite3.Connection, rollup: Rollup) -> Dict[str, Dict[str, object]]:
+    """Снимок источников: max(id) таблиц фактов (по PK — дёшево) и версии из
+    CHANGES_TABLE — их поднимают триггеры на UPDATE/DELETE таблиц фактов и
+    справочников (правка или удаление учтённого заказа, смена категории товара
+    или города клиента делают сводку неверной). Всё — O(1), без чтения самих таблиц."""
+    out: Dict[str, Dict[str, object]] = {"max_id": {}, "versions": {}}
+    for table in rollup.watch:
+        out["max_id"][table] = conn.execute(f"SELECT max(id) FROM {table}").fetchone()[0] or 0
+    versions = {}
+    if _table_exists(conn, CHANGES_TABLE):
+        versions = dict(conn.execute(f"SELECT tbl, version FROM {CHANGES_TABLE}").fetchall())
+    for table in list(rollup.watch) + [t for t, _ in rollup.lookups]:
+        out["versions"][table] = versions.get(table, 0)
+    return out
+
+
+def _change_triggers(rollup: Rollup) -> List[Tuple[str, str, str]]:
+    """(имя триггера, таблица, условие). Таблицы фактов — любой UPDATE и DELETE
+    (INSERT подхватывает инкрементальное обновление по hwm); справочники — UPDATE
+    ключевых колонок и DELETE: новые строки справочника попадут в сводку вместе с новыми заказами."""
+    out = []
+    for table in rollup.watch:
+        out.append((f"{CHANGES_TABLE}_{table}_upd", table, f"AFTER UPDATE ON {table} FOR EACH ROW"))
+        out.append((f"{CHANGES_TABLE}_{table}_del", table, f"AFTER DELETE ON {table} FOR EACH ROW"))
+    for table, cols in rollup.lookups:
+        changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in ("id",) + cols)
+        out.append((f"{CHANGES_TABLE}_{table}_upd", table,
+                    f"AFTER UPDATE OF {', '.join(('id',) + cols)} ON {table} FOR EACH ROW WHEN {changed}"))
+        out.append((f"{CHANGES_TABLE}_{table}_del", table, f"AFTER DELETE ON {table} FOR EACH ROW"))
+    return out
+
+
+def _missing_triggers(conn: sqlite3.Connection, rollup: Rollup) -> List[Tuple[str, str, str]]:
+    return [t for t in _change_triggers(rollup)
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = ?", (t[0],)).fetchone() is None]
+
+
+def _install_triggers(conn: sqlite3.Connection, rollup: Rollup):
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {CHANGES_TABLE} (tbl TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+    for name, table, when in _missing_triggers(conn, rollup):
+        bump = (f"INSERT INTO {CHANGES_TABLE} (tbl, version) VALUES ('{table}', 1) "
+                f"ON CONFLICT (tbl) DO UPDATE SET version = version + 1")
+        conn.execute(f"CREATE TRIGGER {name} {when} BEGIN {bump}; END")
+        # Пока триггера не было, таблица могла измениться незаметно — сводки на ней пересоберутся
+        conn.execute(bump)
+
+
+def _create(conn: sqlite3.Connection, rollup: Rollup):
+    # Без объявленного типа: NUMERIC превратил бы 100.0 в 100, и ответ из сводки
+    # отличался бы от исходного типом значения
+    cols = list(d[0] for d in rollup.dims) + ["n INTEGER NOT NULL"]
+    for m in rollup.measures:
+        cols += [m.name, f"{m.name}_n INTEGER NOT NULL"]
+    conn.execute(f"CREATE TABLE {rollup.name} ({', '.join(cols)})")
+    keys = ", ".join(d[0] for d in rollup.dims)
+    conn.execute(f"CREATE UNIQUE INDEX {rollup.name}_key ON {rollup.name}({keys})")
+
+
+def _upsert_sql(rollup: Rollup) -> str:
+    dims = [d[0] for d in rollup.dims]
+    select = [d[2] for d in rollup.dims] + ["COUNT(*)"]
+    update = ["n = n + excluded.n"]
+    for m in rollup.measures:
+        select += [f"SUM({m.expr})", f"COUNT({m.expr})"]
+        # NULL + x = NULL: группа, где мера была пустой, получает первое непустое значение
+        update += [f"{m.name} = coalesce({m.name} + excluded.{m.name}, {m.name}, excluded.{m.name})",
+                   f"{m.name}_n = {m.name}_n + excluded.{m.name}_n"]
+    group = ", ".join(str(i + 1) for i in range(len(dims)))
+    return (f"INSERT INTO {rollup.name} ({', '.join(rollup.columns)}) "
+            f"SELECT {', '.join(select)} FROM {rollup.source} WHERE {rollup.hwm[1]} > ? AND {rollup.hwm[1]} <= ? "
+            f"GROUP BY {group} "
+            f"ON CONFLICT ({', '.join(dims)}) DO UPDATE SET {', '.join(update)}")
+
+
+def _read_state(conn: sqlite3.Connection, rollup: Rollup) -> Optional[tuple]:
+    if not _table_exists(conn, STATE_TABLE):
+        return None
+    return conn.execute(f"SELECT definition, hwm, source, source_rows, covered_rows FROM {STATE_TABLE} WHERE name = ?",
+                        (rollup.name,)).fetchone()
+
+
+def _unchanged(conn: sqlite3.Connection, rollup: Rollup, row: Optional[tuple], definition: str) -> bool:
+    """Состояние совпадает с источниками — обновлять нечего. Только чтение: холостой
+    прогон не пишет в БД и не сдвигает PRAGMA data_version (кэш результатов живёт дальше)."""
+    if row is None or row[0] != definition or not _table_exists(conn, rollup.name) or _missing_triggers(conn, rollup):
+        return False
+    return json.loads(row[2]) == source_state(conn, rollup)
+
+
+def _result(rollup: Rollup, hwm_before: int, hwm: int, source_rows: int, covered: int, started: float,
+            changed: bool) -> Dict[str, object]:
+    return {
+        "name": rollup.name, "hwm_before": hwm_before, "hwm": hwm, "changed": changed,
+        "source_rows": source_rows, "covered_rows": covered,
+        # Строки фактов, не попавшие в сводку (битые ссылки, позиции старых заказов,
+        # дописанные позже) — переписывание для неё выключено, поможет --rebuild
+        "complete": covered == source_rows,
+        "ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def refresh(conn: sqlite3.Connection, rollup: Rollup, rebuild: bool = False) -> Dict[str, object]:
+    """Добавляет в сводку заказы с id в (hwm, max(id)] одной транзакцией.
+    conn — пишущее соединение с isolation_level=None. Если источники не менялись,
+    возвращается сразу, ничего не записав. Счётчики строк ведутся по приросту:
+    полный count(*) таблицы фактов — только при пересборке."""
+    started = time.perf_counter()
+    definition = definition_hash(rollup)
+    hwm_table, hwm_col = rollup.hwm[0].split(".")
+    if not rebuild:
+        row = _read_state(conn, rollup)
+        if _unchanged(conn, rollup, row, definition):
+            return _result(rollup, row[1], row[1], row[3], row[4], started, False)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {STATE_TABLE} ("
+                     " name TEXT PRIMARY KEY, definition TEXT NOT NULL, hwm INTEGER NOT NULL,"
+                     " source TEXT NOT NULL, source_rows INTEGER NOT NULL, covered_rows INTEGER NOT NULL,"
+                     " refreshed_at REAL NOT NULL)")
+        _install_triggers(conn, rollup)
+        # Внутри BEGIN IMMEDIATE никто не пишет — снимок верен и на момент COMMIT
+        row = _read_state(conn, rollup)
+        source = source_state(conn, rollup)
+        old = json.loads(row[2]) if row and row[0] == definition and not rebuild else None
+        if old is not None and (old.get("versions") != source["versions"] or not _table_exists(conn, rollup.name)):
+            old = None  # учтённые строки правили или удаляли — сводку собираем заново
+        hwm = row[1] if old is not None else 0
+        if old is None:
+            # Нет состояния, сменилось определение или явная пересборка — с нуля
+            conn.execute(f"DROP TABLE IF EXISTS {rollup.name}")
+            _create(conn, rollup)
+        upper = conn.execute(f"SELECT max({hwm_col}) FROM {hwm_table}").fetchone()[0] or 0
+        if old is None:
+            source_rows = conn.execute(f"SELECT count(*) FROM {rollup.root}").fetchone()[0]
+            covered = 0
+        else:
+            # Прирост таблицы фактов по её PK: строки с id выше прошлого снимка
+            source_rows = row[3] + conn.execute(
+                f"SELECT count(*) FROM {rollup.root} WHERE id > ? AND id <= ?",
+                (old["max_id"][rollup.root], source["max_id"][rollup.root]),
+            ).fetchone()[0]
+            covered = row[4]
+        if upper > hwm:
+            covered += conn.execute(
+                f"SELECT count(*) FROM {rollup.source} WHERE {rollup.hwm[1]} > ? AND {rollup.hwm[1]} <= ?", (hwm, upper)
+            ).fetchone()[0]
+            conn.execute(_upsert_sql(rollup), (hwm, upper))
+        conn.execute(
+            f"INSERT OR REPLACE INTO {STATE_TABLE} (name, definition, hwm, source, source_rows, covered_rows, refreshed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (rollup.name, definition, upper, json.dumps(source, sort_keys=True), source_rows, covered, time.time()),
+        )
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return _result(rollup, hwm, upper, source_rows, covered, started, True)
+
+
+def refresh_db(path: str, rebuild: bool = False, only: Optional[List[str]] = None) -> List[Dict[str, object]]:
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        return [refresh(conn, r, rebuild) for r in ROLLUPS if not only or r.name in only]
+    finally:
+        conn.close()
+
+
+def _states(conn: sqlite3.Connection) -> Dict[str, tuple]:
+    if not _table_exists(conn, STATE_TABLE):
+        return {}
+    rows = conn.execute(f"SELECT name, definition, hwm, source, source_rows, covered_rows, refreshed_at FROM {STATE_TABLE}")
+    return {r[0]: r[1:] for r in rows}
+
+
+def _usable(conn: sqlite3.Connection, rollup: Rollup, states: Dict[str, tuple]) -> bool:
+    state = states.get(rollup.name)
+    if state is None or state[0] != definition_hash(rollup) or state[3] != state[4]:
+        return False
+    if not _table_exists(conn, rollup.name):
+        return False
+    return json.loads(state[2]) == source_state(conn, rollup)
+
+
+def status(conn: sqlite3.Connection) -> List[Dict[str, object]]:
+    states = _states(conn)
+    out = []
+    for r in ROLLUPS:
+        state = states.get(r.name)
+        if state is None:
+            out.append({"name": r.name, "exists": False})
+            continue
+        out.append({
+            "name": r.name, "exists": True, "hwm": state[1], "source_rows": state[3], "covered_rows": state[4],
+            "refreshed_at": state[5], "usable": _usable(conn, r, states),
+            "rows": conn.execute(f"SELECT count(*) FROM {r.name}").fetchone()[0] if _table_exists(conn, r.name) else 0,
+        })
+    return out
+
+
+# ------------------------------- разбор SQL -------------------------------
+
+_TOKEN = re.compile(
+    r"""(?P<ws>\s+)
+      | (?P<comment>--[^\n]*|/\*.*?(?:\*/|$))
+      | (?P<string>'(?:[^']|'')*')
+      | (?P<quoted>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])
+      | (?P<lparen>\()
+      | (?P<rparen>\))
+      | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+      | (?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+)
+      | (?P<op><=|>=|<>|!=|==|\|\||<<|>>|[-+*/%<>=,.;?&|~])
+      | (?P<other>.)""",
+    re.S | re.X,
+)
+
+AGGREGATES = frozenset({"sum", "total", "avg", "count", "min", "max"})
+# Скалярные функции, которые можно применять к измерениям rollup как к исходным колонкам.
+# Неизвестная функция (в т.ч. group_concat и прочие агрегаты) — отказ
+SCALAR_FUNCTIONS = frozenset({
+    "abs", "coalesce", "ifnull", "iif", "instr", "julianday", "length", "lower", "ltrim", "nullif",
+    "printf", "format", "replace", "round", "rtrim", "substr", "substring", "trim", "upper", "cast",
+    "date", "strftime", "typeof",
+})
+KEYWORDS = frozenset({
+    "AND", "OR", "NOT", "IS", "NULL", "IN", "LIKE", "GLOB", "BETWEEN", "ESCAPE", "CASE", "WHEN", "THEN",
+    "ELSE", "END", "ASC", "DESC", "NULLS", "FIRST", "LAST", "COLLATE", "NOCASE", "BINARY", "RTRIM", "AS",
+    "TRUE", "FALSE", "INTEGER", "INT", "REAL", "TEXT", "NUMERIC", "FLOAT", "DATE", "OFFSET",
+})
+UNSUPPORTED = frozenset({
+    "UNION", "EXCEPT", "INTERSECT", "WITH", "RECURSIVE", "OVER", "WINDOW", "FILTER", "DISTINCT", "ALL",
+    "EXISTS", "NATURAL", "LEFT", "RIGHT", "FULL", "OUTER", "CROSS", "USING", "VALUES", "INDEXED",
+})
+_CLAUSES = ("SELECT", "FROM", "WHERE", "GROUP BY", "HAVING", "ORDER BY", "LIMIT")
+_DATE_LITERAL = re.compile(r"^'\d{4}-\d{2}-\d{2}'$")
+# Модификаторы date()/strftime(), результат которых зависит только от даты
+_DATE_MODIFIER = re.compile(r"^'(?:start of (?:month|year)|[+-]?\d+ (?:days?|months?|years?)|weekday [0-6])'$", re.I)
+_DATE_FORMAT = re.compile(r"^'(?:[^%']|%[YmdjWw%])*'$")
+# Токены, между которыми сравнение с created_at не может быть частью более связного выражения
+_BOUNDARY_WORDS = frozenset({"AND", "OR", "NOT", "WHEN", "THEN", "ELSE", "END"})
+
+
+class NoRewrite(Exception):
+    pass
+
+
+class Tok(NamedTuple):
+    kind: str
+    text: str
+    start: int
+    end: int
+
+    @property
+    def name(self) -> str:
+        if self.kind == "quoted":
+            return self.text[1:-1].lower()
+        return self.text.lower()
+
+    @property
+    def upper(self) -> str:
+        return self.text.upper() if self.kind == "word" else ""
+
+
+def tokenize(sql: str) -> List[Tok]:
+    out = []
+    for m in _TOKEN.finditer(sql):
+        kind = m.lastgroup
+        if kind == "ws":
+            continue
+        if kind == "comment":
+            raise NoRewrite("comment")
+        out.append(Tok(kind, m.group(), m.start(), m.end()))
+    while out and out[-1].text == ";":
+        out.pop()
+    return out
+
+
+def _split(toks: List[Tok], sep: str) -> List[List[Tok]]:
+    """Разбиение на верхнем уровне скобок по запятой (sep=",") или AND (sep="AND";
+    AND внутри BETWEEN ... AND не режет)."""
+    parts, cur, depth, between = [], [], 0, False
+    for t in toks:
+        if t.kind == "lparen":
+            depth += 1
+        elif t.kind == "rparen":
+            depth -= 1
+        elif depth == 0 and t.upper == "BETWEEN":
+            between = True
+        elif depth == 0 and (t.text == sep if sep == "," else t.upper == sep):
+            if sep == "AND" and between:
+                between = False
+            else:
+                parts.append(cur)
+                cur = []
+                continue
+        cur.append(t)
+    parts.append(cur)
+    if any(not p for p in parts):
+        raise NoRewrite("empty term")
+    return parts
+
+
+def _close(toks: List[Tok], i: int) -> int:
+    depth = 0
+    for j in range(i, len(toks)):
+        if toks[j].kind == "lparen":
+            depth += 1
+        elif toks[j].kind == "rparen":
+            depth -= 1
+            if depth == 0:
+                return j
+    raise NoRewrite("unbalanced parens")
+
+
+def _join(parts: List[str]) -> str:
+    out = ""
+    for p in parts:
+        if out and not out.endswith("(") and p not in (")", ",") and not (p == "(" and out[-1].isalnum()):
+            out += " "
+        out += p
+    return out
+
+
+def _strip_parens(s: str) -> str:
+    while s.startswith("(") and s.endswith(")"):
+        depth = 0
+        for i, ch in enumerate(s):
+            depth += ch == "("
+            depth -= ch == ")"
+            if depth == 0 and i < len(s) - 1:
+                return s
+        s = s[1:-1]
+    return s
+
+
+class Expr(NamedTuple):
+    text: str
+    refs: FrozenSet[str]  # колонки rollup, упомянутые вне агрегатов
+    agg: bool
+
+
+class Query:
+    """SELECT, разрезанный на предложения верхнего уровня. Разбор не зависит от БД,
+    поэтому запросы без агрегатов отсеиваются до обращения к ней."""
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        toks = tokenize(sql)
+        if not toks or toks[0].upper != "SELECT":
+            raise NoRewrite("not a select")
+        if any(t.upper in UNSUPPORTED for t in toks) or sum(t.upper == "SELECT" for t in toks) > 1:
+            raise NoRewrite("unsupported construct")
+        if any(t.text == ";" for t in toks):
+            raise NoRewrite("multiple statements")
+        self.clauses: Dict[str, List[Tok]] = {}
+        depth, current, i = 0, None, 0
+        order = []
+        while i < len(toks):
+            t = toks[i]
+            if t.kind == "lparen":
+                depth += 1
+            elif t.kind == "rparen":
+                depth -= 1
+            name = None
+            if depth == 0 and t.kind == "word":
+                up = t.upper
+                if up in ("GROUP", "ORDER") and i + 1 < len(toks) and toks[i + 1].upper == "BY":
+                    name = up + " BY"
+                elif up in _CLAUSES:
+                    name = up
+            if name is not None:
+                if name in self.clauses:
+                    raise NoRewrite(f"duplicate {name}")
+                order.append(name)
+                current = self.clauses[name] = []
+                i += 2 if name.endswith(" BY") else 1
+                continue
+            current.append(t)
+            i += 1
+        if order != [c for c in _CLAUSES if c in order] or "FROM" not in self.clauses:
+            raise NoRewrite("clause order")
+        words = {t.name for t in toks if t.kind == "word"}
+        if "GROUP BY" not in self.clauses and not words & AGGREGATES:
+            raise NoRewrite("not an aggregate")
+
+
+class _Rewrite:
+    """Перевод одного разобранного запроса на одну сводку. NoRewrite — не доказали."""
+
+    def __init__(self, query: Query, rollup: Rollup, columns: Dict[str, Dict[str, bool]]):
+        self.q = query
+        self.r = rollup
+        self.columns = columns  # table -> {column: это INTEGER PRIMARY KEY}
+        self.dims = {d[1]: d[0] for d in rollup.dims}
+        self.measures = {}
+        for m in rollup.measures:
+            for form in m.forms:
+                self.measures[form] = m.name
+        self.aliases: Dict[str, str] = {}
+        self.select_aliases: Set[str] = set()
+        self.alias_exprs: Dict[str, Expr] = {}
+
+    # ---------------------------- FROM ----------------------------
+
+    def _table_ref(self, toks: List[Tok], i: int) -> int:
+        t = toks[i] if i < len(toks) else None
+        if t is None or t.kind not in ("word", "quoted") or t.upper in KEYWORDS:
+            raise NoRewrite("table expected")
+        table = t.name
+        if table not in self.r.tables or table not in self.columns:
+            raise NoRewrite(f"table {table} is not in rollup")
+        if table in self.aliases.values():
+            raise NoRewrite("self join")
+        i += 1
+        alias = table
+        if i < len(toks) and toks[i].upper == "AS":
+            i += 1
+        if i < len(toks) and toks[i].kind in ("word", "quoted") and toks[i].upper not in ("JOIN", "INNER", "ON"):
+            alias = toks[i].name
+            i += 1
+        if alias in self.aliases:
+            raise NoRewrite("duplicate alias")
+        self.aliases[alias] = table
+        if alias != table:
+            self.aliases.setdefault(table, table)
+        return i
+
+    def _edge(self, conj: List[Tok]) -> Optional[FrozenSet[str]]:
+        """a.x = b.y между разными таблицами -> ребро, иначе None."""
+        eq = [i for i, t in enumerate(conj) if t.text in ("=", "==")]
+        if len(eq) != 1:
+            return None
+        left, right = conj[:eq[0]], conj[eq[0] + 1:]
+        refs = []
+        for side in (left, right):
+            ref = self._column(side) if len(side) in (1, 3) else None
+            if ref is None:
+                return None
+            refs.append(ref)
+        if refs[0].split(".")[0] == refs[1].split(".")[0]:
+            return None
+        return frozenset(refs)
+
+    def _column(self, toks: List[Tok]) -> Optional[str]:
+        if len(toks) == 3 and toks[1].text == "." and all(t.kind in ("word", "quoted") for t in (toks[0], toks[2])):
+            return self._resolve(toks[0].name, toks[2].name)
+        if len(toks) == 1 and toks[0].kind in ("word", "quoted"):
+            return self._resolve(None, toks[0].name)
+        return None
+
+    def _resolve(self, qualifier: Optional[str], column: str) -> Optional[str]:
+        if qualifier is not None:
+            table = self.aliases.get(qualifier)
+            return f"{table}.{column}" if table and column in self.columns[table] else None
+        owners = {t for t in self.aliases.values() if column in self.columns[t]}
+        return f"{owners.pop()}.{column}" if len(owners) == 1 else None
+
+    def _from(self) -> List[List[Tok]]:
+        toks = self.q.clauses["FROM"]
+        edges = set()
+        i = self._table_ref(toks, 0)
+        while i < len(toks):
+            t = toks[i]
+            if t.text == ",":
+                i = self._table_ref(toks, i + 1)
+                continue
+            if t.upper == "INNER":
+                i += 1
+            if i >= len(toks) or toks[i].upper != "JOIN":
+                raise NoRewrite("join expected")
+            i = self._table_ref(toks, i + 1)
+            if i >= len(toks) or toks[i].upper != "ON":
+                raise NoRewrite("join without ON")
+            j = i + 1
+            depth = 0
+            while j < len(toks) and not (depth == 0 and (toks[j].upper in ("JOIN", "INNER") or toks[j].text == ",")):
+                depth += toks[j].kind == "lparen"
+                depth -= toks[j].kind == "rparen"
+                j += 1
+            for conj in _split(toks[i + 1:j], "AND"):
+                edge = self._edge(conj)
+                if edge is None:
+                    raise NoRewrite("non-key join condition")
+                edges.add(edge)
+            i = j
+
+        # Условия WHERE вида a.x = b.y — тоже джойны (FROM a, b WHERE ...)
+        filters = []
+        if "WHERE" in self.q.clauses:
+            for conj in _split(self.q.clauses["WHERE"], "AND"):
+                edge = self._edge(conj)
+                if edge is None:
+                    filters.append(conj)
+                else:
+                    edges.add(edge)
+
+        tables = set(self.aliases.values())
+        if self.r.root not in tables:
+            raise NoRewrite("fact table is not joined")
+        expected = {e for e in self.r.edges if all(ref.split(".")[0] in tables for ref in e)}
+        # Ровно внешние ключи между выбранными таблицами, и они связывают все таблицы (дерево)
+        if edges != expected or len(edges) != len(tables) - 1:
+            raise NoRewrite("join graph differs from rollup")
+        return filters
+
+    # ------------------------- выражения -------------------------
+
+    def _day_ref(self, toks: List[Tok]) -> bool:
+        return self._column(toks) == self.r.day
+
+    def _ref_span(self, toks: List[Tok], i: int) -> int:
+        if i + 2 < len(toks) and toks[i + 1].text == "." and toks[i + 2].kind in ("word", "quoted"):
+            return 3
+        return 1
+
+    @staticmethod
+    def _boundary(t: Optional[Tok]) -> bool:
+        return t is None or t.kind in ("lparen", "rparen") or t.text == "," or t.upper in _BOUNDARY_WORDS
+
+    def _date_call(self, name: str, args: List[Tok]) -> Optional[str]:
+        """date(ts[, модификаторы]) / strftime(fmt, ts[, ...]) / substr(ts, 1, n<=10) -> то же от day."""
+        parts = _split(args, ",") if args else []
+        day = f"{ROLLUP_ALIAS}.{self.dims[self.r.day]}"
+        if name == "date" and parts and self._day_ref(parts[0]):
+            mods = parts[1:]
+            if not mods:
+                return day
+            if all(len(p) == 1 and _DATE_MODIFIER.match(p[0].text) for p in mods):
+                return _join(["date", "(", ", ".join([day] + [p[0].text for p in mods]), ")"])
+        if name == "strftime" and len(parts) >= 2 and len(parts[0]) == 1 and _DATE_FORMAT.match(parts[0][0].text) \
+                and self._day_ref(parts[1]):
+            mods = parts[2:]
+            if all(len(p) == 1 and _DATE_MODIFIER.match(p[0].text) for p in mods):
+                return _join(["strftime", "(", ", ".join([parts[0][0].text, day] + [p[0].text for p in mods]), ")"])
+        if name in ("substr", "substring") and len(parts) == 3 and self._day_ref(parts[0]) \
+                and [t.text for t in parts[1]] == ["1"] and len(parts[2]) == 1 and parts[2][0].kind == "number" \
+                and parts[2][0].text.isdigit() and int(parts[2][0].text) <= 10:
+            return _join([name, "(", f"{day}, 1, {parts[2][0].text}", ")"])
+        return None
+
+    def _measure(self, args: List[Tok]) -> str:
+        parts = []
+        i = 0
+        while i < len(args):
+            t = args[i]
+            if t.kind in ("word", "quoted") and not (i + 1 < len(args) and args[i + 1].kind == "lparen"):
+                span = self._ref_span(args, i)
+                ref = self._column(args[i:i + span])
+                if ref is None:
+                    raise NoRewrite(f"unknown column in aggregate: {t.text}")
+                parts.append(ref)
+                i += span
+                continue
+            parts.append(t.text.lower())
+            i += 1
+        key = _strip_parens("".join(parts))
+        name = self.measures.get(key)
+        if name is None:
+            raise NoRewrite(f"no measure for {key}")
+        return name
+
+    def _aggregate(self, name: str, args: List[Tok], clause: str) -> str:
+        if clause in ("WHERE", "GROUP BY"):
+            raise NoRewrite("aggregate outside SELECT/HAVING/ORDER BY")
+        r = ROLLUP_ALIAS
+        if name == "count":
+            if [t.text for t in args] in (["*"], ["1"]):
+                return f"COALESCE(SUM({r}.n), 0)"
+            ref = self._column(args)
+            if ref is not None and self.columns[ref.split(".")[0]].get(ref.split(".")[1]):
+                return f"COALESCE(SUM({r}.n), 0)"  # INTEGER PRIMARY KEY не бывает NULL
+            return f"COALESCE(SUM({r}.{self._measure(args)}_n), 0)"
+        if name in ("min", "max"):
+            inner = self._expr(args, "MINMAX")
+            return f"{name.upper()}({inner.text})"
+        m = self._measure(args)
+        if name == "avg":
+            return f"(TOTAL({r}.{m}) / NULLIF(SUM({r}.{m}_n), 0))"
+        return f"{name.upper()}({r}.{m})"
+
+    def _expr(self, toks: List[Tok], clause: str) -> Expr:
+        out, refs, agg = [], set(), False
+        i = 0
+        while i < len(toks):
+            t = toks[i]
+            prev = toks[i - 1] if i else None
+            if t.kind == "word" and i + 1 < len(toks) and toks[i + 1].kind == "lparen" \
+                    and (t.upper not in KEYWORDS or t.name in SCALAR_FUNCTIONS):  # IN (...) — не вызов
+                j = _close(toks, i + 1)
+                name, args = t.name, toks[i + 2:j]
+                n_args = len(_split(args, ",")) if args else 0
+                if name in AGGREGATES and not (name in ("min", "max") and n_args > 1):
+                    if clause == "MINMAX":
+                        raise NoRewrite("nested aggregate")
+                    out.append(self._aggregate(name, args, clause))
+                    agg = True
+                else:
+                    if name not in SCALAR_FUNCTIONS and name not in ("min", "max"):
+                        raise NoRewrite(f"function {name}")
+                    call = self._date_call(name, args)
+                    if call is not None:
+                        out.append(call)
+                        refs.add(self.dims[self.r.day])
+                    else:
+                        inner = self._expr(args, clause) if args else Expr("", frozenset(), False)
+                        out += [t.text, "(", inner.text, ")"] if inner.text else [t.text, "(", ")"]
+                        refs |= inner.refs
+                        agg |= inner.agg
+                i = j + 1
+                continue
+
+            if t.kind == "string" and _DATE_LITERAL.match(t.text) and self._boundary(prev) \
+                    and i + 2 < len(toks) and toks[i + 1].text in ("<=", ">"):
+                # 'YYYY-MM-DD' <= created_at  <=>  'YYYY-MM-DD' <= date(created_at)
+                span = self._ref_span(toks, i + 2)
+                after = toks[i + 2 + span] if i + 2 + span < len(toks) else None
+                if self._day_ref(toks[i + 2:i + 2 + span]) and self._boundary(after):
+                    day = self.dims[self.r.day]
+                    out += [t.text, toks[i + 1].text, f"{ROLLUP_ALIAS}.{day}"]
+                    refs.add(day)
+                    i += 2 + span
+                    continue
+
+            if t.kind in ("word", "quoted") and not (t.kind == "word" and t.upper in KEYWORDS and
+                                                     self._ref_span(toks, i) == 1 and self._resolve(None, t.name) is None):
+                span = self._ref_span(toks, i)
+                bare = span == 1
+                if bare and clause == "ORDER BY" and t.name in self.select_aliases:
+                    out.append(t.text)
+                    i += 1
+                    continue
+                ref = self._column(toks[i:i + span])
+                if ref is None:
+                    if bare and t.name in self.select_aliases and clause != "MINMAX":
+                        # В WHERE/GROUP BY/HAVING SQLite сначала ищет колонку, и в rollup она может
+                        # найтись (AS day) — тогда подставляем само выражение алиаса
+                        if t.name in self.r.columns:
+                            e = self.alias_exprs.get(t.name)
+                            if e is None:
+                                raise NoRewrite(f"alias {t.name} shadows rollup column")
+                            out.append(f"({e.text})")
+                            refs |= e.refs
+                            agg |= e.agg
+                            i += 1
+                            continue
+                        out.append(t.text)
+                        i += 1
+                        continue
+                    raise NoRewrite(f"unknown identifier {t.text}")
+                if ref == self.r.day:
+                    nxt = toks[i + span:i + span + 3]
+                    if len(nxt) >= 2 and nxt[0].text in (">=", "<") and nxt[1].kind == "string" \
+                            and _DATE_LITERAL.match(nxt[1].text) and self._boundary(prev) \
+                            and self._boundary(nxt[2] if len(nxt) > 2 else None):
+                        # created_at >= 'YYYY-MM-DD'  <=>  date(created_at) >= 'YYYY-MM-DD' (и так же для <)
+                        day = self.dims[self.r.day]
+                        out += [f"{ROLLUP_ALIAS}.{day}", nxt[0].text, nxt[1].text]
+                        refs.add(day)
+                        i += span + 2
+                        continue
+                    raise NoRewrite("timestamp used beyond date granularity")
+                dim = self.dims.get(ref)
+                if dim is None:
+                    raise NoRewrite(f"{ref} is not a rollup dimension")
+                out.append(f"{ROLLUP_ALIAS}.{dim}")
+                refs.add(dim)
+                i += span
+                continue
+
+            out.append(t.text)
+            i += 1
+        return Expr(_join(out), frozenset(refs), agg)
+
+    # --------------------------- запрос ---------------------------
+
+    def _select_items(self) -> List[Tuple[List[Tok], Optional[str]]]:
+        items = []
+        for item in _split(self.q.clauses["SELECT"], ","):
+            alias = None
+            last = item[-1]
+            if len(item) >= 3 and item[-2].upper == "AS" and last.kind in ("word", "quoted", "string"):
+                alias, item = last, item[:-2]
+            elif len(item) >= 2 and last.kind in ("word", "quoted") and last.upper not in KEYWORDS \
+                    and item[-2].text != "." and item[-2].kind in ("word", "quoted", "rparen", "number", "string") \
+                    and (item[-2].upper not in KEYWORDS or item[-2].upper == "END"):
+                alias, item = last, item[:-1]
+            if alias is not None:
+                name = alias.text[1:-1] if alias.kind in ("quoted", "string") else alias.text
+                self.select_aliases.add(name.lower())
+            else:
+                name = None
+            items.append((item, name))
+        return items
+
+    def _output_name(self, item: List[Tok]) -> str:
+        # Без алиаса SQLite называет колонку её объявленным именем, выражение — его текстом
+        ref = self._column(item)
+        if ref is not None:
+            return ref.split(".")[1]
+        return self.q.sql[item[0].start:item[-1].end]
+
+    def build(self) -> str:
+        filters = self._from()
+        items = self._select_items()
+        select, selected = [], []
+        for item, alias in items:
+            if len(item) == 1 and item[0].text == "*":
+                raise NoRewrite("select *")
+            e = self._expr(item, "SELECT")
+            name = alias if alias is not None else self._output_name(item)
+            select.append(f'{e.text} AS "{name.replace(chr(34), chr(34) * 2)}"')
+            selected.append((e, (alias or "").lower()))
+            if alias is not None:
+                self.alias_exprs[alias.lower()] = e
+
+        grouped = "GROUP BY" in self.q.clauses
+        group_texts, group_aliases, group = set(), set(), []
+        if grouped:
+            for term in _split(self.q.clauses["GROUP BY"], ","):
+                if len(term) == 1 and term[0].kind == "number" and term[0].text.isdigit():
+                    k = int(term[0].text)
+                    if not 1 <= k <= len(selected):
+                        raise NoRewrite("bad GROUP BY position")
+                    group_texts.add(selected[k - 1][0].text)
+                    group.append(term[0].text)
+                    continue
+                if len(term) == 1 and term[0].name in self.select_aliases and self._column(term) is None:
+                    group_aliases.add(term[0].name)
+                e = self._expr(term, "GROUP BY")
+                group_texts.add(e.text)
+                group.append(e.text)
+        elif not any(e.agg for e, _ in selected):
+            raise NoRewrite("not an aggregate")
+
+        def determined(e: Expr, alias: str = "") -> bool:
+            """Значение однозначно в группе: всё вне агрегатов — группируемые выражения.
+            Без GROUP BY голые колонки рядом с агрегатом берутся из произвольной строки — отказ."""
+            if not e.refs:
+                return True
+            if not grouped:
+                return False
+            return e.text in group_texts or alias in group_aliases or \
+                all(f"{ROLLUP_ALIAS}.{d}" in group_texts for d in e.refs)
+
+        for e, alias in selected:
+            if not determined(e, alias):
+                raise NoRewrite("ungrouped column in SELECT")
+
+        where = []
+        for conj in filters:
+            e = self._expr(conj, "WHERE")
+            where.append(e.text if len(filters) == 1 else f"({e.text})")
+
+        having = None
+        if "HAVING" in self.q.clauses:
+            e = self._expr(self.q.clauses["HAVING"], "HAVING")
+            if not determined(e):
+                raise NoRewrite("ungrouped column in HAVING")
+            having = e.text
+
+        order = []
+        if "ORDER BY" in self.q.clauses:
+            for term in _split(self.q.clauses["ORDER BY"], ","):
+                if term[0].kind == "number":
+                    order.append(_join([t.text for t in term]))
+                    continue
+                e = self._expr(term, "ORDER BY")
+                if not determined(e):
+                    raise NoRewrite("ungrouped column in ORDER BY")
+                order.append(e.text)
+
+        limit = None
+        if "LIMIT" in self.q.clauses:
+            toks = self.q.clauses["LIMIT"]
+            if not all(t.kind == "number" or t.text in (",", "?") or t.upper == "OFFSET" for t in toks):
+                raise NoRewrite("complex LIMIT")
+            limit = _join([t.text for t in toks])
+
+        sql = f"SELECT {', '.join(select)} FROM {self.r.name} {ROLLUP_ALIAS}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        if group:
+            sql += " GROUP BY " + ", ".join(group)
+        if having:
+            sql += " HAVING " + having
+        if order:
+            sql += " ORDER BY " + ", ".join(order)
+        if limit:
+            sql += " LIMIT " + limit
+        return sql
+
+
+class RollupRewrite(NamedTuple):
+    sql: str
+    rollup: str
+
+
+class Rewriter:
+    """Переписывает агрегаты на сводки. Готовность сводок (полнота, свежесть,
+    колонки таблиц) кэшируется по токену версии данных (db_utils.data_version)."""
+
+    def __init__(self, rollups: Tuple[Rollup, ...] = ROLLUPS):
+        self.rollups = rollups
+        self._lock = threading.Lock()
+        self._version = None
+        self._ready: Dict[str, bool] = {}
+        self._columns: Dict[str, Dict[str, bool]] = {}
+        self.hits: Dict[str, int] = {}
+        self.stale: Dict[str, int] = {}
+        self.no_match = 0
+        self.errors = 0
+
+    def _load(self, conn: sqlite3.Connection, version) -> Tuple[Dict[str, bool], Dict[str, Dict[str, bool]]]:
+        with self._lock:
+            if version is not None and version == self._version:
+                return self._ready, self._columns
+        columns = {}
+        for table in set().union(*(r.tables for r in self.rollups)):
+            info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+            if info:
+                pks = [row for row in info if row[5]]
+                columns[table] = {
+                    row[1].lower(): len(pks) == 1 and row[5] == 1 and row[2].upper() == "INTEGER" for row in info
+                }
+        states = _states(conn)
+        ready = {r.name: _usable(conn, r, states) for r in self.rollups}
+        with self._lock:
+            self._version, self._ready, self._columns = version, ready, columns
+        return ready, columns
+
+    def rewrite(self, conn: sqlite3.Connection, sql: str, version=None) -> Optional[RollupRewrite]:
+        try:
+            query = Query(sql)
+        except NoRewrite:
+            return self._miss()
+        try:
+            ready, columns = self._load(conn, version)
+        except sqlite3.Error:
+            with self._lock:
+                self.errors += 1
+            return None
+        for rollup in self.rollups:
+            try:
+                text = _Rewrite(query, rollup, columns).build()
+            except NoRewrite:
+                continue
+            result = "hit" if ready.get(rollup.name) else "stale"
+            with self._lock:
+                counts = self.hits if result == "hit" else self.stale
+                counts[rollup.name] = counts.get(rollup.name, 0) + 1
+            metrics.rollup_lookup(rollup.name, result)
+            return RollupRewrite(text, rollup.name) if result == "hit" else None
+        return self._miss()
+
+    def _miss(self):
+        with self._lock:
+            self.no_match += 1
+        metrics.rollup_lookup("", "no_match")
+        return None
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {"hits": dict(self.hits), "stale": dict(self.stale), "no_match": self.no_match,
+                    "errors": self.errors, "ready": dict(self._ready)}
+
+
+rewriter = Rewriter()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="refresh rollup tables (incremental by orders.id high-water mark)")
+    ap.add_argument("--db", default=os.getenv("DB_PATH", "../data/app.db"))
+    ap.add_argument("--rebuild", action="store_true", help="пересобрать с нуля")
+    ap.add_argument("--only", nargs="*", help="имена сводок")
+    ap.add_argument("--status", action="store_true", help="только показать состояние")
+    args = ap.parse_args()
+    if args.status:
+        conn = sqlite3.connect(args.db)
+        try:
+            print(json.dumps(status(conn), ensure_ascii=False, indent=2))
+        finally:
+            conn.close()
+    else:
+        for res in refresh_db(args.db, args.rebuild, args.only):
+            print(json.dumps(res, ensure_ascii=False))
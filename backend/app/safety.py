@@ -1,22 +1,180 @@
-import re
+"""Проверка SQL на основе токенизатора sqlparse (а не поиска подстрок):
+колонки вроде created_at / updated больше не ловятся как CREATE / UPDATE.
+Используется backend'ом, ботом (tg_miniapp/bot/botai.py) и infer_sql.py."""
+from functools import lru_cache
+from typing import FrozenSet, Iterable, NamedTuple, Optional, Tuple
+
+import sqlparse
+from sqlparse import tokens as T
 
 # Довольно строгие правила — можно расширять
-DANGEROUS = re.compile(r"\b(drop|delete|update|insert|truncate|merge|alter|grant|revoke|create)\b", re.I)
-MULTI = re.compile(r";")
-SELECT_START = re.compile(r"^\s*select\b", re.I)
-WHITELIST_TABLES = {"students","orders","products","customers","inventory","orders","order_items","customers","products","students"}
-
-def is_safe_sql(sql: str) -> (bool, str):
-    if DANGEROUS.search(sql):
-        return False, "detected DDL/DML keyword"
-    if MULTI.search(sql):
-        return False, "multiple statements are forbidden"
-    if not SELECT_START.search(sql):
-        return False, "only SELECT queries allowed"
-    # Простая проверка на использование таблиц — если модель упомянула неизвестную таблицу — warn but allow columns
-    tokens = re.findall(r"\b[a-zA-Z_][a-zA-Z0-9_]*\b", sql)
-    used_tables = {t.lower() for t in tokens if t.lower() in WHITELIST_TABLES}
-    if not used_tables:
-        # Может быть безопасный aggregate without table mention — we'll allow but flag
-        return True, None
-    return True, None
+WHITELIST_TABLES = frozenset({"students", "orders", "products", "customers", "inventory", "order_items"})
+
+FORBIDDEN_KEYWORDS = frozenset({
+    "INTO", "ATTACH", "DETACH", "PRAGMA", "VACUUM", "REINDEX", "GRANT", "REVOKE",
+    "TRUNCATE", "MERGE", "COPY", "CALL", "EXEC", "EXECUTE",
+})
+FORBIDDEN_FUNCTIONS = frozenset({"load_extension", "readfile", "writefile", "pg_sleep", "pg_read_file", "dblink"})
+
+_NAME_TYPES = (T.Name, T.String.Symbol)
+# Ключевые слова, после которых FROM-список на этом уровне скобок закончен
+_END_FROM = frozenset({"WHERE", "GROUP", "HAVING", "ORDER", "LIMIT", "OFFSET", "WINDOW",
+                       "UNION", "INTERSECT", "EXCEPT", "VALUES", "RETURNING"})
+
+
+class SqlVerdict(NamedTuple):
+    ok: bool
+    reason: Optional[str]
+    sql: str                # канонический вид: без комментариев, ключевые слова в верхнем регистре
+    tables: FrozenSet[str]  # реальные таблицы (без CTE), в нижнем регистре
+
+
+def _unquote(name: str) -> str:
+    if len(name) >= 2 and name[0] in "\"`[" and name[-1] in "\"`]":
+        name = name[1:-1]
+    return name.lower()
+
+
+def _canonical(tokens) -> str:
+    out = []
+    for tok in tokens:
+        # Комментарий заменяем пробелом: "name--c\nFROM" не должен склеиться в "nameFROM"
+        if tok.is_whitespace or tok.ttype in T.Comment:
+            if out and out[-1] not in (" ", "(", "."):
+                out.append(" ")
+            continue
+        if tok.ttype in T.Punctuation and tok.value in ",)." and out and out[-1] == " ":
+            out.pop()
+        out.append(" ".join(tok.normalized.split()) if tok.ttype in T.Keyword else tok.value)
+    sql = "".join(out).strip()
+    while sql.endswith(";"):
+        sql = sql[:-1].rstrip()
+    return sql
+
+
+def _referenced_tables(tokens) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """Проход по плоскому списку токенов: таблицы после FROM/JOIN (и через запятую
+    в FROM-списке) плюс имена CTE, объявленных в WITH."""
+    tables, ctes = set(), set()
+    depth = 0
+    from_depths = set()      # уровни скобок, где сейчас идёт FROM-список
+    expect_table = False
+    last_table = None        # для schema.table берём последнюю часть
+    after_dot = False
+    cte_mode, cte_candidate = False, None
+
+    for tok in tokens:
+        if tok.ttype is T.Punctuation and tok.value == "(":
+            depth += 1
+            if expect_table:
+                # FROM (t) / JOIN (a JOIN b ...): скобки — продолжение FROM-списка;
+                # для подзапроса FROM (SELECT ...) ожидание снимет сам SELECT
+                from_depths.add(depth)
+            last_table = None
+            continue
+        if tok.ttype is T.Punctuation and tok.value == ")":
+            from_depths.discard(depth)
+            depth = max(0, depth - 1)
+            last_table = None
+            continue
+
+        if tok.ttype in T.Keyword.CTE:
+            cte_mode = True
+            continue
+        if tok.ttype in T.Keyword:
+            kw = tok.normalized
+            if cte_mode and depth == 0:
+                if kw == "AS" and cte_candidate:
+                    ctes.add(cte_candidate)
+                    cte_candidate = None
+                elif tok.ttype in T.Keyword.DML:
+                    cte_mode = False
+            if kw == "FROM" or kw.endswith("JOIN"):
+                expect_table = True
+                from_depths.add(depth)
+            elif tok.ttype in T.Keyword.DML or kw.split()[0] in _END_FROM:
+                from_depths.discard(depth)
+                expect_table = False
+            elif kw != "AS":
+                # ON / USING / INDEXED BY / NATURAL: список FROM продолжается, таблица после запятой
+                expect_table = False
+            last_table = None
+            continue
+
+        if tok.ttype is T.Punctuation and tok.value == ".":
+            after_dot = last_table is not None
+            continue
+        if tok.ttype is T.Punctuation and tok.value == "," and depth in from_depths:
+            expect_table = True
+            last_table = None
+            continue
+
+        if tok.ttype in _NAME_TYPES:
+            name = _unquote(tok.value)
+            if cte_mode and depth == 0:
+                cte_candidate = name
+            if after_dot:
+                tables.discard(last_table)
+                tables.add(name)
+                last_table = name
+            elif expect_table:
+                tables.add(name)
+                last_table = name
+                expect_table = False
+            else:
+                last_table = None
+        after_dot = False
+
+    return frozenset(tables - ctes), frozenset(ctes)
+
+
+@lru_cache(maxsize=4096)
+def _validate(sql: str, allowed: Optional[FrozenSet[str]]) -> SqlVerdict:
+    statements = [s for s in sqlparse.parse(sql) if s.token_first(skip_cm=True) is not None]
+    if not statements:
+        return SqlVerdict(False, "empty query", "", frozenset())
+    if len(statements) > 1:
+        return SqlVerdict(False, "multiple statements are forbidden", "", frozenset())
+
+    stmt = statements[0]
+    canonical = _canonical(stmt.flatten())
+    tokens = [t for t in stmt.flatten() if t.ttype not in T.Comment]
+    if stmt.get_type() != "SELECT":
+        return SqlVerdict(False, "only SELECT queries allowed", canonical, frozenset())
+
+    for i, tok in enumerate(tokens):
+        if tok.ttype in T.Keyword.DML and tok.normalized != "SELECT":
+            return SqlVerdict(False, f"detected DML keyword {tok.normalized}", canonical, frozenset())
+        if tok.ttype in T.Keyword.DDL:
+            return SqlVerdict(False, f"detected DDL keyword {tok.normalized}", canonical, frozenset())
+        if tok.ttype in T.Keyword and tok.normalized in FORBIDDEN_KEYWORDS:
+            return SqlVerdict(False, f"forbidden keyword {tok.normalized}", canonical, frozenset())
+        if tok.ttype in T.Name and tok.value.lower() in FORBIDDEN_FUNCTIONS:
+            return SqlVerdict(False, f"forbidden function {tok.value}", canonical, frozenset())
+
+    tables, _ = _referenced_tables(tokens)
+    if allowed is not None:
+        unknown = sorted(tables - allowed)
+        if unknown:
+            return SqlVerdict(False, f"unknown table(s): {', '.join(unknown)}", canonical, tables)
+    return SqlVerdict(True, None, canonical, tables)
+
+
+def validate_sql(sql: str, allowed_tables: Optional[Iterable[str]] = WHITELIST_TABLES) -> SqlVerdict:
+    """Разбирает SQL и возвращает вердикт + канонический текст.
+    Вердикты мемоизируются, повторный запрос не парсится заново.
+    allowed_tables=None — не проверять таблицы."""
+    allowed = None
+    if allowed_tables is not None:
+        allowed = allowed_tables if isinstance(allowed_tables, frozenset) else frozenset(allowed_tables)
+        allowed = frozenset(t.lower() for t in allowed)
+    return _validate(sql.strip(), allowed)
+
+
+def is_safe_sql(sql: str, allowed_tables: Optional[Iterable[str]] = WHITELIST_TABLES) -> Tuple[bool, Optional[str]]:
+    verdict = validate_sql(sql, allowed_tables)
+    return verdict.ok, verdict.reason
+
+
+def cache_info():
+    return _validate.cache_info()
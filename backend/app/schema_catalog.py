@@ -0,0 +1,399 @@
+"""Каталог схемы БД для промпта LLM.
+
+Один раз интроспектирует подключённую БД (SQLite — sqlite_master и
+PRAGMA table_info/foreign_key_list, Postgres — information_schema) и хранит
+компактное описание таблиц: колонки с типами, PK, внешние ключи, примеры
+значений низкокардинальных текстовых колонок, диапазоны дат и число строк.
+Кэш сбрасывается при смене отпечатка схемы (для SQLite он следует за
+PRAGMA schema_version, см. db_utils.schema_fingerprint), статистика
+перечитывается не чаще раза в SCHEMA_STATS_TTL.
+
+В промпт попадают только таблицы, относящиеся к вопросу (совпадения с именами
+таблиц и колонок, синонимами и примерами значений), плюс таблицы-мосты на пути
+по внешним ключам между ними — и только в пределах LLM_SCHEMA_TOKENS. Если не
+помещается, сначала отбрасываются примеры значений, потом наименее релевантные
+таблицы.
+
+    python -m app.schema_catalog --db ../data/app.db
+    python -m app.schema_catalog --db ../data/app.db --question "Выручка по категориям товаров" --tokens 300"""
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from app.rollups import CHANGES_TABLE, ROLLUPS, STATE_TABLE
+
+LLM_SCHEMA_TOKENS = int(os.getenv("LLM_SCHEMA_TOKENS", 600))  # бюджет на описание схемы в промпте
+SCHEMA_STATS_TTL = float(os.getenv("SCHEMA_STATS_TTL", 600))  # как часто перечитывать число строк и примеры
+SCHEMA_SAMPLE_VALUES = int(os.getenv("SCHEMA_SAMPLE_VALUES", 5))
+SCHEMA_SAMPLE_ROWS = int(os.getenv("SCHEMA_SAMPLE_ROWS", 500))
+SCHEMA_SYNONYMS = os.getenv("SCHEMA_SYNONYMS", "")  # JSON {таблица: [основы слов]} поверх DEFAULT_SYNONYMS
+
+MAX_SAMPLE_LEN = 24
+# Служебные таблицы: сводки подставляет сам backend (app.rollups), модели о них знать не нужно
+HIDDEN_TABLES = {STATE_TABLE, CHANGES_TABLE, "sqlite_sequence"} | {r.name for r in ROLLUPS}
+
+# Основы слов из вопросов пользователей (в основном по-русски) -> таблица
+DEFAULT_SYNONYMS: Dict[str, Tuple[str, ...]] = {
+    "students": ("студент", "учащ", "специальност", "возраст", "факультет"),
+    "customers": ("клиент", "покупател", "заказчик", "город", "client", "city"),
+    "products": ("товар", "продукт", "категори", "ассортимент", "себестоимост", "цен", "product", "category"),
+    "orders": ("заказ", "выручк", "продаж", "доход", "марж", "прибыл", "оборот", "чек", "revenue", "sales", "margin"),
+    "order_items": ("позици", "продаж", "количеств", "штук", "продан", "item", "quantity"),
+    "inventory": ("склад", "остат", "запас", "наличи", "stock", "warehouse"),
+}
+
+_TEXT_TYPES = ("CHAR", "TEXT", "CLOB", "STRING")
+_TIME_TYPES = ("DATE", "TIME")
+
+
+class Column(NamedTuple):
+    name: str
+    type: str
+    pk: bool
+    ref: Optional[str]            # "table.column" для внешнего ключа
+    samples: Tuple[str, ...]      # частые значения низкокардинальной текстовой колонки
+    range: Optional[Tuple[str, str]]  # min..max для дат
+
+
+class Table(NamedTuple):
+    name: str
+    columns: Tuple[Column, ...]
+    rows: Optional[int]
+
+    def line(self, samples: bool = True) -> str:
+        parts = []
+        for c in self.columns:
+            s = c.name + (f" {c.type}" if c.type else "")
+            if c.pk:
+                s += " PK"
+            if c.ref:
+                s += f" -> {c.ref}"
+            if samples and c.samples:
+                s += " [" + ", ".join(_quote(v) for v in c.samples) + "]"
+            if samples and c.range:
+                s += f" {c.range[0]}..{c.range[1]}"
+            parts.append(s)
+        tail = f" -- {_human(self.rows)} rows" if self.rows is not None else ""
+        return f"{self.name}({', '.join(parts)}){tail}"
+
+    def refs(self) -> List[str]:
+        return [c.ref.split(".", 1)[0] for c in self.columns if c.ref]
+
+
+class SchemaPrompt(NamedTuple):
+    text: str
+    tables: Tuple[str, ...]
+    tokens: int
+    dropped: Tuple[str, ...]   # выбранные, но не влезли в бюджет
+    matched: bool              # False — по вопросу ничего не нашли, взяли крупнейшие таблицы
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 байта UTF-8 на токен: латиница ≈ 4 символа, кириллица ≈ 2 — для бюджета этого хватает
+    return math.ceil(len(text.encode("utf-8")) / 4)
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _human(n: int) -> str:
+    if n >= 1_000_000:
+        return f"{n / 1_000_000:.1f}M"
+    if n >= 10_000:
+        return f"{n // 1000}k"
+    return str(n)
+
+
+def _ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _is_text(type_: str) -> bool:
+    t = type_.upper()
+    return not t or any(k in t for k in _TEXT_TYPES)
+
+
+def _is_time(type_: str) -> bool:
+    t = type_.upper()
+    return any(k in t for k in _TIME_TYPES)
+
+
+def _profile(run: Callable[[str], List[tuple]], table: str, col: Column) -> Column:
+    """Примеры значений / диапазон колонки по первым SCHEMA_SAMPLE_ROWS строкам.
+    Колонки с почти уникальными значениями (имена, e-mail) примеров не получают."""
+    if col.pk or col.ref:
+        return col
+    t, c = _ident(table), _ident(col.name)
+    try:
+        if _is_time(col.type):
+            lo, hi = run(f"SELECT min({c}), max({c}) FROM {t}")[0]
+            if lo is not None:
+                return col._replace(range=(str(lo)[:10], str(hi)[:10]))
+        elif _is_text(col.type) and SCHEMA_SAMPLE_VALUES > 0:
+            values = [r[0] for r in run(f"SELECT {c} FROM {t} WHERE {c} IS NOT NULL LIMIT {SCHEMA_SAMPLE_ROWS}")]
+            if not values or not all(isinstance(v, str) for v in values):
+                return col
+            counts = Counter(values)
+            if len(counts) > max(2 * SCHEMA_SAMPLE_VALUES, len(values) // 10):
+                return col
+            top = [v for v, _ in counts.most_common() if len(v) <= MAX_SAMPLE_LEN]
+            return col._replace(samples=tuple(top[:SCHEMA_SAMPLE_VALUES]))
+    except Exception:
+        # Статистика — подсказка, а не условие: таймаут или странный тип просто оставляют колонку без неё
+        logging.debug("schema catalog: cannot profile %s.%s", table, col.name, exc_info=True)
+    return col
+
+
+def introspect_sqlite(conn: sqlite3.Connection, stats: bool = True) -> List[Table]:
+    names = [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'"
+        " ORDER BY name"
+    )]
+    names = [n for n in names if n not in HIDDEN_TABLES]
+    # Число строк — из sqlite_stat1, если БД проанализирована (ANALYZE), иначе count(*)
+    analyzed: Dict[str, int] = {}
+    if stats and conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        for tbl, stat in conn.execute("SELECT tbl, stat FROM sqlite_stat1"):
+            if stat:
+                analyzed[tbl] = max(analyzed.get(tbl, 0), int(stat.split()[0]))
+    run = lambda sql: conn.execute(sql).fetchall()
+    tables = []
+    for name in names:
+        refs = {r[3]: f"{r[2]}.{r[4] or 'id'}" for r in conn.execute(f"PRAGMA foreign_key_list({_ident(name)})")}
+        cols = tuple(
+            Column(r[1], (r[2] or "").upper(), bool(r[5]), refs.get(r[1]), (), None)
+            for r in conn.execute(f"PRAGMA table_info({_ident(name)})")
+        )
+        rows = None
+        if stats:
+            rows = analyzed.get(name)
+            if rows is None:
+                rows = conn.execute(f"SELECT count(*) FROM {_ident(name)}").fetchone()[0]
+            cols = tuple(_profile(run, name, c) for c in cols)
+        tables.append(Table(name, cols, rows))
+    return tables
+
+
+def introspect_postgres(engine, stats: bool = True) -> List[Table]:
+    """engine — app.pg_engine.PostgresEngine; только схема public."""
+    columns = engine.query(
+        "SELECT table_name, column_name, data_type FROM information_schema.columns"
+        " WHERE table_schema = 'public' ORDER BY table_name, ordinal_position"
+    )
+    keys = engine.query(
+        "SELECT tc.table_name, kcu.column_name, tc.constraint_type,"
+        " ccu.table_name AS ref_table, ccu.column_name AS ref_column"
+        " FROM information_schema.table_constraints tc"
+        " JOIN information_schema.key_column_usage kcu"
+        "   ON kcu.constraint_name = tc.constraint_name AND kcu.table_schema = tc.table_schema"
+        " LEFT JOIN information_schema.constraint_column_usage ccu"
+        "   ON ccu.constraint_name = tc.constraint_name AND ccu.table_schema = tc.table_schema"
+        "  AND tc.constraint_type = 'FOREIGN KEY'"
+        " WHERE tc.table_schema = 'public' AND tc.constraint_type IN ('PRIMARY KEY', 'FOREIGN KEY')"
+    )
+    pks = {(k["table_name"], k["column_name"]) for k in keys if k["constraint_type"] == "PRIMARY KEY"}
+    refs = {(k["table_name"], k["column_name"]): f"{k['ref_table']}.{k['ref_column']}"
+            for k in keys if k["constraint_type"] == "FOREIGN KEY" and k["ref_table"]}
+    # reltuples — оценка планировщика; -1, пока таблицу ни разу не анализировали
+    estimates = {}
+    if stats:
+        estimates = {r["relname"]: int(r["rows"]) for r in engine.query(
+            "SELECT c.relname, c.reltuples AS rows FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace"
+            " WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p', 'v', 'm')"
+        ) if r["rows"] is not None and r["rows"] >= 0}
+    run = lambda sql: [tuple(r.values()) for r in engine.query(sql)]
+    by_table: Dict[str, List[Column]] = {}
+    for r in columns:
+        t, c = r["table_name"], r["column_name"]
+        by_table.setdefault(t, []).append(Column(c, r["data_type"].upper(), (t, c) in pks, refs.get((t, c)), (), None))
+    tables = []
+    for name, cols in sorted(by_table.items()):
+        if name in HIDDEN_TABLES:
+            continue
+        if stats:
+            cols = [_profile(run, name, c) for c in cols]
+        tables.append(Table(name, tuple(cols), estimates.get(name)))
+    return tables
+
+
+def _stem(word: str) -> str:
+    # Грубая основа для сопоставления форм слова: orders/order, categories/category
+    return word[:max(3, len(word) - 2)]
+
+
+def _words(text: str) -> List[str]:
+    return [w for w in re.findall(r"\w+", text.casefold()) if len(w) >= 3]
+
+
+def load_synonyms(path: str = SCHEMA_SYNONYMS) -> Dict[str, Tuple[str, ...]]:
+    synonyms = dict(DEFAULT_SYNONYMS)
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            for table, words in json.load(f).items():
+                synonyms[table] = tuple(w.casefold() for w in words)
+    return synonyms
+
+
+class SchemaCatalog:
+    """Кэш интроспекции + выбор таблиц под вопрос. Потокобезопасный:
+    загрузка идёт под блокировкой, остальные потоки ждут её результат."""
+
+    def __init__(self, budget: int = LLM_SCHEMA_TOKENS, stats_ttl: float = SCHEMA_STATS_TTL,
+                 synonyms: Optional[Dict[str, Sequence[str]]] = None):
+        self.budget = budget
+        self.stats_ttl = stats_ttl
+        self.synonyms = {t: tuple(w) for t, w in (synonyms if synonyms is not None else load_synonyms()).items()}
+        self._lock = threading.Lock()
+        self._key = None
+        self._expires = 0.0
+        self._tables: List[Table] = []
+        self._lines: Dict[str, Tuple[str, str]] = {}       # имя -> (полная строка, без примеров)
+        self._keywords: Dict[str, Tuple[set, set, set]] = {}  # имя -> (основы имени, синонимы, основы колонок)
+        self._graph: Dict[str, set] = {}
+        self._counts = {"loads": 0, "prompts": 0, "tokens": 0, "tables": 0, "dropped": 0, "unmatched": 0}
+
+    def tables(self, key, loader: Callable[[], List[Table]]) -> List[Table]:
+        """key — отпечаток схемы; loader вызывается при его смене или по истечении stats_ttl."""
+        with self._lock:
+            if key != self._key or time.monotonic() >= self._expires:
+                self._load(loader())
+                self._key = key
+                self._expires = time.monotonic() + self.stats_ttl
+                self._counts["loads"] += 1
+            return self._tables
+
+    def _load(self, tables: List[Table]):
+        self._tables = tables
+        self._lines = {t.name: (t.line(), t.line(samples=False)) for t in tables}
+        self._keywords = {}
+        for t in tables:
+            name = {_stem(w) for w in _words(t.name.replace("_", " "))}
+            cols = {_stem(w) for c in t.columns for w in _words(c.name.replace("_", " "))}
+            self._keywords[t.name] = (name, set(self.synonyms.get(t.name, ())), cols)
+        names = {t.name for t in tables}
+        self._graph = {t.name: set() for t in tables}
+        for t in tables:
+            for ref in t.refs():
+                if ref in names and ref != t.name:
+                    self._graph[t.name].add(ref)
+                    self._graph[ref].add(t.name)
+
+    def score(self, question: str) -> Dict[str, int]:
+        words = _words(question)
+        text = question.casefold()
+        scores = {}
+        for t in self._tables:
+            name, syn, cols = self._keywords[t.name]
+            s = 0
+            for w in words:
+                if any(w.startswith(k) for k in name):
+                    s += 3
+                elif any(w.startswith(k) for k in syn):
+                    s += 3
+                elif any(w.startswith(k) for k in cols):
+                    s += 1
+            # Значение из вопроса ("Москва", "completed") указывает на колонку и таблицу
+            s += 2 * sum(1 for c in t.columns for v in c.samples if len(v) >= 3 and v.casefold() in text)
+            if s:
+                scores[t.name] = s
+        return scores
+
+    def _path(self, src: str, dst: str) -> List[str]:
+        prev = {src: None}
+        todo = deque([src])
+        while todo:
+            node = todo.popleft()
+            if node == dst:
+                break
+            for nxt in sorted(self._graph.get(node, ())):
+                if nxt not in prev:
+                    prev[nxt] = node
+                    todo.append(nxt)
+        if dst not in prev:
+            return []
+        path = []
+        while dst is not None:
+            path.append(dst)
+            dst = prev[dst]
+        return path[::-1]
+
+    def select(self, question: str) -> Tuple[List[str], bool]:
+        """Таблицы по убыванию важности: найденные по вопросу, затем мосты между
+        ними по внешним ключам. Без совпадений — все, начиная с крупнейших."""
+        scores = self.score(question)
+        if not scores:
+            return [t.name for t in sorted(self._tables, key=lambda t: -(t.rows or 0))], False
+        order = sorted(scores, key=lambda n: (-scores[n], n))
+        chosen = list(order)
+        for i, a in enumerate(order):
+            for b in order[i + 1:]:
+                for node in self._path(a, b)[1:-1]:
+                    if node not in chosen:
+                        chosen.append(node)
+        return chosen, True
+
+    def prompt(self, question: str, key, loader: Callable[[], List[Table]], budget: int = None) -> SchemaPrompt:
+        self.tables(key, loader)
+        budget = self.budget if budget is None else budget
+        with self._lock:
+            chosen, matched = self.select(question)
+            lines, used, dropped = [], 0, []
+            for name in chosen:
+                full, compact = self._lines[name]
+                for line in (full, compact):
+                    cost = estimate_tokens(line + "\n")
+                    if used + cost <= budget or not lines and line is compact:
+                        lines.append(line)
+                        used += cost
+                        break
+                else:
+                    dropped.append(name)
+            c = self._counts
+            c["prompts"] += 1
+            c["tokens"] += used
+            c["tables"] += len(lines)
+            c["dropped"] += len(dropped)
+            c["unmatched"] += not matched
+        names = tuple(line.split("(", 1)[0] for line in lines)
+        return SchemaPrompt("\n".join(lines), names, used, tuple(dropped), matched)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            c = dict(self._counts)
+            n = c["prompts"] or 1
+            return {"tables": len(self._tables), "budget_tokens": self.budget, "loads": c["loads"],
+                    "prompts": c["prompts"], "avg_prompt_tokens": round(c["tokens"] / n, 1),
+                    "avg_tables": round(c["tables"] / n, 2), "dropped_tables": c["dropped"],
+                    "unmatched_questions": c["unmatched"]}
+
+
+catalog = SchemaCatalog()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Print the compact schema catalog or the schema part of an LLM prompt")
+    ap.add_argument("--db", default="../data/app.db")
+    ap.add_argument("--question", help="показать только выбранные для вопроса таблицы")
+    ap.add_argument("--tokens", type=int, default=LLM_SCHEMA_TOKENS, help="бюджет на схему")
+    args = ap.parse_args()
+
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    load = lambda: introspect_sqlite(conn)
+    if args.question:
+        p = catalog.prompt(args.question, None, load, args.tokens)
+        print(p.text)
+        print(f"-- {p.tokens} tokens, tables: {', '.join(p.tables)}"
+              + (f", dropped: {', '.join(p.dropped)}" if p.dropped else "")
+              + ("" if p.matched else " (no match, largest tables)"))
+    else:
+        for t in catalog.tables(None, load):
+            print(t.line())
@@ -0,0 +1,115 @@
+import io
+import json
+from typing import Any, Dict, Iterator
+
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow-выдача опциональна
+    pa = None
+
+NDJSON = "application/x-ndjson"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+def _default(o: Any):
+    if isinstance(o, bytes):
+        return o.decode("utf-8", "replace")
+    return str(o)
+
+
+def _dumps(o: Any) -> str:
+    return json.dumps(o, ensure_ascii=False, separators=(",", ":"), default=_default)
+
+
+def ndjson_stream(stream, header: Dict[str, Any]) -> Iterator[bytes]:
+    """Первая строка — заголовок с колонками, дальше по строке-массиву на запись."""
+    yield (_dumps({**header, "columns": stream.columns}) + "\n").encode("utf-8")
+    for batch in stream:
+        yield "".join(_dumps(row) + "\n" for row in batch).encode("utf-8")
+
+
+def columnar_stream(stream, header: Dict[str, Any]) -> Iterator[bytes]:
+    """Один JSON-документ {..., "columns": [...], "rows": [[...], ...]},
+    который отдаётся кусками по мере fetchmany."""
+    head = _dumps({**header, "columns": stream.columns})
+    yield (head[:-1] + ',"rows":[').encode("utf-8")
+    first = True
+    for batch in stream:
+        chunk = ",".join(_dumps(row) for row in batch)
+        yield (chunk if first else "," + chunk).encode("utf-8")
+        first = False
+    yield b"]}"
+
+
+def _as_strings(values) -> list:
+    return [None if v is None else _default(v) if isinstance(v, bytes) else str(v) for v in values]
+
+
+def _infer_array(values):
+    try:
+        arr = pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Смешанные типы в одной колонке (SQLite это позволяет)
+        return pa.array(_as_strings(values), type=pa.string())
+    if pa.types.is_null(arr.type):
+        return arr.cast(pa.string())
+    return arr
+
+
+def _fit_array(values, type_):
+    """Пачка в тип колонки из уже отданной схемы; None — не влезает."""
+    if pa.types.is_string(type_):
+        return pa.array(_as_strings(values), type=type_)
+    # pa.array(..., type=int64) молча отбрасывает дробную часть: 1.5 -> 1
+    if pa.types.is_integer(type_) and not all(v is None or isinstance(v, int) for v in values):
+        return None
+    try:
+        return pa.array(values, type=type_)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+        return None
+
+
+def _widen_array(values, type_):
+    # Целые -> float64 (если значения представимы точно), всё прочее -> строки
+    if pa.types.is_integer(type_):
+        arr = _fit_array(values, pa.float64())
+        if arr is not None:
+            return arr
+    return pa.array(_as_strings(values), type=pa.string())
+
+
+def arrow_stream(stream) -> Iterator[bytes]:
+    """Arrow IPC stream: схема выводится по первой пачке, колонки без типа
+    (одни NULL) отдаются строками. Если следующая пачка в схему не влезает
+    (SQLite: в колонке после целых пошли дробные или текст), колонка расширяется
+    — int64 до float64, иначе до строк — и до конца ответа идёт новый IPC-поток
+    с расширенной схемой: тело ответа — один или несколько потоков подряд."""
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed")
+    sink = io.BytesIO()
+    writer = None
+    schema = None
+    for batch in stream:
+        cols = list(zip(*batch))
+        if schema is None:
+            arrays = [_infer_array(c) for c in cols]
+        else:
+            arrays = [_fit_array(c, field.type) for c, field in zip(cols, schema)]
+            if any(a is None for a in arrays):
+                arrays = [a if a is not None else _widen_array(c, field.type)
+                          for a, c, field in zip(arrays, cols, schema)]
+                writer.close()  # конец потока со старой схемой
+                writer = None
+        if writer is None:
+            schema = pa.schema([pa.field(n, a.type) for n, a in zip(stream.columns, arrays)])
+            writer = pa.ipc.new_stream(sink, schema)
+        writer.write_batch(pa.record_batch(arrays, schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    if writer is None:
+        schema = pa.schema([pa.field(n, pa.string()) for n in stream.columns])
+        writer = pa.ipc.new_stream(sink, schema)
+    writer.close()
+    yield sink.getvalue()
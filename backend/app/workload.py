@@ -0,0 +1,123 @@
+"""Журнал нагрузки: каждый выполненный запрос (query_db в backend, execute_sql
+в боте) пишется строкой JSONL — источник, файл БД, текст и параметры, время,
+число строк и EXPLAIN QUERY PLAN. По журналу app.index_advisor ищет повторяющиеся
+полные сканы и сортировки во временном B-tree и предлагает индексы.
+
+WORKLOAD_LOG — путь к журналу (пусто — выключено), WORKLOAD_SAMPLE — доля
+записываемых запросов. План снимается после выполнения (в замер времени не
+попадает) и кэшируется по тексту SQL, так что повторные запросы стоят одну
+запись строки в файл."""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+WORKLOAD_LOG = os.getenv("WORKLOAD_LOG", "")
+WORKLOAD_SAMPLE = float(os.getenv("WORKLOAD_SAMPLE", 1.0))
+PLAN_CACHE_SIZE = 1024
+
+
+def explain(conn: sqlite3.Connection, sql: str, params: tuple = ()) -> List[str]:
+    """EXPLAIN QUERY PLAN -> строки detail с отступом по уровню вложенности."""
+    rows = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    depth = {0: -1}
+    out = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        out.append("  " * depth[node_id] + detail)
+    return out
+
+
+class WorkloadRecorder:
+    def __init__(self, path: str = WORKLOAD_LOG, sample: float = WORKLOAD_SAMPLE):
+        self.path = path
+        self.sample = sample
+        self._lock = threading.Lock()
+        self._file = None
+        self._plans: "OrderedDict[tuple, List[str]]" = OrderedDict()
+        self.recorded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path) and self.sample > 0
+
+    def _plan(self, conn: sqlite3.Connection, db: str, sql: str, params: tuple) -> Optional[List[str]]:
+        key = (db, sql)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+        try:
+            plan = explain(conn, sql, params)
+        except sqlite3.Error:
+            return None
+        with self._lock:
+            self._plans[key] = plan
+            if len(self._plans) > PLAN_CACHE_SIZE:
+                self._plans.popitem(last=False)
+        return plan
+
+    def record(self, source: str, db: str, sql: str, params: tuple, ms: float,
+               rows: Optional[int], plan: Optional[List[str]], error: Optional[str] = None):
+        line = json.dumps({
+            "ts": round(time.time(), 3), "source": source, "db": db, "sql": sql,
+            "params": list(params), "ms": round(ms, 3), "rows": rows, "plan": plan, "error": error,
+        }, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file is None:
+                # O_APPEND: строки от нескольких процессов (воркеры uvicorn, бот) не перемешиваются
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+            self._file.write(line + "\n")
+            self.recorded += 1
+
+    @contextmanager
+    def track(self, conn: Optional[sqlite3.Connection], source: str, db: str, sql: str, params: tuple = ()):
+        """with recorder.track(conn, "backend", path, sql, params) as rec:
+               ...; rec["rows"] = len(rows)
+        conn=None (Postgres) — без плана."""
+        rec: Dict[str, Any] = {"rows": None}
+        if not self.enabled or (self.sample < 1 and random.random() >= self.sample):
+            yield rec
+            return
+        started = time.perf_counter()
+        error = None
+        try:
+            yield rec
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            ms = (time.perf_counter() - started) * 1000
+            plan = self._plan(conn, db, sql, params) if conn is not None and error is None else None
+            try:
+                self.record(source, db, sql, params, ms, rec["rows"], plan, error)
+            except OSError:
+                pass  # журнал не должен ломать запрос
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+recorder = WorkloadRecorder()
+
+
+def load(path: str) -> List[Dict[str, Any]]:
+    out = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    continue  # недописанная последняя строка
+    return out
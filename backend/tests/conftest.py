@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Тесты импортируют модули backend как app.*, как и uvicorn app.main:app
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
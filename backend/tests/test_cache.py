@@ -0,0 +1,28 @@
+import pytest
+
+from app.cache import TranslationCache, normalize_question
+
+
+@pytest.mark.parametrize("a, b", [
+    ("Заказы с суммой > 100", "Заказы с суммой < 100"),
+    ("Заказы с суммой >= 100", "Заказы с суммой > 100"),
+    ("Рост больше 1.5%", "Рост больше 15"),
+    ("Товары со скидкой -5", "Товары со скидкой 5"),
+    ("Выручка за 2023-2024", "Выручка за 2023 2024"),
+])
+def test_different_questions_different_keys(a, b):
+    assert TranslationCache.key(a, "fp") != TranslationCache.key(b, "fp")
+
+
+@pytest.mark.parametrize("a, b", [
+    ("Выручка по городам?", "выручка по  городам"),
+    ("  Топ-5 товаров!", "топ-5 товаров"),
+    ("Города: Москва, Алматы.", "города москва алматы"),
+    ("Средний чек 1.5 тыс.?", "средний чек 1.5 тыс"),
+])
+def test_same_question_same_key(a, b):
+    assert TranslationCache.key(a, "fp") == TranslationCache.key(b, "fp")
+
+
+def test_normalize_keeps_meaningful_symbols():
+    assert normalize_question("Заказы с суммой > 1.5% и < -5?") == "заказы с суммой > 1.5% и < -5"
@@ -0,0 +1,189 @@
+import math
+import random
+import sqlite3
+
+import pytest
+
+from app import rollups
+
+SCHEMA = """
+CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT, city TEXT);
+CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, category TEXT, unit_cost NUMERIC, unit_price NUMERIC);
+CREATE TABLE orders (id INTEGER PRIMARY KEY, created_at TIMESTAMP, customer_id INTEGER REFERENCES customers(id),
+                     total_amount NUMERIC, cost_of_goods NUMERIC, status TEXT);
+CREATE TABLE order_items (id INTEGER PRIMARY KEY, order_id INTEGER REFERENCES orders(id),
+                          product_id INTEGER REFERENCES products(id), quantity INTEGER, unit_price NUMERIC, unit_cost NUMERIC);
+"""
+
+CITIES = ["Almaty", "Astana", "Shymkent"]
+CATEGORIES = ["Books", "Toys", "Garden"]
+STATUSES = ["completed", "pending", "cancelled"]
+
+# Запросы, которые переписываются на сводки: ответ должен совпасть с исходным
+QUERIES = [
+    "SELECT c.city, SUM(o.total_amount) AS revenue FROM orders o JOIN customers c ON c.id = o.customer_id GROUP BY c.city",
+    "SELECT status, COUNT(*) AS n FROM orders GROUP BY status",
+    "SELECT COUNT(*) FROM orders",
+    "SELECT strftime('%Y-%m', o.created_at) AS month, SUM(o.total_amount - o.cost_of_goods) AS margin "
+    "FROM orders o GROUP BY month ORDER BY month",
+    "SELECT c.city, AVG(o.total_amount) AS avg_check FROM orders o JOIN customers c ON c.id = o.customer_id "
+    "WHERE o.created_at >= '2024-02-01' AND o.created_at < '2024-03-01' GROUP BY c.city",
+    "SELECT p.category, SUM(oi.quantity * oi.unit_price) AS revenue FROM order_items oi "
+    "JOIN products p ON p.id = oi.product_id GROUP BY p.category ORDER BY revenue DESC",
+    "SELECT p.category, c.city, SUM(oi.quantity) AS qty FROM order_items oi JOIN products p ON p.id = oi.product_id "
+    "JOIN orders o ON o.id = oi.order_id JOIN customers c ON c.id = o.customer_id GROUP BY p.category, c.city",
+    "SELECT date(o.created_at) AS day, COUNT(*) AS n FROM orders o WHERE o.status = 'pending' GROUP BY day",
+]
+
+# Ответ из сводки не гарантированно тот же — переписывать нельзя
+NOT_REWRITTEN = [
+    "SELECT status, COUNT(DISTINCT customer_id) FROM orders GROUP BY status",
+    "SELECT c.name, SUM(o.total_amount) FROM orders o JOIN customers c ON c.id = o.customer_id GROUP BY c.name",
+    "SELECT c.city, SUM(o.total_amount) FROM orders o LEFT JOIN customers c ON c.id = o.customer_id GROUP BY c.city",
+    "SELECT status, SUM(total_amount) FROM orders WHERE total_amount > 100 GROUP BY status",
+    "SELECT * FROM orders",
+]
+
+
+def _insert_orders(conn, rng, n, first_id):
+    prices = {r[0]: r[1:] for r in conn.execute("SELECT id, unit_price, unit_cost FROM products")}
+    for oid in range(first_id, first_id + n):
+        items = [(rng.randint(1, 6), rng.randint(1, 4)) for _ in range(rng.randint(1, 3))]
+        total = sum(q * prices[pid][0] for pid, q in items)
+        cost = sum(q * prices[pid][1] for pid, q in items)
+        conn.execute("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?)",
+                     (oid, f"2024-{rng.randint(1, 3):02d}-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:00:00",
+                      rng.randint(1, 12), total, cost, rng.choice(STATUSES)))
+        conn.executemany("INSERT INTO order_items (order_id, product_id, quantity, unit_price, unit_cost) VALUES (?, ?, ?, ?, ?)",
+                         [(oid, pid, q) + prices[pid] for pid, q in items])
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "bi.db")
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.executescript(SCHEMA)
+    rng = random.Random(7)
+    for i in range(1, 13):
+        conn.execute("INSERT INTO customers VALUES (?, ?, ?)", (i, f"c{i}", CITIES[i % 3]))
+    for i in range(1, 7):
+        conn.execute("INSERT INTO products VALUES (?, ?, ?, ?, ?)", (i, f"p{i}", CATEGORIES[i % 3], i * 2, i * 3.5))
+    _insert_orders(conn, rng, 300, 1)
+    results = rollups.refresh_db(path)
+    assert all(r["complete"] for r in results)
+    yield path, conn, rng
+    conn.close()
+
+
+def _same(a, b):
+    a, b = sorted(a, key=repr), sorted(b, key=repr)
+    return len(a) == len(b) and all(
+        len(x) == len(y) and all(u == v or isinstance(u, float) and math.isclose(u, v, rel_tol=1e-9) for u, v in zip(x, y))
+        for x, y in zip(a, b)
+    )
+
+
+def _assert_equivalent(conn):
+    rewriter = rollups.Rewriter()
+    for sql in QUERIES:
+        rw = rewriter.rewrite(conn, sql)
+        assert rw is not None, sql
+        assert _same(conn.execute(sql).fetchall(), conn.execute(rw.sql).fetchall()), (sql, rw.sql)
+
+
+def _targets(conn):
+    rewriter = rollups.Rewriter()
+    return {sql: {r.name: r for r in rollups.ROLLUPS}[rewriter.rewrite(conn, sql).rollup] for sql in QUERIES}
+
+
+def _assert_stale(conn, targets, tables):
+    # Сводки на изменённых таблицах не используются, остальные — как прежде
+    rewriter = rollups.Rewriter()
+    for sql, rollup in targets.items():
+        stale = bool(tables & (set(rollup.watch) | {t for t, _ in rollup.lookups}))
+        assert (rewriter.rewrite(conn, sql) is None) == stale, sql
+
+
+def test_rewrite_equivalent(db):
+    _assert_equivalent(db[1])
+
+
+@pytest.mark.parametrize("sql", NOT_REWRITTEN)
+def test_not_rewritten(db, sql):
+    assert rollups.Rewriter().rewrite(db[1], sql) is None
+
+
+def test_idle_refresh_writes_nothing(db):
+    path, conn, _ = db
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    assert not any(r["changed"] for r in rollups.refresh_db(path))
+    assert conn.execute("PRAGMA data_version").fetchone()[0] == version
+
+
+def test_insert_is_incremental(db):
+    path, conn, rng = db
+    targets = _targets(conn)
+    _insert_orders(conn, rng, 40, 301)
+    _assert_stale(conn, targets, {"orders", "order_items"})
+    results = rollups.refresh_db(path)
+    assert all(r["changed"] and r["hwm_before"] == 300 and r["complete"] for r in results)
+    _assert_equivalent(conn)
+
+
+@pytest.mark.parametrize("changes", [
+    ["UPDATE orders SET status = 'shipped' WHERE status = 'pending'"],
+    ["UPDATE orders SET total_amount = total_amount + 1 WHERE id % 7 = 0"],
+    ["UPDATE order_items SET quantity = quantity + 1 WHERE id % 5 = 0"],
+    ["DELETE FROM order_items WHERE order_id < 50", "DELETE FROM orders WHERE id < 50"],
+    ["DELETE FROM order_items WHERE id % 9 = 0"],
+    ["UPDATE customers SET city = 'Astana' WHERE city = 'Almaty'"],
+    ["UPDATE products SET category = 'Books' WHERE id = 2"],
+])
+def test_update_and_delete_rebuild(db, changes):
+    path, conn, _ = db
+    targets = _targets(conn)
+    for sql in changes:
+        conn.execute(sql)
+    # До обновления сводки на изменённых таблицах устарели — переписывание выключено
+    _assert_stale(conn, targets, {sql.split()[1 if sql.startswith("UPDATE") else 2] for sql in changes})
+    results = rollups.refresh_db(path)
+    assert any(r["changed"] and r["hwm_before"] == 0 for r in results)
+    assert all(r["complete"] for r in results)
+    _assert_equivalent(conn)
+
+
+def test_delete_order_keeps_count_exact(db):
+    path, conn, _ = db
+    sql = "SELECT COUNT(*) FROM orders"
+    conn.execute("DELETE FROM orders WHERE id < 100")
+    assert rollups.Rewriter().rewrite(conn, sql) is None
+    rollups.refresh_db(path)
+    rw = rollups.Rewriter().rewrite(conn, sql)
+    assert conn.execute(rw.sql).fetchone()[0] == conn.execute(sql).fetchone()[0] == 201
+
+
+def test_orphans_disable_rewrite(db):
+    path, conn, _ = db
+    # Заказы удалённого клиента выпадают из внутреннего джойна сводки — она неполная
+    conn.execute("DELETE FROM customers WHERE id = 3")
+    results = rollups.refresh_db(path)
+    assert not any(r["complete"] for r in results)
+    assert all(rollups.Rewriter().rewrite(conn, sql) is None for sql in QUERIES)
+
+
+def test_irrelevant_lookup_change_keeps_rollup(db):
+    path, conn, _ = db
+    conn.execute("UPDATE customers SET name = 'renamed' WHERE id = 1")
+    conn.execute("INSERT INTO customers VALUES (100, 'new', 'Almaty')")
+    assert not any(r["changed"] for r in rollups.refresh_db(path))
+    _assert_equivalent(conn)
+
+
+def test_late_item_makes_rollup_incomplete(db):
+    path, conn, _ = db
+    conn.execute("INSERT INTO order_items (order_id, product_id, quantity, unit_price, unit_cost) VALUES (5, 1, 1, 3.5, 2)")
+    results = {r["name"]: r for r in rollups.refresh_db(path)}
+    assert not results["rollup_daily_sales"]["complete"]
+    assert rollups.Rewriter().rewrite(conn, QUERIES[5]) is None
+    assert rollups.refresh_db(path, rebuild=True)[0]["complete"]
+    _assert_equivalent(conn)
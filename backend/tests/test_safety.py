@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+from app.safety import validate_sql, is_safe_sql
+
+ALLOWED = [
+    "SELECT * FROM students",
+    "select name, age from students where age > 20",
+    "SELECT s.name FROM students s JOIN orders o ON s.id = o.customer_id",
+    "SELECT * FROM students AS s, orders AS o WHERE s.id = o.customer_id",
+    "SELECT * FROM main.students",
+    "SELECT * FROM (students)",
+    "SELECT * FROM (SELECT id FROM students) t",
+    "SELECT * FROM students WHERE id IN (SELECT customer_id FROM orders)",
+    "WITH top AS (SELECT * FROM students) SELECT * FROM top",
+    "SELECT created_at, updated FROM orders",  # не CREATE / UPDATE
+    "SELECT * FROM students;",
+    "SELECT a.name, o.id FROM students a JOIN orders o ON a.id = o.customer_id, products p WHERE p.id = 1",
+    "SELECT name, age FROM students WHERE age IN (20, 21) ORDER BY name, age",
+    "SELECT major, count(*) FROM students GROUP BY major, age HAVING count(*) > 1",
+    "SELECT name FROM students UNION SELECT name, 1 FROM customers",
+]
+
+DENIED = [
+    ("SELECT * FROM sqlite_master", "unknown table"),
+    ("SELECT name, sql FROM (sqlite_master)", "unknown table"),
+    ("SELECT * FROM students AS s, (sqlite_master)", "unknown table"),
+    ("SELECT * FROM (((sqlite_master)))", "unknown table"),
+    ("SELECT * FROM (students s JOIN (sqlite_master) m ON 1)", "unknown table"),
+    ("SELECT * FROM (SELECT * FROM sqlite_master) t", "unknown table"),
+    ("SELECT * FROM students WHERE id IN (SELECT rootpage FROM sqlite_master)", "unknown table"),
+    ("SELECT * FROM students s JOIN sqlite_master m ON 1", "unknown table"),
+    ("SELECT a.name, m.sql FROM students a JOIN students b ON a.id = b.id, sqlite_master m", "unknown table"),
+    ("SELECT m.sql FROM students a JOIN students b USING (id), sqlite_master m", "unknown table"),
+    ("SELECT * FROM students INDEXED BY x, sqlite_master", "unknown table"),
+    ("SELECT * FROM students a NATURAL JOIN students b, sqlite_master", "unknown table"),
+    ("SELECT * FROM students a LEFT JOIN orders o ON (a.id = o.customer_id), sqlite_master", "unknown table"),
+    ("WITH x AS (SELECT * FROM sqlite_master) SELECT * FROM x", "unknown table"),
+    ("SELECT * FROM students; DROP TABLE students", "multiple statements"),
+    ("SELECT 1; SELECT 2", "multiple statements"),
+    ("DELETE FROM students", "only SELECT"),
+    ("PRAGMA table_info(students)", "only SELECT"),
+    ("ATTACH DATABASE 'x.db' AS x", "only SELECT"),
+    ("SELECT * INTO backup FROM students", "forbidden keyword INTO"),
+    ("SELECT load_extension('evil') FROM students", "forbidden function"),
+    ("", "empty query"),
+    ("-- только комментарий", "empty query"),
+]
+
+
+@pytest.mark.parametrize("sql", ALLOWED)
+def test_allowed(sql):
+    verdict = validate_sql(sql)
+    assert verdict.ok, verdict.reason
+
+
+@pytest.mark.parametrize("sql, reason", DENIED)
+def test_denied(sql, reason):
+    verdict = validate_sql(sql)
+    assert not verdict.ok
+    assert reason in verdict.reason
+
+
+def test_tables_exclude_ctes():
+    assert validate_sql("WITH top AS (SELECT * FROM students) SELECT * FROM top").tables == {"students"}
+
+
+def test_custom_whitelist():
+    assert is_safe_sql("SELECT * FROM singer", {"singer"}) == (True, None)
+    assert not is_safe_sql("SELECT * FROM students", {"Singer"})[0]
+    assert validate_sql("SELECT * FROM sqlite_master", None).ok
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT name--c\nFROM students",
+    "SELECT name/*x*/FROM students",
+    "SELECT /* все */ name FROM students -- хвост",
+])
+def test_comments_become_whitespace(sql):
+    verdict = validate_sql(sql)
+    assert verdict.ok
+    assert verdict.sql == "SELECT name FROM students"
+    # Канонический текст исполняется как есть (и служит ключом кэша результатов)
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE students (id INTEGER PRIMARY KEY, name TEXT)")
+    conn.execute(verdict.sql)
+
+
+def test_canonical_keywords_and_semicolon():
+    assert validate_sql("select  name\n from students ;").sql == "SELECT name FROM students"
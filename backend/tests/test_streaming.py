@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+from app import streaming
+
+
+class FakeStream:
+    def __init__(self, columns, batches):
+        self.columns = columns
+        self._batches = batches
+
+    def __iter__(self):
+        return iter(self._batches)
+
+
+def _read_arrow(body: bytes):
+    """Все IPC-потоки тела подряд -> [(схема, строки)]."""
+    pa = pytest.importorskip("pyarrow")
+    source = pa.BufferReader(body)
+    out = []
+    while source.tell() < len(body):
+        reader = pa.ipc.open_stream(source)
+        rows = [row for b in reader for row in zip(*(c.to_pylist() for c in b.columns))]
+        out.append((reader.schema, rows))
+    return out
+
+
+def test_arrow_single_schema():
+    pytest.importorskip("pyarrow")
+    stream = FakeStream(["id", "name"], [[(1, "a"), (2, None)], [(3, "c")]])
+    parts = _read_arrow(b"".join(streaming.arrow_stream(stream)))
+    assert len(parts) == 1
+    assert [str(t) for t in parts[0][0].types] == ["int64", "string"]
+    assert parts[0][1] == [(1, "a"), (2, None), (3, "c")]
+
+
+@pytest.mark.parametrize("later, widened, expected", [
+    ([(2.5, None)], "double", [2.5, 3.0]),
+    ([("x", None)], "string", ["x", "3"]),
+    ([(2 ** 60 + 1, None)], "int64", [2 ** 60 + 1, 3]),  # влезает — схема прежняя
+])
+def test_arrow_widens_later_batches(later, widened, expected):
+    pytest.importorskip("pyarrow")
+    # Вторая колонка: сначала одни NULL (строки), потом числа — в строки
+    stream = FakeStream(["v", "w"], [[(1, None), (2, None)], later, [(3, 7)]])
+    parts = _read_arrow(b"".join(streaming.arrow_stream(stream)))
+    types = [str(schema.field("v").type) for schema, _ in parts]
+    assert types[0] == "int64" and types[-1] == widened
+    values = [row[0] for _, rows in parts for row in rows]
+    assert values == [1, 2] + expected
+    assert [row[1] for _, rows in parts for row in rows] == [None, None, None, "7"]
+
+
+def test_arrow_widens_once_for_rest_of_stream():
+    pytest.importorskip("pyarrow")
+    # Дробное в int64 не урезается до целого, а расширяет колонку
+    stream = FakeStream(["v"], [[(1,)], [(1.5,)], [(2,)], [("x",)], [(3,)]])
+    parts = _read_arrow(b"".join(streaming.arrow_stream(stream)))
+    assert [str(s.field("v").type) for s, _ in parts] == ["int64", "double", "string"]
+    assert [row[0] for _, rows in parts for row in rows] == [1, 1.5, 2.0, "x", "3"]
+
+
+def test_arrow_empty_result():
+    pytest.importorskip("pyarrow")
+    parts = _read_arrow(b"".join(streaming.arrow_stream(FakeStream(["a"], []))))
+    assert len(parts) == 1 and parts[0][1] == []
+
+
+def test_columnar_and_ndjson_mixed_types():
+    stream = [[(1, b"x")], [(1.5, "y")]]
+    body = b"".join(streaming.columnar_stream(FakeStream(["a", "b"], stream), {"sql": "q"}))
+    assert json.loads(body) == {"sql": "q", "columns": ["a", "b"], "rows": [[1, "x"], [1.5, "y"]]}
+    lines = b"".join(streaming.ndjson_stream(FakeStream(["a", "b"], stream), {})).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [{"columns": ["a", "b"]}, [1, "x"], [1.5, "y"]]
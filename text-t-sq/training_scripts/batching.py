@@ -0,0 +1,223 @@
+# batching.py
+# Батчи по бюджету токенов вместо фиксированного batch_size.
+#   TokenBudgetBatchSampler — примеры близкой длины в одном батче, размер батча
+#       подбирается так, чтобы batch * (max_input + max_label) <= TRAIN_MAX_TOKENS
+#   PackedDataset / PackedCollator — режим упаковки (TRAIN_PACKING=1): несколько
+#       коротких примеров в одной строке; маски блочные (encoder, decoder и
+#       cross-attention видят только свой пример), лосс совпадает с обычным
+#   BucketedSeq2SeqTrainer — подключает всё это к Seq2SeqTrainer и пишет в лог
+#       tokens/sec и долю паддинга
+import os, time
+from typing import Dict, List, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+from transformers import Seq2SeqTrainer
+
+TRAIN_MAX_TOKENS = int(os.environ.get("TRAIN_MAX_TOKENS", 6144))
+TRAIN_PACKING    = os.environ.get("TRAIN_PACKING", "0") == "1"
+BUCKET_BATCHES   = 50  # сортируем по длине внутри окна ~50 батчей, чтобы сохранить случайность
+
+
+class TokenBudgetBatchSampler:
+    def __init__(self, input_lengths: Sequence[int], label_lengths: Sequence[int],
+                 max_tokens: int = TRAIN_MAX_TOKENS, shuffle: bool = True, seed: int = 42,
+                 bucket_batches: int = BUCKET_BATCHES):
+        self.input_lengths = np.asarray(input_lengths, dtype=np.int64)
+        self.label_lengths = np.asarray(label_lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        mean_cost = float((self.input_lengths + self.label_lengths).mean()) if len(self.input_lengths) else 1.0
+        self.window = max(1, int(bucket_batches * max(1.0, max_tokens / mean_cost)))
+        self._cache = (None, None)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _build(self, epoch: int) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed + epoch)
+        n = len(self.input_lengths)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+        batches = []
+        for start in range(0, n, self.window):
+            window = order[start:start + self.window]
+            window = window[np.lexsort((self.label_lengths[window], self.input_lengths[window]))]
+            cur, max_in, max_lab = [], 0, 0
+            for i in window.tolist():
+                m_in = max(max_in, int(self.input_lengths[i]))
+                m_lab = max(max_lab, int(self.label_lengths[i]))
+                if cur and (len(cur) + 1) * (m_in + m_lab) > self.max_tokens:
+                    batches.append(cur)
+                    cur, m_in, m_lab = [], int(self.input_lengths[i]), int(self.label_lengths[i])
+                cur.append(i)
+                max_in, max_lab = m_in, m_lab
+            if cur:
+                batches.append(cur)
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def _batches(self) -> List[List[int]]:
+        epoch, batches = self._cache
+        if epoch != self.epoch:
+            batches = self._build(self.epoch)
+            self._cache = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self.epoch += 1  # следующий проход — новая перестановка, даже если set_epoch не зовут
+        return iter(batches)
+
+    def __len__(self) -> int:
+        return len(self._batches())
+
+    def padding_stats(self) -> Dict[str, float]:
+        """Оценка без прогона модели: сколько токенов реальных и сколько уйдёт на паддинг."""
+        real = padded = 0
+        for b in self._batches():
+            real += int(self.input_lengths[b].sum() + self.label_lengths[b].sum())
+            padded += len(b) * int(self.input_lengths[b].max() + self.label_lengths[b].max())
+        return {"batches": len(self), "real_tokens": real, "padded_tokens": padded,
+                "padding_ratio": round(1 - real / padded, 4) if padded else 0.0}
+
+
+class PackedDataset(Dataset):
+    """Упаковка: в строку кладём несколько примеров, пока входы влезают в max_input,
+    а SQL — в max_target. Жадно: самый длинный из оставшихся + самые короткие."""
+
+    def __init__(self, base, max_input: int, max_target: int, decoder_start_token_id: int = 0):
+        self.base = base
+        self.decoder_start = decoder_start_token_id
+        in_len = np.asarray(base.input_lengths, dtype=np.int64)
+        lab_len = np.asarray(base.label_lengths, dtype=np.int64)
+        order = np.argsort(in_len, kind="stable").tolist()
+        lo, hi = 0, len(order) - 1
+        self.packs: List[List[int]] = []
+        while lo <= hi:
+            pack = [order[hi]]
+            used_in, used_lab = int(in_len[order[hi]]), int(lab_len[order[hi]])
+            hi -= 1
+            while lo <= hi and used_in + in_len[order[lo]] <= max_input and used_lab + lab_len[order[lo]] <= max_target:
+                pack.append(order[lo])
+                used_in += int(in_len[order[lo]])
+                used_lab += int(lab_len[order[lo]])
+                lo += 1
+            self.packs.append(pack)
+        self.input_lengths = np.array([in_len[p].sum() for p in self.packs], dtype=np.int64)
+        self.label_lengths = np.array([lab_len[p].sum() for p in self.packs], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.packs)
+
+    def __getitem__(self, idx: int) -> Dict[str, List[int]]:
+        out = {"input_ids": [], "input_segments": [], "labels": [], "decoder_input_ids": [], "decoder_segments": []}
+        for seg, i in enumerate(self.packs[idx], 1):
+            ex = self.base[i]
+            lab = ex["labels"]
+            out["input_ids"] += ex["input_ids"]
+            out["input_segments"] += [seg] * len(ex["input_ids"])
+            out["labels"] += lab
+            # сдвиг вправо — внутри каждого примера, а не по склеенной строке
+            out["decoder_input_ids"] += [self.decoder_start] + lab[:-1]
+            out["decoder_segments"] += [seg] * len(lab)
+        return out
+
+
+class PackedCollator:
+    def __init__(self, pad_token_id: int = 0):
+        self.pad = {"input_ids": pad_token_id, "input_segments": 0, "labels": -100,
+                    "decoder_input_ids": pad_token_id, "decoder_segments": 0}
+
+    def __call__(self, features: List[Dict[str, List[int]]]) -> Dict[str, torch.Tensor]:
+        batch = {}
+        for key, pad in self.pad.items():
+            width = max(len(f[key]) for f in features)
+            batch[key] = torch.tensor([f[key] + [pad] * (width - len(f[key])) for f in features], dtype=torch.long)
+        return batch
+
+
+def _additive(mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    # bool [B, Q, K] -> готовая 4D-маска [B, 1, Q, K]: 0 — можно, min — нельзя
+    return torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill(~mask, torch.finfo(dtype).min)[:, None]
+
+
+def packed_forward(model, inputs: Dict[str, torch.Tensor]):
+    """Прямой проход по упакованному батчу с блочными масками."""
+    base = getattr(model, "module", model)
+    if hasattr(base, "get_base_model"):  # PEFT: LoRA-слои уже внутри базовой модели
+        base = base.get_base_model()
+    seg_in, seg_dec = inputs["input_segments"], inputs["decoder_segments"]
+    dtype = torch.get_autocast_dtype(seg_in.device.type) \
+        if torch.is_autocast_enabled(seg_in.device.type) else base.dtype
+    enc_mask = (seg_in[:, :, None] == seg_in[:, None, :]) & (seg_in[:, None, :] > 0)
+    t = seg_dec.shape[1]
+    causal = torch.ones(t, t, dtype=torch.bool, device=seg_dec.device).tril()
+    self_mask = (seg_dec[:, :, None] == seg_dec[:, None, :]) & causal
+    cross_mask = (seg_dec[:, :, None] == seg_in[:, None, :]) & (seg_in[:, None, :] > 0)
+    # пустые строки маски (паддинг декодера) — пусть смотрят хотя бы на себя/первый токен
+    self_mask |= torch.eye(t, dtype=torch.bool, device=seg_dec.device)
+    cross_mask[..., 0] |= seg_dec == 0
+    encoder_outputs = base.get_encoder()(input_ids=inputs["input_ids"], attention_mask=_additive(enc_mask, dtype))
+    return base(encoder_outputs=encoder_outputs, attention_mask=_additive(cross_mask, dtype),
+                decoder_input_ids=inputs["decoder_input_ids"],
+                decoder_attention_mask=_additive(self_mask, dtype), labels=inputs["labels"])
+
+
+class BucketedSeq2SeqTrainer(Seq2SeqTrainer):
+    """Seq2SeqTrainer с батч-сэмплером по токенам (и упаковкой) для train;
+    eval/predict идут как раньше, через data_collator и per_device_eval_batch_size."""
+
+    def __init__(self, *args, train_batch_sampler=None, train_collator=None, pad_token_id: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_batch_sampler = train_batch_sampler
+        self.train_collator = train_collator
+        self.pad_token_id = pad_token_id
+        self._tok = {"real": 0, "padded": 0, "since": time.perf_counter()}
+        self._tok_total = {"real": 0, "padded": 0, "seconds": 0.0}
+
+    def get_train_dataloader(self):
+        if self.train_batch_sampler is None:
+            return super().get_train_dataloader()
+        dl = DataLoader(self.train_dataset, batch_sampler=self.train_batch_sampler,
+                        collate_fn=self.train_collator or self.data_collator,
+                        num_workers=self.args.dataloader_num_workers,
+                        pin_memory=self.args.dataloader_pin_memory)
+        return self.accelerator.prepare(dl)
+
+    def _count_tokens(self, inputs):
+        if "input_segments" in inputs:
+            real = (inputs["input_segments"] > 0).sum() + (inputs["decoder_segments"] > 0).sum()
+        else:
+            real = (inputs["input_ids"] != self.pad_token_id).sum() + (inputs["labels"] != -100).sum()
+        self._tok["real"] += int(real)
+        self._tok["padded"] += inputs["input_ids"].numel() + inputs["labels"].numel()
+
+    def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
+        if model.training:
+            self._count_tokens(inputs)
+        if "input_segments" not in inputs:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs, **kwargs)
+        outputs = packed_forward(model, inputs)
+        return (outputs.loss, outputs) if return_outputs else outputs.loss
+
+    def log(self, logs: Dict[str, float], *args, **kwargs):
+        now = time.perf_counter()
+        if self._tok["padded"]:
+            elapsed = now - self._tok["since"]
+            logs["tokens_per_s"] = round(self._tok["real"] / elapsed, 1) if elapsed else 0.0
+            logs["padding_ratio"] = round(1 - self._tok["real"] / self._tok["padded"], 4)
+            self._tok_total["real"] += self._tok["real"]
+            self._tok_total["padded"] += self._tok["padded"]
+            self._tok_total["seconds"] += elapsed
+        self._tok = {"real": 0, "padded": 0, "since": now}
+        super().log(logs, *args, **kwargs)
+
+    def throughput(self) -> Dict[str, float]:
+        t = self._tok_total
+        return {"real_tokens": t["real"], "padded_tokens": t["padded"],
+                "tokens_per_s": round(t["real"] / t["seconds"], 1) if t["seconds"] else 0.0,
+                "padding_ratio": round(1 - t["real"] / t["padded"], 4) if t["padded"] else 0.0}
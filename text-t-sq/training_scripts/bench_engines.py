@@ -0,0 +1,108 @@
+# bench_engines.py
+# Паритет и скорость рантаймов T5 (sql_engine.py) на Spider dev:
+#   - exact match SQL каждого движка против PyTorch fp32 (паритет) и против gold
+#   - латентность generate (p50/p95/mean) и RSS процесса после загрузки/прогона
+# Каждый движок гоняется в отдельном процессе, чтобы память не смешивалась.
+#
+#   python bench_engines.py --engines torch torch-int8 onnx onnx-int8 --limit 200
+import argparse, json, multiprocessing as mp, os, statistics, time
+
+SPIDER_DIR = os.environ.get("SPIDER_DIR", "data/spider")
+MAX_NEW_TOKENS = 196
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def norm_sql(sql: str) -> str:
+    return " ".join(sql.strip().rstrip(";").lower().split())
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    if not xs:
+        return 0.0
+    k = min(len(xs) - 1, max(0, int(round(p / 100 * (len(xs) - 1)))))
+    return xs[k]
+
+
+def run_engine(engine, model_dir, examples, out_q):
+    import torch
+    from sql_engine import load_sql_model
+    from schema_link import SchemaLinker, load_tables
+
+    base_rss = rss_mb()
+    t0 = time.perf_counter()
+    tokenizer, model = load_sql_model(model_dir, engine)
+    load_s = time.perf_counter() - t0
+    loaded_rss = rss_mb()
+    linker = SchemaLinker(load_tables(SPIDER_DIR))
+
+    preds, lat = [], []
+    for ex in examples:
+        tok = tokenizer(linker.build_input(ex["question"], ex["db_id"]), return_tensors="pt",
+                        truncation=True, max_length=1024)
+        t = time.perf_counter()
+        with torch.inference_mode():
+            out = model.generate(**tok, max_new_tokens=MAX_NEW_TOKENS, num_beams=4, early_stopping=True)
+        lat.append((time.perf_counter() - t) * 1000)
+        preds.append(tokenizer.decode(out[0], skip_special_tokens=True).strip())
+    out_q.put({
+        "engine": engine, "preds": preds, "latency_ms": lat, "load_s": load_s,
+        "rss_loaded_mb": loaded_rss - base_rss, "rss_peak_mb": rss_mb(),
+    })
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", default="out_t5_spider/final")
+    ap.add_argument("--engines", nargs="+", default=["torch", "torch-int8", "onnx", "onnx-int8"])
+    ap.add_argument("--split", default="dev")
+    ap.add_argument("--limit", type=int, default=200)
+    ap.add_argument("--out", default="bench_engines.json")
+    args = ap.parse_args()
+
+    with open(os.path.join(SPIDER_DIR, f"{args.split}.json"), "r", encoding="utf-8") as f:
+        examples = json.load(f)[:args.limit]
+
+    ctx = mp.get_context("spawn")
+    results = {}
+    engines = args.engines if "torch" in args.engines else ["torch"] + args.engines  # эталон для паритета
+    for engine in engines:
+        q = ctx.Queue()
+        p = ctx.Process(target=run_engine, args=(engine, args.model, examples, q))
+        p.start()
+        res = q.get()
+        p.join()
+        results[engine] = res
+
+    ref = results["torch"]["preds"]
+    gold = [norm_sql(ex["query"]) for ex in examples]
+    report = {"model": args.model, "split": args.split, "n": len(examples), "engines": {}}
+    print(f"{'engine':<11} {'parity':>7} {'gold_em':>8} {'p50ms':>8} {'p95ms':>8} {'mean':>8} {'load_s':>7} {'rss_mb':>7}")
+    for engine, r in results.items():
+        parity = sum(norm_sql(a) == norm_sql(b) for a, b in zip(r["preds"], ref)) / len(ref)
+        em = sum(norm_sql(a) == g for a, g in zip(r["preds"], gold)) / len(gold)
+        row = {
+            "parity_vs_torch": parity, "exact_match_gold": em,
+            "p50_ms": percentile(r["latency_ms"], 50), "p95_ms": percentile(r["latency_ms"], 95),
+            "mean_ms": statistics.mean(r["latency_ms"]), "load_s": r["load_s"],
+            "rss_loaded_mb": r["rss_loaded_mb"], "rss_peak_mb": r["rss_peak_mb"],
+            "mismatches": [{"question": ex["question"], "torch": a, engine: b}
+                           for ex, a, b in zip(examples, ref, r["preds"]) if norm_sql(a) != norm_sql(b)][:20],
+        }
+        report["engines"][engine] = row
+        print(f"{engine:<11} {parity:>7.3f} {em:>8.3f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} "
+              f"{row['mean_ms']:>8.1f} {row['load_s']:>7.1f} {row['rss_loaded_mb']:>7.0f}")
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"report -> {args.out}")
@@ -0,0 +1,310 @@
+# constrained.py
+# Декодирование T5 с учётом схемы:
+#   - SchemaLogitsProcessor: маска словаря — разрешены только куски словаря,
+#     из которых складываются SQL-ключевые слова/операторы, числа, алиасы T1/T2,
+#     имена таблиц/колонок текущей БД и слова из вопроса (значения). Кусок берётся
+#     по содержимому: буквенная часть — подстрока разрешённого слова (в начале
+#     слова — его префикс), остальное — цифры/пробел/символы SQL. Так проходят и
+#     куски без "▁" ("(", "*", "dium" из "sta"+"dium", "2." из "T2.name").
+#     Покрытие проверяется на gold SQL: python constrained.py --model ... --spider ...
+#   - RepeatStop: остановка, когда SQL синтаксически закрыт (скобки/кавычки)
+#     и модель начала повторять хвост ("LIMIT 1 LIMIT 1 ...")
+#   - адаптивный режим: сначала greedy; если уверенность ниже порога или в SQL
+#     есть неизвестные идентификаторы — только эти строки перегенерируются beam search
+import argparse, json, os, re, sys
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+SQL_DECODE        = os.environ.get("SQL_DECODE", "adaptive")  # beam | greedy | adaptive
+# Выключено, пока проверка покрытия gold SQL (см. main ниже) не пройдёт на dev для поставляемого чекпойнта
+SQL_CONSTRAIN     = os.environ.get("SQL_CONSTRAIN", "0") == "1"
+GREEDY_CONFIDENCE = float(os.environ.get("SQL_GREEDY_CONFIDENCE", 0.85))
+NUM_BEAMS         = int(os.environ.get("SQL_NUM_BEAMS", 4))
+
+SQL_WORDS = (
+    "select from where group by order having limit join on as and or not in like between is null "
+    "distinct count sum avg min max asc desc union intersect except exists case when then else end "
+    "cast inner left outer cross natural all any true false"
+).split()
+SQL_SYMBOLS = list("(),.*=<>!'\"%-+/;") + ["!=", "<>", ">=", "<=", "||"] + [str(d) for d in range(10)]
+SQL_KEYWORDS = set(SQL_WORDS)
+ALIAS_WORDS = ["t"]  # T1, T2. — алиасы таблиц в gold SQL Spider
+
+_RUN = re.compile(r"[^\W\d]+")  # буквы и "_" — часть слова/идентификатора
+_FREE = set("(),.*=<>!'\"%-+/;|0123456789 ")  # всё, кроме букв, что может стоять в куске
+
+_IDENT = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_STRINGS = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+_ALIAS = re.compile(r"^t\d+$", re.I)
+
+
+def _variants(word: str) -> List[str]:
+    out = {word, word.lower(), word.upper(), word.capitalize()}
+    return [p + w for w in out for p in ("", " ")]
+
+
+class SchemaVocab:
+    """Разрешённые id токенов по db_id (кэш) + слова конкретного вопроса."""
+
+    def __init__(self, tokenizer, table_meta: list, vocab_size: int):
+        self.tokenizer = tokenizer
+        self.vocab_size = vocab_size
+        self.meta = {m["db_id"]: m for m in table_meta}
+        self._base: Dict[str, torch.Tensor] = {}
+        self._index_vocab()
+        self._always = self._ids(SQL_WORDS, extra_plain=SQL_SYMBOLS) | self._free | self._allowed(SQL_WORDS + ALIAS_WORDS)
+        for tid in (tokenizer.eos_token_id, tokenizer.pad_token_id, tokenizer.unk_token_id):
+            if tid is not None:
+                self._always.add(tid)
+
+    def _index_vocab(self):
+        """Один проход по словарю: куски без букв (цифры, символы) — в _free,
+        у остальных запоминаем буквенные части: run -> [(id, № части, начало слова)]."""
+        special = set(self.tokenizer.all_special_ids)
+        n = min(self.vocab_size, len(self.tokenizer))
+        self._free = set()
+        self._runs: Dict[str, List[Tuple[int, int, bool]]] = {}
+        self._n_runs: Dict[int, int] = {}
+        for i, piece in enumerate(self.tokenizer.convert_ids_to_tokens(list(range(n)))):
+            if piece is None or i in special:
+                continue
+            text = piece.replace("\u2581", " ")
+            if any(ch not in _FREE for ch in _RUN.sub("", text)):
+                continue
+            runs = list(_RUN.finditer(text))
+            if not runs:
+                if text:
+                    self._free.add(i)
+                continue
+            self._n_runs[i] = len(runs)
+            for k, m in enumerate(runs):
+                word_start = m.start() > 0 and text[m.start() - 1] in _FREE and not text[m.start() - 1].isdigit()
+                self._runs.setdefault(m.group().lower(), []).append((i, k, word_start))
+
+    def _allowed(self, words: Iterable[str]) -> set:
+        """Куски, все буквенные части которых — подстроки слов (в начале слова — префиксы).
+        Покрывает любое разбиение слова токенизатором, в т.ч. после "." и "("."""
+        hits: Dict[int, set] = {}
+        for w in {w.lower() for w in words if w}:
+            for a in range(len(w)):
+                for b in range(a + 1, len(w) + 1):
+                    for i, k, word_start in self._runs.get(w[a:b], ()):
+                        if not (word_start and a):
+                            hits.setdefault(i, set()).add(k)
+        return {i for i, ks in hits.items() if len(ks) == self._n_runs[i]}
+
+    def _ids(self, words, extra_plain=()) -> set:
+        texts = [v for w in words for v in _variants(w)] + list(extra_plain) + [" " + s for s in extra_plain]
+        ids = set()
+        for row in self.tokenizer(texts, add_special_tokens=False)["input_ids"]:
+            ids.update(row)
+        return ids
+
+    def identifiers(self, db_id: str) -> set:
+        m = self.meta[db_id]
+        names = set(m["table_names_original"])
+        names.update(c for t, c in m["column_names_original"] if t != -1)
+        return names
+
+    def base_mask(self, db_id: str) -> torch.Tensor:
+        mask = self._base.get(db_id)
+        if mask is None:
+            names = self.identifiers(db_id)
+            parts = {p for n in names for p in n.split("_") if p}
+            ids = self._always | self._ids(names | parts) | self._allowed(names | parts)
+            mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+            mask[[i for i in ids if i < self.vocab_size]] = True
+            self._base[db_id] = mask
+        return mask
+
+    def mask(self, question: str, db_id: str) -> torch.Tensor:
+        mask = self.base_mask(db_id).clone()
+        q_words = re.findall(r"\w+", question)
+        q_ids = self._ids(q_words, extra_plain=[question]) | self._allowed(q_words)
+        mask[[i for i in q_ids if i < self.vocab_size]] = True
+        return mask
+
+    def unknown_identifiers(self, sql: str, db_id: str) -> set:
+        """Идентификаторы в SQL, которых нет ни в схеме, ни среди ключевых слов."""
+        known = {n.lower() for n in self.identifiers(db_id)}
+        body = _STRINGS.sub(" ", sql)
+        aliases = {m.group(1).lower() for m in re.finditer(r"\bas\s+([A-Za-z_]\w*)", body, re.I)}
+        unknown = set()
+        for w in _IDENT.findall(body):
+            lw = w.lower()
+            if lw in SQL_KEYWORDS or lw in known or lw in aliases or _ALIAS.match(w):
+                continue
+            unknown.add(w)
+        return unknown
+
+
+class SchemaLogitsProcessor(LogitsProcessor):
+    """masks: [n_items, vocab] — на каждую строку пачки; строки beam search
+    (n_items * num_beams) получают маску своего примера."""
+
+    def __init__(self, masks: torch.Tensor):
+        self.masks = masks
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        rows, vocab = scores.shape
+        masks = self.masks
+        if rows != masks.shape[0]:
+            masks = masks.repeat_interleave(rows // masks.shape[0], dim=0)
+        if vocab != masks.shape[1]:
+            masks = torch.nn.functional.pad(masks, (0, vocab - masks.shape[1]), value=False)
+        return scores.masked_fill(~masks.to(scores.device), float("-inf"))
+
+
+class RepeatStop(StoppingCriteria):
+    """Останавливает строку, если скобки закрыты, кавычки чётные и последние
+    n токенов повторяют предыдущие n (модель зациклилась на хвосте)."""
+
+    def __init__(self, tokenizer, min_len: int = 8, max_ngram: int = 6):
+        self.tokenizer = tokenizer
+        self.min_len = min_len
+        self.max_ngram = max_ngram
+
+    def _looping(self, seq: List[int]) -> bool:
+        for n in range(2, self.max_ngram + 1):
+            if len(seq) >= 2 * n and seq[-n:] == seq[-2 * n:-n]:
+                return True
+        return False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if input_ids.shape[1] < self.min_len:
+            return done
+        for i, row in enumerate(input_ids.tolist()):
+            if not self._looping(row):
+                continue
+            text = self.tokenizer.decode(row, skip_special_tokens=True)
+            if text.count("(") == text.count(")") and text.count("'") % 2 == 0 and text.count('"') % 2 == 0:
+                done[i] = True
+        return done
+
+
+def trim_repeats(sql: str) -> str:
+    """Срезает повторяющийся хвост: 'LIMIT 1 LIMIT 1' -> 'LIMIT 1'."""
+    words = sql.split()
+    changed = True
+    while changed:
+        changed = False
+        for n in range(1, 7):
+            if len(words) >= 2 * n and words[-n:] == words[-2 * n:-n]:
+                words = words[:-n]
+                changed = True
+                break
+    return " ".join(words)
+
+
+class ConstrainedDecoder:
+    def __init__(self, tokenizer, model, table_meta: list, max_new_tokens: int = 196,
+                 mode: str = SQL_DECODE, constrain: bool = SQL_CONSTRAIN,
+                 confidence: float = GREEDY_CONFIDENCE, num_beams: int = NUM_BEAMS):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_new_tokens = max_new_tokens
+        self.mode = mode
+        self.constrain = constrain
+        self.confidence = confidence
+        self.num_beams = num_beams
+        vocab_size = getattr(getattr(model, "config", None), "vocab_size", None) or len(tokenizer)
+        self.vocab = SchemaVocab(tokenizer, table_meta, vocab_size)
+        self.stop = RepeatStop(tokenizer)
+        self.stats = {"greedy_accepted": 0, "beam_fallbacks": 0, "beam_only": 0, "unknown_identifiers": 0}
+
+    def _processors(self, items) -> Optional[LogitsProcessorList]:
+        if not self.constrain:
+            return None
+        masks = torch.stack([self.vocab.mask(q, db_id) for q, db_id in items])
+        return LogitsProcessorList([SchemaLogitsProcessor(masks)])
+
+    def _run(self, enc, items, num_beams: int, with_scores: bool = False):
+        kwargs = dict(max_new_tokens=self.max_new_tokens, num_beams=num_beams,
+                      stopping_criteria=StoppingCriteriaList([self.stop]))
+        if num_beams > 1:
+            kwargs["early_stopping"] = True
+        if with_scores:
+            kwargs.update(output_scores=True, return_dict_in_generate=True)
+        procs = self._processors(items)
+        if procs is not None:
+            kwargs["logits_processor"] = procs
+        with torch.inference_mode():
+            return self.model.generate(**enc, **kwargs)
+
+    def _decode(self, sequences) -> List[str]:
+        return [trim_repeats(s.strip()) for s in self.tokenizer.batch_decode(sequences, skip_special_tokens=True)]
+
+    def _confidence(self, out) -> List[float]:
+        # Средняя вероятность выбранных токенов (без паддинга после </s>)
+        seq = out.sequences[:, 1:]
+        logps = torch.stack([torch.log_softmax(s.float(), dim=-1) for s in out.scores], dim=1)
+        chosen = logps.gather(-1, seq[:, :logps.shape[1]].unsqueeze(-1)).squeeze(-1)
+        pad = self.tokenizer.pad_token_id
+        valid = (seq[:, :logps.shape[1]] != pad) & torch.isfinite(chosen)
+        mean = (chosen * valid).sum(1) / valid.sum(1).clamp(min=1)
+        return mean.exp().tolist()
+
+    def generate(self, enc: dict, items: List[Tuple[str, str]]) -> List[str]:
+        """enc — input_ids/attention_mask пачки; items — [(question, db_id)] той же длины."""
+        if self.mode == "beam":
+            self.stats["beam_only"] += len(items)
+            return self._decode(self._run(enc, items, self.num_beams))
+        out = self._run(enc, items, 1, with_scores=True)
+        sqls = self._decode(out.sequences)
+        if self.mode == "greedy":
+            return sqls
+
+        conf = self._confidence(out)
+        retry = []
+        for i, ((_, db_id), sql) in enumerate(zip(items, sqls)):
+            unknown = self.vocab.unknown_identifiers(sql, db_id)
+            if unknown:
+                self.stats["unknown_identifiers"] += 1
+            if not sql or conf[i] < self.confidence or unknown:
+                retry.append(i)
+        self.stats["greedy_accepted"] += len(items) - len(retry)
+        if retry:
+            self.stats["beam_fallbacks"] += len(retry)
+            sub = {k: v[retry] for k, v in enc.items()}
+            beam_sqls = self._decode(self._run(sub, [items[i] for i in retry], self.num_beams))
+            for i, sql in zip(retry, beam_sqls):
+                sqls[i] = sql
+        return sqls
+
+
+def gold_coverage(vocab: SchemaVocab, examples: List[dict]) -> List[dict]:
+    """Примеры, чей gold SQL маска не пропускает: [{db_id, question, query, blocked}].
+    Пустой список — ограничение не мешает модели выдать ни один из эталонных ответов."""
+    tok = vocab.tokenizer
+    fails = []
+    for ex in examples:
+        mask = vocab.mask(ex["question"], ex["db_id"])
+        ids = tok(text_target=ex["query"])["input_ids"]
+        blocked = [tok.convert_ids_to_tokens(i) for i in ids if i >= vocab.vocab_size or not mask[i]]
+        if blocked:
+            fails.append({"db_id": ex["db_id"], "question": ex["question"], "query": ex["query"], "blocked": blocked})
+    return fails
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Check that every gold SQL query stays inside the schema mask")
+    ap.add_argument("--model", default="out_t5_spider/final", help="каталог с токенизатором")
+    ap.add_argument("--spider", default=os.environ.get("SPIDER_DIR", "data/spider"))
+    ap.add_argument("--split", default="dev")
+    ap.add_argument("--show", type=int, default=20, help="сколько провалов напечатать")
+    args = ap.parse_args()
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    with open(os.path.join(args.spider, "tables.json"), "r", encoding="utf-8") as f:
+        table_meta = json.load(f)
+    with open(os.path.join(args.spider, f"{args.split}.json"), "r", encoding="utf-8") as f:
+        examples = json.load(f)
+    fails = gold_coverage(SchemaVocab(tokenizer, table_meta, len(tokenizer)), examples)
+    print(f"{len(examples) - len(fails)}/{len(examples)} gold queries inside the mask")
+    for fail in fails[:args.show]:
+        print(json.dumps(fail, ensure_ascii=False))
+    sys.exit(1 if fails else 0)
@@ -0,0 +1,239 @@
+# eval_spider.py
+# Execution accuracy и скорость всего стека text-to-SQL на Spider dev:
+#   - SQL генерируется пачками тем же путём, что в боте: SchemaLinker +
+#     PrefixTokenCache + ConstrainedDecoder (SQL_ENGINE, SQL_DECODE, SCHEMA_PRUNE)
+#   - предсказанный и gold SQL исполняются в пуле процессов (spider_db, immutable),
+#     у каждого запроса свой таймаут (progress handler SQLite -> interrupt)
+#   - результаты сравниваются как мультимножества строк (как список — если в gold
+#     есть ORDER BY), с учётом перестановки колонок
+#   - латентность по стадиям: tokenize / generate (на пачку и на пример) / execute
+# Пока идёт генерация следующей пачки, пул уже исполняет предыдущую.
+#
+#   python eval_spider.py --model out_t5_spider/final --limit 500 --out eval_spider.json
+import argparse, itertools, json, math, os, sqlite3, sys, time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from typing import Dict, List, Optional, Tuple
+
+from spider_db import SpiderDbCache
+
+SPIDER_DIR     = os.environ.get("SPIDER_DIR", "data/spider")
+EVAL_WORKERS   = int(os.environ.get("EVAL_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+EVAL_TIMEOUT_S = float(os.environ.get("EVAL_TIMEOUT_S", 10))
+EVAL_MAX_ROWS  = 100_000  # больше — считаем ответ неверным, чтобы не тащить гигабайты через пул
+MAX_NEW_TOKENS = 196
+MAX_PERMUTE_COLS = 6      # перестановки колонок перебираем только для узких результатов
+
+_dbs: Optional[SpiderDbCache] = None
+
+
+# ==================== пул исполнения ====================
+def _init_worker(spider_dir: str):
+    global _dbs
+    _dbs = SpiderDbCache(spider_dir)
+
+
+def _run_sql(db_id: str, sql: str, timeout: float) -> Tuple[Optional[list], Optional[str], float]:
+    """-> (rows, error, ms). error: None | 'timeout' | 'too_many_rows' | текст ошибки SQLite."""
+    started = time.perf_counter()
+    deadline = started + timeout
+    try:
+        with _dbs.connection(db_id) as conn:
+            conn.set_progress_handler(lambda: time.perf_counter() > deadline, 10_000)
+            try:
+                cur = conn.execute(sql)
+                rows = cur.fetchmany(EVAL_MAX_ROWS + 1)
+                cur.close()
+            finally:
+                conn.set_progress_handler(None, 0)
+    except sqlite3.OperationalError as e:
+        err = "timeout" if "interrupt" in str(e).lower() else f"{type(e).__name__}: {e}"
+        return None, err, (time.perf_counter() - started) * 1000
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}", (time.perf_counter() - started) * 1000
+    ms = (time.perf_counter() - started) * 1000
+    if len(rows) > EVAL_MAX_ROWS:
+        return None, "too_many_rows", ms
+    return rows, None, ms
+
+
+def _norm_value(v):
+    if isinstance(v, float):
+        return round(v, 6) if math.isfinite(v) else str(v)
+    if isinstance(v, bytes):
+        return v.hex()
+    return v
+
+
+def _norm_rows(rows: list) -> List[tuple]:
+    return [tuple(_norm_value(v) for v in r) for r in rows]
+
+
+def results_match(pred: list, gold: list, ordered: bool) -> bool:
+    pred, gold = _norm_rows(pred), _norm_rows(gold)
+    if len(pred) != len(gold):
+        return False
+    if not gold:
+        return True
+    width = len(gold[0])
+    if any(len(r) != width for r in pred):
+        return False
+
+    def same(p):
+        return p == gold if ordered else Counter(p) == Counter(gold)
+
+    if same(pred):
+        return True
+    if width > MAX_PERMUTE_COLS:
+        return False
+    # колонки в другом порядке (SELECT b, a вместо SELECT a, b) — тоже верный ответ
+    for perm in itertools.permutations(range(width)):
+        if perm != tuple(range(width)) and same([tuple(r[i] for i in perm) for r in pred]):
+            return True
+    return False
+
+
+def execute_pair(db_id: str, pred_sql: str, gold_sql: str, timeout: float) -> Dict:
+    gold, gold_err, gold_ms = _run_sql(db_id, gold_sql, timeout)
+    pred, pred_err, pred_ms = _run_sql(db_id, pred_sql, timeout)
+    if gold_err:
+        status = "gold_error"
+    elif pred_err == "timeout":
+        status = "timeout"
+    elif pred_err:
+        status = "pred_error"
+    else:
+        status = "correct" if results_match(pred, gold, "order by" in gold_sql.lower()) else "wrong"
+    return {"status": status, "error": pred_err or gold_err, "pred_ms": pred_ms, "gold_ms": gold_ms}
+
+
+# ==================== отчёт ====================
+def norm_sql(sql: str) -> str:
+    return " ".join(sql.strip().rstrip(";").lower().split())
+
+
+def percentiles(xs: List[float]) -> Dict[str, float]:
+    if not xs:
+        return {"n": 0}
+    xs = sorted(xs)
+
+    def p(q):
+        return round(xs[min(len(xs) - 1, max(0, int(round(q / 100 * (len(xs) - 1)))))], 3)
+
+    return {"n": len(xs), "p50": p(50), "p90": p(90), "p95": p(95), "p99": p(99),
+            "max": round(xs[-1], 3), "mean": round(sum(xs) / len(xs), 3)}
+
+
+def _pool_context():
+    # fork — воркеры не импортируют заново __main__ с torch (как в token_shards.py)
+    return get_context("fork" if "fork" in get_all_start_methods() else "spawn")
+
+
+def evaluate(examples: List[dict], model_dir: str, engine: str, batch_size: int,
+             workers: int, timeout: float) -> Tuple[Dict, List[Dict]]:
+    import torch
+    from sql_engine import load_sql_model
+    from schema_link import SchemaLinker, PrefixTokenCache, load_tables
+    from constrained import ConstrainedDecoder
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "backend"))
+    from app.safety import validate_sql
+
+    t0 = time.perf_counter()
+    tokenizer, model = load_sql_model(model_dir, engine)
+    load_s = time.perf_counter() - t0
+    table_meta = load_tables(SPIDER_DIR)
+    allowed = {m["db_id"]: m["table_names_original"] for m in table_meta}
+    tokens = PrefixTokenCache(tokenizer, SchemaLinker(table_meta), max_length=1024)
+    decoder = ConstrainedDecoder(tokenizer, model, table_meta, max_new_tokens=MAX_NEW_TOKENS)
+
+    lat = {"tokenize_ms": [], "generate_batch_ms": [], "generate_ms": [], "execute_pred_ms": [], "execute_gold_ms": []}
+    rows: List[Dict] = []
+    futures = []
+    started = time.perf_counter()
+    with ProcessPoolExecutor(workers, mp_context=_pool_context(),
+                             initializer=_init_worker, initargs=(SPIDER_DIR,)) as pool:
+        for start in range(0, len(examples), batch_size):
+            batch = examples[start:start + batch_size]
+            items = [(ex["question"], ex["db_id"]) for ex in batch]
+            t = time.perf_counter()
+            enc = tokens.encode_batch(items)
+            lat["tokenize_ms"].append((time.perf_counter() - t) * 1000 / len(batch))
+            t = time.perf_counter()
+            with torch.inference_mode():
+                sqls = decoder.generate(enc, items)
+            gen_ms = (time.perf_counter() - t) * 1000
+            lat["generate_batch_ms"].append(gen_ms)
+            lat["generate_ms"].extend([gen_ms / len(batch)] * len(batch))
+            for ex, sql in zip(batch, sqls):
+                row = {"question": ex["question"], "db_id": ex["db_id"], "gold": ex["query"], "pred": sql,
+                       "exact_match": norm_sql(sql) == norm_sql(ex["query"])}
+                verdict = validate_sql(sql, allowed.get(ex["db_id"]))
+                if not verdict.ok:
+                    row.update(status="blocked", error=verdict.reason)
+                    futures.append(None)
+                else:
+                    futures.append(pool.submit(execute_pair, ex["db_id"], sql, ex["query"], timeout))
+                rows.append(row)
+        for row, fut in zip(rows, futures):
+            if fut is None:
+                continue
+            res = fut.result()
+            row.update(status=res["status"], error=res["error"])
+            lat["execute_gold_ms"].append(res["gold_ms"])
+            if res["status"] != "gold_error":
+                lat["execute_pred_ms"].append(res["pred_ms"])
+    wall_s = time.perf_counter() - started
+
+    counts = Counter(r["status"] for r in rows)
+    scored = len(rows) - counts["gold_error"]  # битый gold не считается ни за, ни против модели
+    return {
+        "model": model_dir, "engine": engine, "decode": decoder.mode, "n": len(rows),
+        "batch_size": batch_size, "workers": workers, "timeout_s": timeout,
+        "execution_accuracy": round(counts["correct"] / scored, 4) if scored else 0.0,
+        "exact_match": round(sum(r["exact_match"] for r in rows) / len(rows), 4) if rows else 0.0,
+        "counts": dict(counts),
+        "latency_ms": {k: percentiles(v) for k, v in lat.items()},
+        "load_s": round(load_s, 2), "wall_s": round(wall_s, 2),
+        "examples_per_s": round(len(rows) / wall_s, 2) if wall_s else 0.0,
+        "decoder_stats": dict(decoder.stats), "prefix_cache": tokens.stats(),
+        "failures": [r for r in rows if r["status"] != "correct"][:50],
+    }, rows
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="execution accuracy + latency of text-to-SQL on Spider")
+    ap.add_argument("--model", default="out_t5_spider/final")
+    ap.add_argument("--engine", default=None, help="SQL_ENGINE по умолчанию")
+    ap.add_argument("--split", default="dev")
+    ap.add_argument("--limit", type=int, default=0, help="0 — весь сплит")
+    ap.add_argument("--batch-size", type=int, default=16)
+    ap.add_argument("--workers", type=int, default=EVAL_WORKERS)
+    ap.add_argument("--timeout", type=float, default=EVAL_TIMEOUT_S, help="секунд на один SQL")
+    ap.add_argument("--out", default="eval_spider.json")
+    ap.add_argument("--per-example", default="", help="jsonl со всеми примерами (для диффа между прогонами)")
+    args = ap.parse_args()
+
+    with open(os.path.join(SPIDER_DIR, f"{args.split}.json"), "r", encoding="utf-8") as f:
+        examples = json.load(f)
+    if args.limit:
+        examples = examples[:args.limit]
+
+    from sql_engine import SQL_ENGINE
+    report, rows = evaluate(examples, args.model, args.engine or SQL_ENGINE, args.batch_size,
+                            args.workers, args.timeout)
+    report["split"] = args.split
+    lat = report["latency_ms"]
+    print(f"n={report['n']}  exec_acc={report['execution_accuracy']:.3f}  exact={report['exact_match']:.3f}  "
+          f"{report['examples_per_s']} ex/s  counts={report['counts']}")
+    for stage in ("tokenize_ms", "generate_ms", "execute_pred_ms", "execute_gold_ms"):
+        s = lat[stage]
+        if s["n"]:
+            print(f"  {stage:<16} p50 {s['p50']:>9.2f}  p95 {s['p95']:>9.2f}  p99 {s['p99']:>9.2f}  max {s['max']:>9.2f}")
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.per_example:
+        with open(args.per_example, "w", encoding="utf-8") as f:
+            for r in rows:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    print(f"report -> {args.out}")
@@ -0,0 +1,60 @@
+# export_onnx.py
+# Экспорт дообученной T5 (out_t5_spider/final) в ONNX для CPU:
+#   encoder_model.onnx, decoder_model.onnx, decoder_with_past_model.onnx (KV-cache)
+# и, с --int8, динамически квантизованные копии в <out>_int8.
+#
+#   python export_onnx.py --model out_t5_spider/final --int8
+#   SQL_ENGINE=onnx-int8 python infer_sql.py
+import argparse, glob, os, shutil, tempfile
+from sql_engine import is_adapter_dir, load_torch_model, onnx_dir
+from transformers import T5TokenizerFast
+
+TOKENIZER_FILES = ("spiece.model", "tokenizer.json", "tokenizer_config.json", "special_tokens_map.json")
+
+
+def export(model_dir: str, out_dir: str):
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    tokenizer = T5TokenizerFast.from_pretrained(model_dir)
+    with tempfile.TemporaryDirectory() as tmp:
+        src = model_dir
+        if is_adapter_dir(model_dir):
+            # optimum экспортирует обычную модель — сначала вливаем LoRA
+            load_torch_model(model_dir).save_pretrained(tmp)
+            tokenizer.save_pretrained(tmp)
+            src = tmp
+        model = ORTModelForSeq2SeqLM.from_pretrained(src, export=True, use_cache=True)
+        model.save_pretrained(out_dir)
+    tokenizer.save_pretrained(out_dir)
+    print(f"✅ ONNX: {out_dir}")
+
+
+def quantize(onnx_in: str, onnx_out: str):
+    from optimum.onnxruntime import ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    os.makedirs(onnx_out, exist_ok=True)
+    for path in sorted(glob.glob(os.path.join(onnx_in, "*.onnx"))):
+        name = os.path.basename(path)
+        quantizer = ORTQuantizer.from_pretrained(onnx_in, file_name=name)
+        quantizer.quantize(save_dir=onnx_out, quantization_config=qconfig)
+        # ORTQuantizer сохраняет как *_quantized.onnx — возвращаем исходные имена,
+        # чтобы ORTModelForSeq2SeqLM нашёл графы без подсказок
+        q_path = os.path.join(onnx_out, name.replace(".onnx", "_quantized.onnx"))
+        if os.path.exists(q_path):
+            os.replace(q_path, os.path.join(onnx_out, name))
+    for f in os.listdir(onnx_in):
+        if f.endswith(".json") or f in TOKENIZER_FILES:
+            shutil.copy(os.path.join(onnx_in, f), onnx_out)
+    print(f"✅ ONNX int8: {onnx_out}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--model", default="out_t5_spider/final")
+    ap.add_argument("--out", default=None)
+    ap.add_argument("--int8", action="store_true", help="ещё и int8 dynamic quantization")
+    args = ap.parse_args()
+    out = args.out or onnx_dir(args.model)
+    export(args.model, out)
+    if args.int8:
+        quantize(out, out.rstrip("/\\") + "_int8")
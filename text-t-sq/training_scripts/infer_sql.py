@@ -1,48 +1,54 @@
 # infer_sql.py
-import os, sqlite3
-from transformers import T5ForConditionalGeneration, T5TokenizerFast
+import os, sys
+from sql_engine import load_sql_model
+from spider_db import SpiderDbCache, fetch_bounded, SPIDER_MAX_FETCH
+from constrained import ConstrainedDecoder
+from schema_link import SchemaLinker, load_tables
+
+# Общая с backend проверка SQL (backend/app/safety.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "backend"))
+from app.safety import validate_sql
 
 MODEL_DIR = "out_t5_spider/final"
 SPIDER_DIR = "data/spider"
 
-tokenizer = T5TokenizerFast.from_pretrained(MODEL_DIR)
-model = T5ForConditionalGeneration.from_pretrained(MODEL_DIR).eval()
-
-def build_schema_string(db_id):
-    import json
-    tables = json.load(open(os.path.join(SPIDER_DIR, "tables.json"), "r", encoding="utf-8"))
-    meta = next(m for m in tables if m["db_id"] == db_id)
-    tbls = meta["table_names_original"]
-    cols = {}
-    for (tbl_idx, col_name), col_type in zip(meta["column_names_original"], meta["column_types"]):
-        if tbl_idx == -1: continue
-        cols.setdefault(tbl_idx, []).append(f"{col_name}:{col_type}")
-    serial = " | ".join(f"{tbls[i]}({', '.join(cols.get(i, []))})" for i in range(len(tbls)))
-    return serial
+tokenizer, model = load_sql_model(MODEL_DIR)  # SQL_ENGINE=torch|torch-int8|onnx|onnx-int8
+dbs = SpiderDbCache(SPIDER_DIR)
+
+_tables = None
+_linker = None
+
+def linker():
+    # tables.json читаем один раз на процесс; SchemaLinker держит индексы и кэш сериализаций
+    global _tables, _linker
+    if _linker is None:
+        _tables = load_tables(SPIDER_DIR)
+        _linker = SchemaLinker(_tables)
+    return _linker
+
+def build_schema_string(db_id, question=None):
+    # С вопросом — та же выборка таблиц, что в боте и prep_spider (SCHEMA_PRUNE), без — вся схема
+    lk = linker()
+    return lk.schema_string(db_id, lk.select(question, db_id) if question else None)
+
+_decoder = None
 
 def generate_sql(question, db_id, max_new_tokens=196):
-    schema = build_schema_string(db_id)
-    inp = f"translate to SQL | db: {db_id} | schema: {schema} | question: {question}"
+    global _decoder
+    if _decoder is None:
+        linker()
+        _decoder = ConstrainedDecoder(tokenizer, model, _tables, max_new_tokens=max_new_tokens)  # SQL_DECODE=beam|greedy|adaptive
+    inp = linker().build_input(question, db_id)
     tok = tokenizer(inp, return_tensors="pt", truncation=True, max_length=1024)
-    out = model.generate(**tok, max_new_tokens=max_new_tokens, num_beams=4, early_stopping=True)
-    sql = tokenizer.decode(out[0], skip_special_tokens=True).strip()
-    return sql
-
-def is_safe_select(sql: str) -> bool:
-    s = sql.strip().lower().replace("\n"," ")
-    if not s.startswith("select"):
-        return False
-    bad = ["insert", "update", "delete", "drop", "alter", "truncate", "attach", "detach", ";"]
-    return not any(b in s for b in bad)
-
-def execute_sql(sql: str, db_id: str):
-    db_path = os.path.join(SPIDER_DIR, "database", db_id, f"{db_id}.sqlite")
-    con = sqlite3.connect(db_path)
-    cur = con.cursor()
-    cur.execute(sql)
-    rows = cur.fetchall()
-    cols = [d[0] for d in cur.description] if cur.description else []
-    con.close()
+    return _decoder.generate(tok, [(question, db_id)])[0]
+
+def is_safe_select(sql: str, db_id: str = None) -> bool:
+    allowed = linker().indexes[db_id].tables if db_id else None
+    return validate_sql(sql, allowed).ok
+
+def execute_sql(sql: str, db_id: str, max_rows: int = SPIDER_MAX_FETCH):
+    with dbs.connection(db_id) as con:
+        cols, rows, _ = fetch_bounded(con.execute(sql), max_rows)
     return cols, rows
 
 if __name__ == "__main__":
@@ -50,7 +56,7 @@ if __name__ == "__main__":
     db = "student_assessment"  # пример; подставь реальный db_id из dev
     sql = generate_sql(q, db)
     print("SQL:", sql)
-    if is_safe_select(sql):
+    if is_safe_select(sql, db):
         cols, rows = execute_sql(sql, db)
         print(cols)
         print(rows[:5])
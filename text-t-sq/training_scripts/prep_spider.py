@@ -1,23 +1,24 @@
 # prep_spider.py
 import json, os
 from collections import defaultdict
+from schema_link import SchemaLinker, SCHEMA_PRUNE
 
 SPIDER_DIR = "data/spider"
 
-def load_tables():
-    with open(os.path.join(SPIDER_DIR, "tables.json"), "r", encoding="utf-8") as f:
-        tables = json.load(f)
-    by_db = {}
-    for t in tables:
-        db = t["db_id"]
-        cols = []
-        for (tid, colname), (table_names) in zip(t["column_names"], t["table_names_original"]):
-            pass
-        # Соберём простой сериализатор
+_META = None
+
+def load_meta():
+    # tables.json читаем один раз на процесс — он общий для всех сплитов
+    global _META
+    if _META is None:
+        with open(os.path.join(SPIDER_DIR, "tables.json"), "r", encoding="utf-8") as f:
+            _META = json.load(f)
+    return _META
+
+def load_tables(meta=None):
+    # Соберём простой сериализатор
     by_db = {}
-    with open(os.path.join(SPIDER_DIR, "tables.json"), "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    for m in meta:
+    for m in meta or load_meta():
         db_id = m["db_id"]
         tbls = m["table_names_original"]
         cols = defaultdict(list)
@@ -36,27 +37,34 @@ def load_split(name):
     with open(os.path.join(SPIDER_DIR, f"{name}.json"), "r", encoding="utf-8") as f:
         return json.load(f)
 
-def make_pairs(split):
-    by_db = load_tables()
-    pairs = []
+def iter_pairs(split, prune=SCHEMA_PRUNE):
+    meta = load_meta()
+    # Та же обрезка схемы, что и в боте (schema_link.py), чтобы входы совпадали
+    linker = SchemaLinker(meta, prune=True) if prune else None
+    by_db = None if linker else load_tables(meta)
     for ex in load_split(split):
         q = ex["question"]
         sql = ex["query"]
         db = ex["db_id"]
-        schema = by_db[db]
+        schema = linker.schema_string(db, linker.select(q, db)) if linker else by_db[db]
         inp = f"translate to SQL | db: {db} | schema: {schema} | question: {q}"
         tgt = sql
-        pairs.append({"input": inp, "target": tgt, "db_id": db})
-    return pairs
+        yield {"input": inp, "target": tgt, "db_id": db}
+
+def make_pairs(split, prune=SCHEMA_PRUNE):
+    return list(iter_pairs(split, prune))
+
+def write_jsonl(pairs, path):
+    n = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for r in pairs:
+            f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            n += 1
+    return n
 
 if __name__ == "__main__":
-    train = make_pairs("train_spider")
-    dev = make_pairs("dev")
     os.makedirs("data/processed", exist_ok=True)
-    with open("data/processed/train.jsonl", "w", encoding="utf-8") as f:
-        for r in train:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
-    with open("data/processed/dev.jsonl", "w", encoding="utf-8") as f:
-        for r in dev:
-            f.write(json.dumps(r, ensure_ascii=False) + "\n")
-    print("done")
+    # Пишем потоково; токенизация — отдельно и один раз (token_shards.py / train_t5_spider.py)
+    n_train = write_jsonl(iter_pairs("train_spider"), "data/processed/train.jsonl")
+    n_dev = write_jsonl(iter_pairs("dev"), "data/processed/dev.jsonl")
+    print(f"done: train={n_train}, dev={n_dev}")
@@ -0,0 +1,218 @@
+# schema_link.py
+# Schema linking для входов T5: оставляем только таблицы/колонки, которые
+# лексически пересекаются с вопросом, плюс кэш сериализованных и
+# токенизированных кусков схемы по db_id. Используется в prep_spider.py
+# (обучение) и в tg_miniapp/bot/botai.py (инференс), чтобы входы совпадали.
+# По умолчанию обрезка выключена: поставляемый чекпойнт обучен на полных
+# схемах. Включать SCHEMA_PRUNE=1 — только вместе с переобучением на
+# prep_spider.py и сравнением execution accuracy в eval_spider.py.
+import json, os, re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+SCHEMA_PRUNE   = os.environ.get("SCHEMA_PRUNE", "0") == "1"
+MAX_TABLES     = int(os.environ.get("SCHEMA_MAX_TABLES", 6))
+KEEP_ALL_COLS  = int(os.environ.get("SCHEMA_KEEP_ALL_COLS", 8))  # узкие таблицы не режем
+TRIGRAM_MIN    = 0.5
+
+_WORD = re.compile(r"[A-Za-zА-Яа-яЁё0-9]+")
+_CAMEL = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+
+Selection = Tuple[Tuple[int, Tuple[int, ...]], ...]  # ((table_idx, (col_idx, ...)), ...)
+
+
+def load_tables(spider_dir: str) -> list:
+    with open(os.path.join(spider_dir, "tables.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _stem(w: str) -> str:
+    if len(w) > 4 and w.endswith("ies"):
+        return w[:-3] + "y"
+    if len(w) > 4 and w.endswith("es") and w[-3] in "sxz":
+        return w[:-2]
+    if len(w) > 3 and w.endswith("s") and not w.endswith("ss"):
+        return w[:-1]
+    return w
+
+
+def words(text: str) -> set:
+    text = _CAMEL.sub(" ", text.replace("_", " "))
+    return {_stem(w.lower()) for w in _WORD.findall(text)}
+
+
+def _trigrams(w: str) -> frozenset:
+    w = f"#{w}#"
+    return frozenset(w[i:i + 3] for i in range(len(w) - 2))
+
+
+def _trigram_sim(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class DbIndex:
+    """Предрасчитанный индекс одной базы из tables.json."""
+
+    def __init__(self, meta: dict):
+        self.db_id = meta["db_id"]
+        self.tables = meta["table_names_original"]
+        readable_tables = meta.get("table_names", self.tables)
+        self.table_words = [words(o) | words(r) for o, r in zip(self.tables, readable_tables)]
+
+        # колонки по таблицам: (глобальный индекс, имя, тип)
+        self.columns: Dict[int, List[Tuple[int, str, str]]] = {}
+        self.col_words: Dict[int, set] = {}
+        self.col_grams: Dict[int, List[frozenset]] = {}
+        readable_cols = meta.get("column_names", meta["column_names_original"])
+        for ci, ((ti, name), col_type, (_, readable)) in enumerate(
+                zip(meta["column_names_original"], meta["column_types"], readable_cols)):
+            if ti == -1:
+                continue
+            self.columns.setdefault(ti, []).append((ci, name, col_type))
+            w = words(name) | words(readable)
+            self.col_words[ci] = w
+            self.col_grams[ci] = [_trigrams(x) for x in w]
+
+        col_table = {ci: ti for ti, cols in self.columns.items() for ci, _, _ in cols}
+        pks = meta.get("primary_keys", [])
+        self.keys = set(k for pk in pks for k in (pk if isinstance(pk, list) else [pk]))
+        self.fk_links: Dict[int, set] = {}
+        for a, b in meta.get("foreign_keys", []):
+            self.keys.update((a, b))
+            ta, tb = col_table.get(a), col_table.get(b)
+            if ta is not None and tb is not None and ta != tb:
+                self.fk_links.setdefault(ta, set()).add(tb)
+                self.fk_links.setdefault(tb, set()).add(ta)
+
+    def _col_score(self, ci: int, q_words: set, q_grams: List[frozenset]) -> float:
+        score = float(len(self.col_words[ci] & q_words))
+        if not score:
+            for cg in self.col_grams[ci]:
+                if any(_trigram_sim(cg, qg) >= TRIGRAM_MIN for qg in q_grams):
+                    score = 0.5
+                    break
+        return score
+
+    def full_selection(self) -> Selection:
+        return tuple((ti, tuple(ci for ci, _, _ in self.columns.get(ti, []))) for ti in range(len(self.tables)))
+
+    def link(self, question: str) -> Selection:
+        q_words = words(question)
+        q_grams = [_trigrams(w) for w in q_words if len(w) > 2]
+        col_scores = {ci: self._col_score(ci, q_words, q_grams) for ci in self.col_words}
+        table_scores = []
+        for ti in range(len(self.tables)):
+            s = 2.0 * len(self.table_words[ti] & q_words)
+            s += sum(col_scores[ci] for ci, _, _ in self.columns.get(ti, []))
+            table_scores.append(s)
+
+        ranked = sorted((ti for ti, s in enumerate(table_scores) if s > 0), key=lambda t: -table_scores[t])
+        chosen = set(ranked[:MAX_TABLES])
+        if not chosen:
+            # Ничего не нашли (например, вопрос по-русски) — отдаём схему целиком
+            return self.full_selection()
+        # Таблицы-мосты: связаны внешними ключами сразу с двумя выбранными (many-to-many)
+        for ti in range(len(self.tables)):
+            if ti not in chosen and len(self.fk_links.get(ti, set()) & chosen) >= 2:
+                chosen.add(ti)
+
+        selection = []
+        for ti in sorted(chosen):
+            cols = self.columns.get(ti, [])
+            if len(cols) > KEEP_ALL_COLS:
+                keep = [ci for idx, (ci, _, _) in enumerate(cols)
+                        if idx == 0 or ci in self.keys or col_scores[ci] > 0]
+            else:
+                keep = [ci for ci, _, _ in cols]
+            selection.append((ti, tuple(keep)))
+        return tuple(selection)
+
+    def serialize(self, selection: Selection) -> str:
+        out = []
+        for ti, keep in selection:
+            keep = set(keep)
+            cols = ", ".join(f"{name}:{col_type}" for ci, name, col_type in self.columns.get(ti, []) if ci in keep)
+            out.append(f"{self.tables[ti]}({cols})")
+        return " | ".join(out)
+
+
+class SchemaLinker:
+    """Индексы всех баз + LRU-кэш сериализованных схем (по db_id и выбору таблиц)."""
+
+    def __init__(self, table_meta: list, prune: bool = SCHEMA_PRUNE, cache_size: int = 4096):
+        self.prune = prune
+        self.indexes = {m["db_id"]: DbIndex(m) for m in table_meta}
+        self._cache: "OrderedDict[tuple, str]" = OrderedDict()
+        self._cache_size = cache_size
+
+    def select(self, question: str, db_id: str) -> Selection:
+        idx = self.indexes[db_id]
+        return idx.link(question) if self.prune else idx.full_selection()
+
+    def schema_string(self, db_id: str, selection: Optional[Selection] = None) -> str:
+        idx = self.indexes[db_id]
+        if selection is None:
+            selection = idx.full_selection()
+        key = (db_id, selection)
+        s = self._cache.get(key)
+        if s is None:
+            s = idx.serialize(selection)
+            self._cache[key] = s
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return s
+
+    def build_input(self, question: str, db_id: str) -> str:
+        sch = self.schema_string(db_id, self.select(question, db_id))
+        return f"translate to SQL | db: {db_id} | schema: {sch} | question: {question}"
+
+
+class PrefixTokenCache:
+    """Кэш токенов префикса "translate to SQL | db: .. | schema: .." по (db_id, выбор).
+    Вопрос токенизируется отдельно и приклеивается; при переполнении режем
+    схему, а не вопрос (раньше truncation молча отрезал именно вопрос)."""
+
+    def __init__(self, tokenizer, linker: SchemaLinker, max_length: int = 1024, cache_size: int = 4096):
+        self.tokenizer = tokenizer
+        self.linker = linker
+        self.max_length = max_length
+        self._cache: "OrderedDict[tuple, List[int]]" = OrderedDict()
+        self._cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+
+    def _prefix_ids(self, db_id: str, selection: Selection) -> List[int]:
+        key = (db_id, selection)
+        ids = self._cache.get(key)
+        if ids is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return ids
+        self.misses += 1
+        sch = self.linker.schema_string(db_id, selection)
+        ids = self.tokenizer(f"translate to SQL | db: {db_id} | schema: {sch} |",
+                             add_special_tokens=False)["input_ids"]
+        self._cache[key] = ids
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return ids
+
+    def encode(self, question: str, db_id: str) -> List[int]:
+        prefix = self._prefix_ids(db_id, self.linker.select(question, db_id))
+        q_ids = self.tokenizer(f"question: {question}", add_special_tokens=False)["input_ids"]
+        budget = self.max_length - len(q_ids) - 1  # -1 под </s>
+        if budget < 0:
+            q_ids, budget = q_ids[:self.max_length - 1], 0
+        return prefix[:budget] + q_ids + [self.tokenizer.eos_token_id]
+
+    def encode_batch(self, items: List[Tuple[str, str]]):
+        """[(question, db_id), ...] -> тензоры input_ids/attention_mask с паддингом."""
+        ids = [self.encode(q, db_id) for q, db_id in items]
+        return self.tokenizer.pad({"input_ids": ids}, padding=True, return_tensors="pt")
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
@@ -0,0 +1,151 @@
+# spider_db.py
+# Кэш открытых соединений к базам Spider по db_id (бот, infer_sql).
+# Базы Spider — статичные файлы только для чтения, поэтому открываем их как
+# file:...?mode=ro&immutable=1: SQLite не берёт блокировки и не проверяет
+# изменения файла, а схема парсится один раз на соединение, а не на запрос.
+#   - LRU по db_id, на каждый db_id — стек свободных соединений
+#   - SPIDER_DB_MAX_OPEN — потолок открытых файлов (свободные соединения
+#     самых давно не использованных баз закрываются первыми)
+#   - SPIDER_DB_IDLE_S — соединения, простаивающие дольше, закрываются
+import os, sqlite3, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+SPIDER_DB_MAX_OPEN  = int(os.environ.get("SPIDER_DB_MAX_OPEN", 32))
+SPIDER_DB_IDLE_S    = float(os.environ.get("SPIDER_DB_IDLE_S", 600))
+SPIDER_DB_MMAP_SIZE = int(os.environ.get("SPIDER_DB_MMAP_SIZE", 64 * 1024 * 1024))
+SPIDER_MAX_FETCH    = int(os.environ.get("SPIDER_MAX_FETCH", 1000))
+
+
+def db_path(spider_dir: str, db_id: str) -> str:
+    return os.path.join(spider_dir, "database", db_id, f"{db_id}.sqlite")
+
+
+class SpiderDbCache:
+    def __init__(self, spider_dir: str, max_open: int = SPIDER_DB_MAX_OPEN,
+                 idle_timeout: float = SPIDER_DB_IDLE_S, mmap_size: int = SPIDER_DB_MMAP_SIZE):
+        self.spider_dir = spider_dir
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.mmap_size = mmap_size
+        self._lock = threading.Lock()
+        # db_id -> [(conn, last_used), ...]; порядок ключей — LRU
+        self._idle: "OrderedDict[str, List[Tuple[sqlite3.Connection, float]]]" = OrderedDict()
+        self._open = 0  # свободные + выданные
+        self._stats = {"hits": 0, "misses": 0, "evicted_lru": 0, "evicted_idle": 0, "closed_over_cap": 0}
+
+    def _connect(self, db_id: str) -> sqlite3.Connection:
+        path = Path(db_path(self.spider_dir, db_id))
+        if not path.is_file():
+            raise FileNotFoundError(f"no database for db_id {db_id!r}: {path}")
+        uri = path.resolve().as_uri() + "?mode=ro&immutable=1"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def _close(self, conn: sqlite3.Connection):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def _sweep(self, now: float) -> List[sqlite3.Connection]:
+        # под self._lock; возвращает соединения, которые надо закрыть
+        victims = []
+        for db_id in list(self._idle):
+            stack = self._idle[db_id]
+            keep = [(c, t) for c, t in stack if now - t < self.idle_timeout]
+            if len(keep) != len(stack):
+                self._stats["evicted_idle"] += len(stack) - len(keep)
+                victims.extend(c for c, t in stack if now - t >= self.idle_timeout)
+            if keep:
+                self._idle[db_id] = keep
+            else:
+                del self._idle[db_id]
+        # потолок по файлам: закрываем свободные соединения с LRU-конца
+        while self._open - len(victims) > self.max_open and self._idle:
+            db_id, stack = next(iter(self._idle.items()))
+            victims.append(stack.pop(0)[0])
+            self._stats["evicted_lru"] += 1
+            if not stack:
+                del self._idle[db_id]
+        self._open -= len(victims)
+        return victims
+
+    def acquire(self, db_id: str) -> sqlite3.Connection:
+        now = time.monotonic()
+        with self._lock:
+            stack = self._idle.get(db_id)
+            conn = stack.pop()[0] if stack else None
+            if conn is not None:
+                self._stats["hits"] += 1
+                self._idle.move_to_end(db_id)
+            else:
+                self._stats["misses"] += 1
+                self._open += 1  # новое соединение учитываем до sweep — освободит место под него
+            victims = self._sweep(now)
+        for c in victims:
+            self._close(c)
+        if conn is None:
+            try:
+                conn = self._connect(db_id)
+            except BaseException:
+                with self._lock:
+                    self._open -= 1
+                raise
+        return conn
+
+    def release(self, db_id: str, conn: sqlite3.Connection, broken: bool = False):
+        with self._lock:
+            if broken or self._open > self.max_open:
+                # выдано больше соединений, чем разрешено держать открытыми
+                self._open -= 1
+                self._stats["closed_over_cap"] += not broken
+                close = True
+            else:
+                self._idle.setdefault(db_id, []).append((conn, time.monotonic()))
+                self._idle.move_to_end(db_id)
+                close = False
+        if close:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self, db_id: str):
+        conn = self.acquire(db_id)
+        broken = False
+        try:
+            yield conn
+        except sqlite3.DatabaseError as e:
+            # interrupt/ошибка в SQL соединение не портят; остальное — закрываем
+            broken = not isinstance(e, sqlite3.OperationalError)
+            raise
+        finally:
+            self.release(db_id, conn, broken=broken)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"open": self._open, "idle": sum(len(s) for s in self._idle.values()),
+                    "dbs": len(self._idle), "max_open": self.max_open, **self._stats}
+
+    def close(self):
+        with self._lock:
+            victims = [c for stack in self._idle.values() for c, _ in stack]
+            self._idle.clear()
+            self._open -= len(victims)
+        for c in victims:
+            self._close(c)
+
+
+def fetch_bounded(cur: sqlite3.Cursor, max_rows: int = SPIDER_MAX_FETCH) -> Tuple[list, list, bool]:
+    """-> (cols, rows, more): не больше max_rows строк, more — были ли ещё.
+    Курсор закрывается: недочитанный statement не должен висеть на кэшированном соединении."""
+    try:
+        rows = cur.fetchmany(max_rows + 1)
+        cols = [d[0] for d in cur.description] if cur.description else []
+    finally:
+        cur.close()
+    more = len(rows) > max_rows
+    return cols, rows[:max_rows], more
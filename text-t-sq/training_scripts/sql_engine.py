@@ -0,0 +1,108 @@
+# sql_engine.py
+# Выбор рантайма для T5 text-to-SQL по env SQL_ENGINE:
+#   torch      — PyTorch fp32 (LoRA-адаптер вливается в веса при загрузке)
+#   torch-int8 — то же + динамическая int8-квантизация nn.Linear
+#   onnx       — onnxruntime, encoder/decoder/decoder_with_past (KV-cache), см. export_onnx.py
+#   onnx-int8  — onnxruntime с int8-квантизованными графами
+# Все варианты отдают объект с HF-совместимым .generate(), так что
+# generate_sql в botai.py / infer_sql.py не меняется.
+# torch/transformers импортируются внутри функций: импорт модуля дешёвый,
+# а inspect_model_dir позволяет проверить веса без загрузки модели.
+import json, os, struct
+
+SQL_ENGINE   = os.environ.get("SQL_ENGINE", "torch")
+SQL_ONNX_DIR = os.environ.get("SQL_ONNX_DIR", "")
+ORT_THREADS  = int(os.environ.get("ORT_THREADS", 0))  # 0 — решает onnxruntime
+ENGINES = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+
+def is_adapter_dir(model_dir: str) -> bool:
+    return os.path.exists(os.path.join(model_dir, "adapter_config.json"))
+
+
+def onnx_dir(model_dir: str, int8: bool = False) -> str:
+    if SQL_ONNX_DIR:
+        return SQL_ONNX_DIR
+    return model_dir.rstrip("/\\") + ("_onnx_int8" if int8 else "_onnx")
+
+
+def _safetensors_header(path: str) -> dict:
+    # Формат: 8 байт длины (little-endian u64) + JSON-заголовок; тензоры не читаем
+    with open(path, "rb") as f:
+        (n,) = struct.unpack("<Q", f.read(8))
+        return json.loads(f.read(n))
+
+
+def inspect_model_dir(model_dir: str) -> dict:
+    """Проверка каталога модели без загрузки весов: конфиги, файлы весов,
+    число тензоров/параметров по заголовкам safetensors."""
+    info = {"adapter": is_adapter_dir(model_dir), "weights": [], "tensors": 0, "params": 0}
+    cfg = "adapter_config.json" if info["adapter"] else "config.json"
+    with open(os.path.join(model_dir, cfg), "r", encoding="utf-8") as f:
+        conf = json.load(f)
+    info["base"] = conf.get("base_model_name_or_path") if info["adapter"] else conf.get("_name_or_path")
+    for name in sorted(os.listdir(model_dir)):
+        path = os.path.join(model_dir, name)
+        if name.endswith(".safetensors"):
+            header = _safetensors_header(path)
+            header.pop("__metadata__", None)
+            info["tensors"] += len(header)
+            for t in header.values():
+                n = 1
+                for d in t["shape"]:
+                    n *= d
+                info["params"] += n
+            info["weights"].append(name)
+        elif name.endswith(".bin") and name.startswith(("pytorch_model", "adapter_model")):
+            info["weights"].append(name)
+    if not info["weights"]:
+        raise FileNotFoundError(f"no weights in {model_dir}")
+    return info
+
+
+def _has_safetensors(model_dir: str) -> bool:
+    return any(n.endswith(".safetensors") for n in os.listdir(model_dir))
+
+
+def load_torch_model(model_dir: str):
+    from transformers import T5ForConditionalGeneration
+    # safetensors читаются через mmap: без pickle и без второй копии весов в памяти
+    kwargs = {"low_cpu_mem_usage": True}
+    if is_adapter_dir(model_dir):
+        # LoRA-адаптер: вливаем в базовые веса — минус лишние матмулы на каждом шаге
+        from peft import AutoPeftModelForSeq2SeqLM
+        model = AutoPeftModelForSeq2SeqLM.from_pretrained(model_dir, **kwargs).merge_and_unload()
+    else:
+        model = T5ForConditionalGeneration.from_pretrained(
+            model_dir, use_safetensors=_has_safetensors(model_dir), **kwargs
+        )
+    return model.eval()
+
+
+def load_sql_model(model_dir: str, engine: str = SQL_ENGINE):
+    """-> (tokenizer, model)"""
+    if engine not in ENGINES:
+        raise ValueError(f"unknown SQL_ENGINE={engine!r}, expected one of {ENGINES}")
+    from transformers import T5TokenizerFast
+    tokenizer = T5TokenizerFast.from_pretrained(model_dir)
+
+    if engine.startswith("torch"):
+        model = load_torch_model(model_dir)
+        if engine == "torch-int8":
+            import torch
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return tokenizer, model
+
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    path = onnx_dir(model_dir, int8=engine == "onnx-int8")
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"{path} not found — run export_onnx.py first")
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if ORT_THREADS:
+        opts.intra_op_num_threads = ORT_THREADS
+    model = ORTModelForSeq2SeqLM.from_pretrained(
+        path, use_cache=True, provider="CPUExecutionProvider", session_options=opts
+    )
+    return tokenizer, model
@@ -0,0 +1,219 @@
+# token_shards.py
+# Однократная токенизация train/dev в memory-mapped шарды.
+#   data/tokenized/<split>-<key>/
+#       meta.json                      — токенайзер, MAX_INPUT/MAX_TARGET, dtype, шарды
+#       shard_00000.inputs.bin         — id токенов входов подряд (uint16/int32)
+#       shard_00000.inputs.off.npy     — смещения начала каждого примера (+ конец)
+#       shard_00000.labels.bin / .labels.off.npy — то же для целевого SQL
+# key = sha1(токенайзер + MAX_INPUT + MAX_TARGET + размер/mtime jsonl): сменился
+# любой из них — шарды пересобираются, иначе train_t5_spider.py берёт готовые.
+# Токенизация — в пуле процессов, jsonl читается потоково кусками.
+#
+#   python token_shards.py --model t5-small --max-input 512 --max-target 128
+import argparse, hashlib, itertools, json, os, shutil, time
+from multiprocessing import get_all_start_methods, get_context
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+TOKENIZED_DIR = os.environ.get("TOKENIZED_DIR", "data/tokenized")
+SHARD_SIZE    = int(os.environ.get("TOKEN_SHARD_SIZE", 20000))  # примеров в шарде
+CHUNK_SIZE    = 1000                                            # примеров на задачу пула
+TOKENIZE_WORKERS = int(os.environ.get("TOKENIZE_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+
+_tok_input = None
+_tok_target = None
+
+
+def _init_worker(tokenizer_json: str, max_input: int, max_target: int):
+    # Воркерам хватает Rust-токенайзера из tokenizers: без импорта transformers/torch
+    # процесс стартует за доли секунды. Сериализованный tokenizer.json содержит и
+    # post-processor (</s>), так что id совпадают с T5TokenizerFast(..., truncation=True).
+    global _tok_input, _tok_target
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"  # параллелим процессами, не потоками Rust
+    from tokenizers import Tokenizer
+    _tok_input = Tokenizer.from_str(tokenizer_json)
+    _tok_input.no_padding()
+    _tok_input.enable_truncation(max_input)
+    _tok_target = Tokenizer.from_str(tokenizer_json)
+    _tok_target.no_padding()
+    _tok_target.enable_truncation(max_target)
+
+
+def _tokenize_chunk(rows: List[Tuple[str, str]]) -> Tuple[List[List[int]], List[List[int]]]:
+    inputs = [e.ids for e in _tok_input.encode_batch([r[0] for r in rows])]
+    labels = [e.ids for e in _tok_target.encode_batch([r[1] for r in rows])]
+    return inputs, labels
+
+
+def _read_chunks(jsonl_path: str, size: int = CHUNK_SIZE) -> Iterator[List[Tuple[str, str]]]:
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        rows = (json.loads(line) for line in f if line.strip())
+        while True:
+            chunk = [(r["input"], r["target"]) for r in itertools.islice(rows, size)]
+            if not chunk:
+                return
+            yield chunk
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    h = hashlib.sha1(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    h.update(repr(sorted(tokenizer.special_tokens_map.items())).encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def cache_dir(jsonl_path: str, tokenizer, max_input: int, max_target: int, root: str = TOKENIZED_DIR) -> str:
+    st = os.stat(jsonl_path)
+    key = hashlib.sha1(json.dumps([tokenizer_fingerprint(tokenizer), max_input, max_target,
+                                   st.st_size, st.st_mtime_ns]).encode("utf-8")).hexdigest()[:12]
+    split = os.path.splitext(os.path.basename(jsonl_path))[0]
+    return os.path.join(root, f"{split}-{key}")
+
+
+class _ShardWriter:
+    def __init__(self, out_dir: str, dtype):
+        self.out_dir = out_dir
+        self.dtype = dtype
+        self.shards: List[Dict] = []
+        self._reset()
+
+    def _reset(self):
+        self._inputs: List[np.ndarray] = []
+        self._labels: List[np.ndarray] = []
+
+    def add(self, inputs: List[List[int]], labels: List[List[int]]):
+        self._inputs.extend(np.asarray(x, dtype=self.dtype) for x in inputs)
+        self._labels.extend(np.asarray(x, dtype=self.dtype) for x in labels)
+        while len(self._inputs) >= SHARD_SIZE:
+            self._flush(SHARD_SIZE)
+
+    def _write(self, name: str, seqs: List[np.ndarray]):
+        lengths = np.fromiter((len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+        off = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=off[1:])
+        flat = np.concatenate(seqs) if seqs else np.zeros(0, dtype=self.dtype)
+        flat.tofile(os.path.join(self.out_dir, f"{name}.bin"))
+        np.save(os.path.join(self.out_dir, f"{name}.off.npy"), off)
+        return int(off[-1])
+
+    def _flush(self, n: int):
+        name = f"shard_{len(self.shards):05d}"
+        inputs, self._inputs = self._inputs[:n], self._inputs[n:]
+        labels, self._labels = self._labels[:n], self._labels[n:]
+        self.shards.append({
+            "name": name, "examples": len(inputs),
+            "input_tokens": self._write(f"{name}.inputs", inputs),
+            "label_tokens": self._write(f"{name}.labels", labels),
+        })
+
+    def close(self):
+        if self._inputs:
+            self._flush(len(self._inputs))
+
+
+def build_shards(jsonl_path: str, out_dir: str, tokenizer, model_name: str, max_input: int,
+                 max_target: int, workers: int = TOKENIZE_WORKERS) -> dict:
+    started = time.perf_counter()
+    tmp = out_dir + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max else np.int32
+    writer = _ShardWriter(tmp, dtype)
+    init_args = (tokenizer.backend_tokenizer.to_str(), max_input, max_target)
+    if workers > 1:
+        # fork: воркеры стартуют мгновенно, не импортируя заново __main__ с torch;
+        # токенайзеры в них создаются заново, без потоков Rust (см. _init_worker)
+        ctx = get_context("fork" if "fork" in get_all_start_methods() else "spawn")
+        with ctx.Pool(workers, initializer=_init_worker, initargs=init_args) as pool:
+            for inputs, labels in pool.imap(_tokenize_chunk, _read_chunks(jsonl_path)):
+                writer.add(inputs, labels)
+    else:
+        _init_worker(*init_args)
+        for chunk in _read_chunks(jsonl_path):
+            writer.add(*_tokenize_chunk(chunk))
+    writer.close()
+    meta = {
+        "source": os.path.abspath(jsonl_path), "tokenizer": model_name,
+        "max_input": max_input, "max_target": max_target,
+        "dtype": np.dtype(dtype).name, "shards": writer.shards,
+        "examples": sum(s["examples"] for s in writer.shards),
+        "build_s": round(time.perf_counter() - started, 2), "workers": workers,
+    }
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp, out_dir)  # читатели видят либо старые, либо полные новые шарды
+    return meta
+
+
+class TokenShards:
+    """Датасет поверх шардов: всё через np.memmap, в память ничего не копируется,
+    пока пример не запрошен. Элементы — dict(input_ids, attention_mask, labels)
+    в формате, который понимает DataCollatorForSeq2Seq."""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        dtype = np.dtype(self.meta["dtype"])
+        self._inputs, self._labels = [], []
+        starts = [0]
+        for s in self.meta["shards"]:
+            base = os.path.join(path, s["name"])
+            self._inputs.append(self._open(base + ".inputs", dtype))
+            self._labels.append(self._open(base + ".labels", dtype))
+            starts.append(starts[-1] + s["examples"])
+        self._starts = np.asarray(starts, dtype=np.int64)
+        # длины (нужны батч-сэмплерам) считаются из смещений, без чтения токенов
+        self.input_lengths = np.concatenate([np.diff(off) for _, off in self._inputs]) \
+            if self._inputs else np.zeros(0, dtype=np.int64)
+        self.label_lengths = np.concatenate([np.diff(off) for _, off in self._labels]) \
+            if self._labels else np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def _open(base: str, dtype):
+        off = np.load(base + ".off.npy", mmap_mode="r")
+        if off[-1] == 0:
+            return np.zeros(0, dtype=dtype), off
+        return np.memmap(base + ".bin", dtype=dtype, mode="r"), off
+
+    def __len__(self) -> int:
+        return int(self._starts[-1])
+
+    def _slice(self, parts, shard: int, local: int) -> np.ndarray:
+        data, off = parts[shard]
+        return data[off[local]:off[local + 1]]
+
+    def __getitem__(self, idx: int) -> Dict[str, List[int]]:
+        if idx < 0:
+            idx += len(self)
+        shard = int(np.searchsorted(self._starts, idx, side="right")) - 1
+        local = idx - int(self._starts[shard])
+        inp = self._slice(self._inputs, shard, local).tolist()
+        return {"input_ids": inp, "attention_mask": [1] * len(inp),
+                "labels": self._slice(self._labels, shard, local).tolist()}
+
+
+def load_or_build(jsonl_path: str, tokenizer, model_name: str, max_input: int, max_target: int,
+                  workers: int = TOKENIZE_WORKERS, root: str = TOKENIZED_DIR) -> TokenShards:
+    path = cache_dir(jsonl_path, tokenizer, max_input, max_target, root)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        print(f"tokenized cache hit: {path}")
+    else:
+        meta = build_shards(jsonl_path, path, tokenizer, model_name, max_input, max_target, workers)
+        print(f"tokenized {meta['examples']} examples -> {path} in {meta['build_s']}s ({workers} workers)")
+    return TokenShards(path)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="pre-tokenize processed Spider jsonl into mmap shards")
+    ap.add_argument("--model", default="t5-small")
+    ap.add_argument("--max-input", type=int, default=512)
+    ap.add_argument("--max-target", type=int, default=128)
+    ap.add_argument("--workers", type=int, default=TOKENIZE_WORKERS)
+    ap.add_argument("files", nargs="*", default=["data/processed/train.jsonl", "data/processed/dev.jsonl"])
+    a = ap.parse_args()
+    from transformers import T5TokenizerFast
+    tok = T5TokenizerFast.from_pretrained(a.model)
+    for path in a.files:
+        ds = load_or_build(path, tok, a.model, a.max_input, a.max_target, a.workers)
+        print(f"{path}: {len(ds)} examples, mean input {ds.input_lengths.mean():.1f} tokens")
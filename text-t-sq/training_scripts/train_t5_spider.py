@@ -1,11 +1,13 @@
 # train_t5_spider.py (совместимый)
 import os, torch
-from datasets import load_dataset
 from transformers import (
     T5ForConditionalGeneration, T5TokenizerFast,
-    DataCollatorForSeq2Seq, Seq2SeqTrainingArguments, Seq2SeqTrainer
+    DataCollatorForSeq2Seq, Seq2SeqTrainingArguments
 )
 from peft import LoraConfig, get_peft_model
+from token_shards import load_or_build
+from batching import (TRAIN_MAX_TOKENS, TRAIN_PACKING, BucketedSeq2SeqTrainer,
+                      PackedCollator, PackedDataset, TokenBudgetBatchSampler)
 
 MODEL_NAME   = "t5-small"
 TRAIN_PATH   = "data/processed/train.jsonl"
@@ -17,67 +19,72 @@ EPOCHS       = 3
 
 tokenizer = T5TokenizerFast.from_pretrained(MODEL_NAME)
 
-def load_jsonl(path): return load_dataset("json", data_files=path, split="train")
+# Всё тяжёлое — внутри main(): на Windows воркеры токенизации (spawn) заново импортируют этот модуль
+def main():
+    # Токенизация делается один раз (пул процессов) и кладётся в memory-mapped шарды
+    # data/tokenized/<split>-<key>, key зависит от токенайзера, MAX_INPUT/MAX_TARGET и jsonl;
+    # повторные запуски (подбор гиперпараметров) открывают готовые шарды без копирования
+    train_tok = load_or_build(TRAIN_PATH, tokenizer, MODEL_NAME, MAX_INPUT, MAX_TARGET)
+    dev_tok   = load_or_build(DEV_PATH,   tokenizer, MODEL_NAME, MAX_INPUT, MAX_TARGET)
 
-def tok_fn(batch):
-    m = tokenizer(batch["input"], max_length=MAX_INPUT, truncation=True)
-    with tokenizer.as_target_tokenizer():
-        lab = tokenizer(batch["target"], max_length=MAX_TARGET, truncation=True)
-    m["labels"] = lab["input_ids"]
-    return m
+    # (опционально на быстрый тест)
+    # train_tok = torch.utils.data.Subset(train_tok, range(200))
+    # dev_tok   = torch.utils.data.Subset(dev_tok, range(50))
 
-train_ds = load_jsonl(TRAIN_PATH)
-dev_ds   = load_jsonl(DEV_PATH)
+    # Батчи по бюджету токенов (TRAIN_MAX_TOKENS), примеры близкой длины вместе;
+    # TRAIN_PACKING=1 — ещё и несколько коротких примеров в одной строке
+    train_ds = PackedDataset(train_tok, MAX_INPUT, MAX_TARGET) if TRAIN_PACKING else train_tok
+    sampler = TokenBudgetBatchSampler(train_ds.input_lengths, train_ds.label_lengths, TRAIN_MAX_TOKENS)
+    est = sampler.padding_stats()
+    print(f"train: {len(train_tok)} examples -> {len(train_ds)} rows{' (packed)' if TRAIN_PACKING else ''}, "
+          f"{est['batches']} batches/epoch at {TRAIN_MAX_TOKENS} tokens, padding {est['padding_ratio']:.1%}")
 
-train_tok = train_ds.map(tok_fn, batched=True, remove_columns=train_ds.column_names)
-dev_tok   = dev_ds.map(tok_fn,   batched=True, remove_columns=dev_ds.column_names)
+    base = T5ForConditionalGeneration.from_pretrained(MODEL_NAME)
+    peft_cfg = LoraConfig(
+        r=16, lora_alpha=32, target_modules=["q","v","k","o","wi","wo"],
+        lora_dropout=0.05, bias="none", task_type="SEQ_2_SEQ_LM"
+    )
+    model = get_peft_model(base, peft_cfg)
 
-# (опционально на быстрый тест)
-# train_tok = train_tok.select(range(200))
-# dev_tok   = dev_tok.select(range(50))
+    torch.set_float32_matmul_precision("high")
+    use_bf16 = torch.cuda.is_available() and torch.cuda.get_device_capability(0)[0] >= 8
+    fp16_flag = torch.cuda.is_available() and not use_bf16  # на CPU fp16 не поддерживается
 
-base = T5ForConditionalGeneration.from_pretrained(MODEL_NAME)
-peft_cfg = LoraConfig(
-    r=16, lora_alpha=32, target_modules=["q","v","k","o","wi","wo"],
-    lora_dropout=0.05, bias="none", task_type="SEQ_2_SEQ_LM"
-)
-model = get_peft_model(base, peft_cfg)
-
-torch.set_float32_matmul_precision("high")
-use_bf16 = torch.cuda.is_available() and torch.cuda.get_device_capability(0)[0] >= 8
-fp16_flag = not use_bf16
-
-args = Seq2SeqTrainingArguments(
-    output_dir=OUT_DIR,
-    learning_rate=2e-4,
-    per_device_train_batch_size=8,
-    per_device_eval_batch_size=8,
-    gradient_accumulation_steps=2,
-    num_train_epochs=EPOCHS,
-    logging_steps=50,
-    save_total_limit=2,
-    save_steps=500,
-    predict_with_generate=True,
-    fp16=fp16_flag,
-    bf16=use_bf16,
-    dataloader_pin_memory=True,
-    report_to="none",
-    do_eval=True,                 # в старых версиях достаточно этого
-)
+    args = Seq2SeqTrainingArguments(
+        output_dir=OUT_DIR,
+        learning_rate=2e-4,
+        per_device_train_batch_size=8,  # для train не используется: размер задаёт sampler
+        per_device_eval_batch_size=8,
+        gradient_accumulation_steps=2,
+        num_train_epochs=EPOCHS,
+        logging_steps=50,
+        save_total_limit=2,
+        save_steps=500,
+        predict_with_generate=True,
+        fp16=fp16_flag,
+        bf16=use_bf16,
+        dataloader_pin_memory=True,
+        report_to="none",
+        do_eval=True,                 # в старых версиях достаточно этого
+    )
 
-data_collator = DataCollatorForSeq2Seq(tokenizer, model=model)
+    data_collator = DataCollatorForSeq2Seq(tokenizer, model=model)
 
-trainer = Seq2SeqTrainer(
-    model=model,
-    args=args,
-    train_dataset=train_tok,
-    eval_dataset=dev_tok,         # будет валидировать при save_steps (или по кнопке)
-    data_collator=data_collator,
-    tokenizer=tokenizer,
-)
+    trainer = BucketedSeq2SeqTrainer(
+        model=model,
+        args=args,
+        train_dataset=train_ds,
+        eval_dataset=dev_tok,         # будет валидировать при save_steps (или по кнопке)
+        data_collator=data_collator,
+        tokenizer=tokenizer,
+        train_batch_sampler=sampler,
+        train_collator=PackedCollator(tokenizer.pad_token_id) if TRAIN_PACKING else None,
+        pad_token_id=tokenizer.pad_token_id,
+    )
 
-if __name__ == "__main__":
     trainer.train()
+    tp = trainer.throughput()
+    print(f"throughput: {tp['tokens_per_s']} tokens/s, padding ratio {tp['padding_ratio']:.1%}")
     # можно руками вызвать eval на dev:
     try:
         print(trainer.evaluate())
@@ -86,3 +93,6 @@ if __name__ == "__main__":
     trainer.save_model(f"{OUT_DIR}/final")
     tokenizer.save_pretrained(f"{OUT_DIR}/final")
     print("✅ trained & saved")
+
+if __name__ == "__main__":
+    main()
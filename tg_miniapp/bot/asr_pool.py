@@ -0,0 +1,97 @@
+import io
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict
+
+SAMPLE_RATE = 16000
+
+
+class AsrBusy(Exception):
+    pass
+
+
+class AsrPool:
+    """Пул распознавания голосовых: байты из Telegram декодируются в памяти
+    (PyAV внутри faster_whisper.decode_audio, без ffmpeg-процесса и временных
+    файлов) в 16 kHz float32 и транскрибируются на workers параллельных воркерах.
+
+    Веса Whisper общие: один WhisperModel с num_workers=workers, а потоки
+    CPU (cpu_threads, т.е. WHISPER_CPU_THREADS) делятся между воркерами.
+    Если заняты все воркеры и max_queue мест ожидания — submit кидает AsrBusy.
+    """
+
+    def __init__(self, model_name: str, device: str = "cpu", compute_type: str = "int8",
+                 cpu_threads: int = 4, workers: int = 2, max_queue: int = 8):
+        self.workers = max(1, min(workers, cpu_threads)) if device == "cpu" else max(1, workers)
+        self.threads_per_worker = max(1, cpu_threads // self.workers)
+        # faster_whisper (ctranslate2 + av) импортируем только когда пул реально нужен
+        from faster_whisper import WhisperModel, decode_audio
+        self._decode_audio = decode_audio
+        self.model = WhisperModel(model_name, device=device, compute_type=compute_type,
+                                  cpu_threads=self.threads_per_worker, num_workers=self.workers)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="asr")
+        self._slots = threading.BoundedSemaphore(self.workers + max_queue)
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._stats = {"done": 0, "rejected": 0, "errors": 0, "audio_s": 0.0, "decode_s": 0.0, "asr_s": 0.0}
+
+    def _run(self, data: bytes, language: str) -> str:
+        started = time.monotonic()
+        audio = self._decode_audio(io.BytesIO(data), sampling_rate=SAMPLE_RATE)
+        decoded = time.monotonic()
+        text = self._transcribe(audio, language)
+        with self._lock:
+            self._stats["done"] += 1
+            self._stats["audio_s"] += len(audio) / SAMPLE_RATE
+            self._stats["decode_s"] += decoded - started
+            self._stats["asr_s"] += time.monotonic() - decoded
+        return text
+
+    def _transcribe(self, audio, language: str, vad_filter: bool = True) -> str:
+        segments, _ = self.model.transcribe(
+            audio, language=language, vad_filter=vad_filter,
+            vad_parameters={"min_silence_duration_ms": 500},
+            beam_size=1, best_of=1, temperature=0.0, no_speech_threshold=0.6,
+            condition_on_previous_text=True
+        )
+        # segments — ленивый генератор: распознавание идёт здесь, в потоке воркера
+        return " ".join(s.text for s in segments).strip()
+
+    def warm_up(self, language: str = "ru"):
+        # Секунда тишины без VAD (иначе до декодера дело не дойдёт); счётчики не трогаем
+        import numpy as np
+        self._transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32), language, vad_filter=False)
+
+    def submit(self, data: bytes, language: str = "ru") -> Future:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise AsrBusy("ASR pool is saturated")
+        with self._lock:
+            self._pending += 1
+        fut = self._pool.submit(self._run, data, language)
+        fut.add_done_callback(self._done)
+        return fut
+
+    def _done(self, fut: Future):
+        with self._lock:
+            self._pending -= 1
+            if fut.exception() is not None:
+                self._stats["errors"] += 1
+        self._slots.release()
+
+    def transcribe(self, data: bytes, language: str = "ru", timeout: float = None) -> str:
+        return self.submit(data, language).result(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+            s["pending"] = self._pending
+        s["workers"] = self.workers
+        s["threads_per_worker"] = self.threads_per_worker
+        s["max_queue"] = self.max_queue
+        # во сколько раз быстрее реального времени
+        s["x_realtime"] = round(s["audio_s"] / s["asr_s"], 2) if s["asr_s"] else 0.0
+        return s
@@ -0,0 +1,92 @@
+import threading
+import time
+import queue
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+
+class BatchQueueFull(Exception):
+    pass
+
+
+class MicroBatcher:
+    """Динамический micro-batching: запросы копятся в очереди и уходят одним
+    вызовом run_batch, когда набралось max_batch штук или прошло max_wait_ms
+    с момента первого запроса в пачке. Результаты раздаются обратно через Future.
+
+    run_batch(items) -> list результатов той же длины и в том же порядке.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]], max_batch: int = 8,
+                 max_wait_ms: float = 15, max_queue: int = 256, name: str = "batcher"):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._q: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._stats = {"batches": 0, "items": 0, "errors": 0, "last_batch": 0, "max_batch_seen": 0,
+                       "busy_s": 0.0}
+        self._sizes: Dict[int, int] = {}
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        fut: Future = Future()
+        try:
+            self._q.put_nowait((item, fut))
+        except queue.Full:
+            raise BatchQueueFull("inference queue is full")
+        return fut
+
+    def __call__(self, item: Any, timeout: float = None) -> Any:
+        return self.submit(item).result(timeout)
+
+    def _collect(self) -> list:
+        batch = [self._q.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                # Что уже лежит в очереди — забираем без ожидания
+                batch.append(self._q.get_nowait() if remaining <= 0 else self._q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            batch = [(item, fut) for item, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.monotonic()
+            try:
+                results = self.run_batch([item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"run_batch returned {len(results)} results for {len(batch)} items")
+            except BaseException as e:
+                with self._lock:
+                    self._stats["errors"] += 1
+                for _, fut in batch:
+                    fut.set_exception(e)
+            else:
+                for (_, fut), res in zip(batch, results):
+                    fut.set_result(res)
+            with self._lock:
+                n = len(batch)
+                self._stats["batches"] += 1
+                self._stats["items"] += n
+                self._stats["last_batch"] = n
+                self._stats["max_batch_seen"] = max(self._stats["max_batch_seen"], n)
+                self._stats["busy_s"] += time.monotonic() - started
+                self._sizes[n] = self._sizes.get(n, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+            s["queue_depth"] = self._q.qsize()
+            s["avg_batch"] = round(s["items"] / s["batches"], 2) if s["batches"] else 0.0
+            s["batch_sizes"] = dict(sorted(self._sizes.items()))
+            s["max_batch"] = self.max_batch
+            s["max_wait_ms"] = self.max_wait * 1000
+        return s
@@ -1,6 +1,23 @@
-import os, uuid, tempfile, subprocess, sqlite3, json, telebot
-from faster_whisper import WhisperModel
-from transformers import T5ForConditionalGeneration, T5TokenizerFast
+import os, sys, json, time, telebot
+_T0 = time.perf_counter()
+
+# Общий с backend код (governor и т.п.) лежит в backend/app,
+# общий с обучением (schema linking) — в text-t-sq/training_scripts
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, os.path.join(ROOT_DIR, "backend"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "text-t-sq", "training_scripts"))
+from app import governor, metrics
+from app.workload import recorder as workload
+from app.governor import QueryRejected, BudgetExceeded
+from app.safety import validate_sql
+from batcher import MicroBatcher, BatchQueueFull
+from asr_pool import AsrPool, AsrBusy
+from pipeline import Pipeline, PipelineFull
+from lazy import Lazy, record, timed, timing_report, warm_up
+from schema_link import SchemaLinker, PrefixTokenCache
+from spider_db import SpiderDbCache, fetch_bounded, db_path as spider_db_path
+from sql_engine import load_sql_model, SQL_ENGINE  # torch/transformers грузятся лениво, внутри load_sql_model
+record("imports", time.perf_counter() - _T0)
 
 # ===================== CONFIG =====================
 
@@ -15,20 +32,42 @@ HAS_CUDA        = bool(os.environ.get("CUDA_VISIBLE_DEVICES"))
 WHISPER_DEVICE  = "cuda" if HAS_CUDA else "cpu"
 WHISPER_COMPUTE = os.environ.get("WHISPER_COMPUTE_TYPE") or ("float16" if HAS_CUDA else "int8")
 CPU_THREADS     = int(os.environ.get("WHISPER_CPU_THREADS", max(1, (os.cpu_count() or 4)//2)))
+ASR_WORKERS     = int(os.environ.get("ASR_WORKERS", 2))     # параллельных распознаваний (делят CPU_THREADS)
+ASR_QUEUE_SIZE  = int(os.environ.get("ASR_QUEUE_SIZE", 8))  # сверх этого — "сервер перегружен"
 
 # Ответы ограничим
 MAX_ROWS = int(os.environ.get("MAX_ROWS", 20))
 MAX_SQL_TOKENS = int(os.environ.get("MAX_SQL_TOKENS", 196))
+
+# Micro-batching для T5: сколько вопросов склеивать и сколько ждать добора пачки
+SQL_BATCH_SIZE    = int(os.environ.get("SQL_BATCH_SIZE", 8))
+SQL_BATCH_WAIT_MS = float(os.environ.get("SQL_BATCH_WAIT_MS", 15))
+SQL_QUEUE_SIZE    = int(os.environ.get("SQL_QUEUE_SIZE", 256))
+BOT_THREADS       = int(os.environ.get("BOT_THREADS", 4))  # хендлеры только ставят задачу в pipeline
+
+# Конвейер обработки сообщений: сколько потоков у каждой стадии
+DOWNLOAD_WORKERS      = int(os.environ.get("DOWNLOAD_WORKERS", 4))
+SQL_WORKERS           = int(os.environ.get("SQL_WORKERS", SQL_BATCH_SIZE))  # чтобы было кому собраться в батч
+EXEC_WORKERS          = int(os.environ.get("EXEC_WORKERS", 4))
+PIPELINE_MAX_INFLIGHT = int(os.environ.get("PIPELINE_MAX_INFLIGHT", 64))
+PIPELINE_MAX_PER_CHAT = int(os.environ.get("PIPELINE_MAX_PER_CHAT", 5))
+
+# Модели грузятся лениво (при первом запросе); BOT_WARMUP=1 — сразу после старта
+# в фоне, с пустым прогоном, чтобы первый пользователь не ждал загрузки
+BOT_WARMUP = os.environ.get("BOT_WARMUP", "1") == "1"
     
 # ================== INIT MODELS ===================
-bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, parse_mode="HTML")
+with timed("telebot"):
+    bot = telebot.TeleBot(TELEGRAM_BOT_TOKEN, parse_mode="HTML", num_threads=BOT_THREADS)
 
-# faster-whisper (офлайн)
-asr = WhisperModel(WHISPER_MODEL, device=WHISPER_DEVICE, compute_type=WHISPER_COMPUTE, cpu_threads=CPU_THREADS)
+# faster-whisper (офлайн): пул воркеров, аудио декодируется в памяти
+asr = Lazy("whisper", lambda: AsrPool(WHISPER_MODEL, device=WHISPER_DEVICE, compute_type=WHISPER_COMPUTE,
+                                      cpu_threads=CPU_THREADS, workers=ASR_WORKERS, max_queue=ASR_QUEUE_SIZE))
 
-# T5 токенайзер/модель (для старта можно подставить "google/t5-small")
-tokenizer = T5TokenizerFast.from_pretrained(MODEL_DIR)
-sql_model = T5ForConditionalGeneration.from_pretrained(MODEL_DIR).eval()
+# T5 токенайзер/модель (для старта можно подставить "google/t5-small");
+# рантайм (torch / torch-int8 / onnx / onnx-int8) выбирается через SQL_ENGINE,
+# веса safetensors читаются через mmap
+t5 = Lazy("t5", lambda: load_sql_model(MODEL_DIR))
 
 # ================== STATE: user -> db_id ==========
 # простая in-memory карта (на прод лучше KV/БД)
@@ -39,73 +78,84 @@ def load_tables():
     with open(os.path.join(SPIDER_DIR, "tables.json"), "r", encoding="utf-8") as f:
         return json.load(f)
 
-TABLE_META = load_tables()
-META_BY_DB = {m["db_id"]: m for m in TABLE_META}
+class Spider:
+    def __init__(self, table_meta):
+        self.table_meta = table_meta
+        self.meta_by_db = {m["db_id"]: m for m in table_meta}
+        self.allowed_tables = {db_id: frozenset(t.lower() for t in m["table_names_original"])
+                               for db_id, m in self.meta_by_db.items()}
+        # Индексы для schema linking строятся один раз
+        self.linker = SchemaLinker(table_meta)
+
+spider = Lazy("tables.json", lambda: Spider(load_tables()))
+
+class SqlGen:
+    def __init__(self):
+        from constrained import ConstrainedDecoder  # тянет torch
+        tokenizer, model = t5()
+        sp = spider()
+        # Сериализованные и токенизированные префиксы схем кэшируются по db_id (+ выбранным таблицам)
+        self.tokens = PrefixTokenCache(tokenizer, sp.linker, max_length=1024)
+        # Декодирование: маска словаря по схеме БД + greedy с откатом на beam (SQL_DECODE)
+        self.decoder = ConstrainedDecoder(tokenizer, model, sp.table_meta, max_new_tokens=MAX_SQL_TOKENS)
+
+sqlgen = Lazy("sql decoder", SqlGen, deps=(t5, spider))
 
 def schema_string(db_id: str) -> str:
-    m = META_BY_DB[db_id]
-    tbls = m["table_names_original"]
-    cols = {}
-    for (tbl_idx, col_name), col_type in zip(m["column_names_original"], m["column_types"]):
-        if tbl_idx == -1:
-            continue
-        cols.setdefault(tbl_idx, []).append(f"{col_name}:{col_type}")
-    serial = " | ".join(f"{tbls[i]}({', '.join(cols.get(i, []))})" for i in range(len(tbls)))
-    return serial
+    return spider().linker.schema_string(db_id)
 
 def db_path(db_id: str) -> str:
-    return os.path.join(SPIDER_DIR, "database", db_id, f"{db_id}.sqlite")
+    return spider_db_path(SPIDER_DIR, db_id)
+
+# Открытые соединения (immutable, mmap) переиспользуются между запросами к тому же db_id
+SPIDER_DBS = SpiderDbCache(SPIDER_DIR)
 
 # ================ Audio helpers ===================
-def ogg_to_wav(in_path: str) -> str:
-    out_path = in_path.rsplit(".", 1)[0] + ".wav"
-    ffmpeg_bin = os.environ.get("FFMPEG_BIN", "ffmpeg")
-    subprocess.run([ffmpeg_bin, "-y", "-i", in_path, "-ac","1","-ar","16000","-vn", out_path],
-                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return out_path
-
-def transcribe(path: str, language="ru") -> str:
-    segments, info = asr.transcribe(
-        path, language=language, vad_filter=True,
-        vad_parameters={"min_silence_duration_ms": 500},
-        beam_size=1, best_of=1, temperature=0.0, no_speech_threshold=0.6,
-        condition_on_previous_text=True
-    )
-    return " ".join(s.text for s in segments).strip()
+@metrics.timed("transcribe")
+def transcribe(data: bytes, language="ru") -> str:
+    # OGG/Opus из Telegram -> 16 kHz float32 прямо в памяти, без ffmpeg и tmp-файлов
+    return asr().transcribe(data, language=language)
 
 # ================ NL -> SQL =======================
 def build_input(question: str, db_id: str) -> str:
-    sch = schema_string(db_id)
-    return f"translate to SQL | db: {db_id} | schema: {sch} | question: {question}"
+    return spider().linker.build_input(question, db_id)
+
+@metrics.timed("generate_sql_batch")
+def generate_sql_batch(items):
+    # items: [(question, db_id), ...] — одна пачка с паддингом до самого длинного входа
+    gen = sqlgen()
+    return gen.decoder.generate(gen.tokens.encode_batch(items), items)
 
+sql_batcher = MicroBatcher(generate_sql_batch, max_batch=SQL_BATCH_SIZE, max_wait_ms=SQL_BATCH_WAIT_MS,
+                           max_queue=SQL_QUEUE_SIZE, name="t5-batcher")
+
+@metrics.timed("generate_sql")  # с ожиданием в очереди батчера
 def generate_sql(question: str, db_id: str) -> str:
-    inp = build_input(question, db_id)
-    tok = tokenizer(inp, return_tensors="pt", truncation=True, max_length=1024)
-    out = sql_model.generate(**tok, max_new_tokens=MAX_SQL_TOKENS, num_beams=4, early_stopping=True)
-    sql = tokenizer.decode(out[0], skip_special_tokens=True).strip()
-    return sql
-
-def is_safe_select(sql: str) -> bool:
-    s = sql.strip().lower().replace("\n", " ")
-    if not s.startswith("select"):
-        return False
-    bad = ["insert", "update", "delete", "drop", "alter", "truncate", "attach", "detach", "create", "replace"]
-    if any(b in s for b in bad): return False
-    if ";" in s: return False
-    return True
+    return sql_batcher((question, db_id))
+
+def is_safe_select(sql: str, db_id: str) -> bool:
+    # Только SELECT и только таблицы выбранной базы
+    return validate_sql(sql, spider().allowed_tables[db_id]).ok
 
+@metrics.timed("execute_sql")
 def execute_sql(sql: str, db_id: str):
-    path = db_path(db_id)
-    con = sqlite3.connect(path)
-    cur = con.cursor()
-    cur.execute(sql)
-    rows = cur.fetchmany(MAX_ROWS + 1)  # +1 чтобы понять, что есть ещё
-    cols = [d[0] for d in cur.description] if cur.description else []
-    con.close()
-    more = len(rows) > MAX_ROWS
-    rows = rows[:MAX_ROWS]
-    return cols, rows, more
+    with SPIDER_DBS.connection(db_id) as con:
+        # План проверяем заранее, LIMIT ставим с запасом +1 чтобы понять, что есть ещё
+        try:
+            sql = governor.preflight(con, sql, MAX_ROWS + 1)
+        except QueryRejected:
+            metrics.rejected("plan")
+            raise
+        try:
+            with governor.Budget(con), workload.track(con, "bot", os.path.abspath(db_path(db_id)), sql) as rec:
+                cols, rows, more = fetch_bounded(con.execute(sql), MAX_ROWS)
+                rec["rows"] = len(rows)
+                return cols, rows, more
+        except BudgetExceeded:
+            metrics.rejected("budget")
+            raise
 
+@metrics.timed("render_table")
 def render_table(cols, rows, more=False) -> str:
     if not cols:
         return "Пустой ответ."
@@ -119,6 +169,74 @@ def render_table(cols, rows, more=False) -> str:
         lines.append(f"\n<i>Показаны первые {MAX_ROWS} строк.</i>")
     return "\n".join(lines)
 
+# ==================== PIPELINE ====================
+# download -> asr -> sql -> exec, у каждой стадии свой пул потоков;
+# сообщения одного чата обрабатываются строго по очереди
+pipeline = Pipeline({"download": DOWNLOAD_WORKERS, "asr": ASR_WORKERS, "sql": SQL_WORKERS, "exec": EXEC_WORKERS},
+                    max_inflight=PIPELINE_MAX_INFLIGHT, max_per_chat=PIPELINE_MAX_PER_CHAT)
+
+class FinalReply(Exception):
+    """Досрочный ответ пользователю (пустая транскрипция, небезопасный SQL)."""
+
+def _heard(ctx) -> str:
+    return f"<b>Распознано:</b> {ctx['text']}\n\n" if ctx.get("voice") else ""
+
+@metrics.timed("download")
+def step_download(ctx):
+    info = bot.get_file(ctx["file_id"])
+    ctx["data"] = bot.download_file(info.file_path)
+    return ctx
+
+def step_asr(ctx):
+    ctx["text"] = transcribe(ctx.pop("data"), language="ru")  # фиксируем язык для скорости
+    if not ctx["text"]:
+        raise FinalReply("Пустая транскрипция.")
+    return ctx
+
+def step_sql(ctx):
+    ctx["sql"] = sql = generate_sql(ctx["text"], ctx["db_id"])
+    with metrics.timer("validate_sql"):
+        safe = is_safe_select(sql, ctx["db_id"])
+    if not safe:
+        metrics.rejected("unsafe")
+        raise FinalReply(f"{_heard(ctx)}🚫 Небезопасный SQL:\n<code>{sql}</code>")
+    return ctx
+
+def step_exec(ctx):
+    cols, rows, more = execute_sql(ctx["sql"], ctx["db_id"])
+    return f"{_heard(ctx)}<b>SQL:</b> <code>{ctx['sql']}</code>\n\n{render_table(cols, rows, more)}"
+
+TEXT_STEPS = [("sql", step_sql), ("exec", step_exec)]
+VOICE_STEPS = [("download", step_download), ("asr", step_asr)] + TEXT_STEPS
+
+def error_text(ctx, e: BaseException) -> str:
+    if isinstance(e, FinalReply):
+        return str(e)
+    if isinstance(e, (QueryRejected, BudgetExceeded)):
+        sql = f"\n<code>{ctx['sql']}</code>" if ctx.get("sql") else ""
+        return f"⏱ Запрос слишком тяжёлый: <code>{e}</code>{sql}"
+    if isinstance(e, (BatchQueueFull, AsrBusy)):
+        return "Сервер перегружен, попробуй через минуту."
+    what = "распознавания/SQL" if ctx.get("voice") else "SQL"
+    return f"Ошибка {what}: <code>{e}</code>"
+
+def finish(ack, text: str):
+    try:
+        bot.edit_message_text(text, ack.chat.id, ack.message_id)
+    except Exception:
+        # например, ответ длиннее лимита на редактирование — шлём отдельным сообщением
+        bot.send_message(ack.chat.id, text, reply_to_message_id=ack.message_id)
+
+def enqueue(m, ctx, steps):
+    # Сразу подтверждаем приём, итоговый ответ заменит это сообщение
+    ack = bot.reply_to(m, "⏳ Обрабатываю…")
+    try:
+        pipeline.submit(m.chat.id, ctx, steps,
+                        on_done=lambda text: finish(ack, text),
+                        on_error=lambda e: finish(ack, error_text(ctx, e)))
+    except PipelineFull:
+        finish(ack, "Сервер перегружен, попробуй через минуту.")
+
 # ================= BOT COMMANDS ===================
 @bot.message_handler(commands=["start", "help"])
 def help_cmd(m):
@@ -126,7 +244,8 @@ def help_cmd(m):
         "Привет! Я голос→SQL бот.\n\n"
         "1) /db &lt;db_id&gt; — выбрать базу Spider\n"
         "2) пришли voice/audio с вопросом — я распознаю и выполню запрос\n"
-        "3) /ask &lt;вопрос&gt; — текстовый вопрос без голоса\n\n"
+        "3) /ask &lt;вопрос&gt; — текстовый вопрос без голоса\n"
+        "4) /stats — латентность по стадиям и счётчики\n\n"
         f"Spider dir: <code>{SPIDER_DIR}</code>\nModel dir: <code>{MODEL_DIR}</code>"
     )
 
@@ -137,9 +256,10 @@ def set_db(m):
         bot.reply_to(m, "Использование: /db &lt;db_id&gt;")
         return
     db_id = parts[1].strip()
-    if db_id not in META_BY_DB:
+    meta_by_db = spider().meta_by_db
+    if db_id not in meta_by_db:
         # подсказка по доступным
-        sample = ", ".join(list(META_BY_DB.keys())[:10])
+        sample = ", ".join(list(meta_by_db.keys())[:10])
         bot.reply_to(m, f"Не знаю db_id <b>{db_id}</b>. Примеры: {sample} …")
         return
     USER_DB[m.chat.id] = db_id
@@ -147,7 +267,58 @@ def set_db(m):
 
 @bot.message_handler(commands=["health"])
 def health(m):
-    bot.reply_to(m, f"OK ✅\nASR: {WHISPER_MODEL} ({WHISPER_DEVICE}/{WHISPER_COMPUTE}, threads={CPU_THREADS})\nSQL model: {MODEL_DIR}")
+    g = governor.stats()
+    b = sql_batcher.stats()
+    p = pipeline.stats()
+    c = SPIDER_DBS.stats()
+    stages = ", ".join(f"{n}={st['running']}/{st['workers']}+{st['queued']}" for n, st in p["stages"].items())
+    # Статусы моделей — без принудительной загрузки
+    ready = all(x.ready for x in (asr, t5, spider, sqlgen))
+    if asr.ready:
+        a = asr().stats()
+        asr_line = (f"ASR pool: workers={a['workers']}x{a['threads_per_worker']}t, pending={a['pending']}, "
+                    f"rejected={a['rejected']}, x_realtime={a['x_realtime']}")
+    else:
+        asr_line = f"ASR pool: {asr.status()}"
+    if sqlgen.ready:
+        d = sqlgen().decoder
+        dec_line = f"Decode ({d.mode}): greedy_ok={d.stats['greedy_accepted']}, beam_fallbacks={d.stats['beam_fallbacks']}"
+    else:
+        dec_line = f"Decode: {sqlgen.status()}"
+    bot.reply_to(m, f"{'OK ✅' if ready else 'Warming up ⏳'}\n"
+                    f"ASR: {WHISPER_MODEL} ({WHISPER_DEVICE}/{WHISPER_COMPUTE}, threads={CPU_THREADS}) — {asr.status()}\n"
+                    f"{asr_line}\nSQL model: {MODEL_DIR} ({SQL_ENGINE}) — {t5.status()}\n"
+                    f"tables.json: {spider.status()}\n"
+                    f"SQL budget: timeouts={g['timeouts']}, step_limits={g['step_limits']}, "
+                    f"rejected_scans={g['rejected_scans']}, down_limited={g['down_limited']}\n"
+                    f"Spider DBs: open={c['open']}/{c['max_open']}, hits={c['hits']}, misses={c['misses']}\n"
+                    f"T5 batcher: queue={b['queue_depth']}, avg_batch={b['avg_batch']}, "
+                    f"last_batch={b['last_batch']}, max_batch={b['max_batch']}, wait={b['max_wait_ms']:g}ms\n"
+                    f"{dec_line}\n"
+                    f"Pipeline: inflight={p['inflight']}/{p['max_inflight']}, rejected={p['rejected']}, {stages}")
+
+@bot.message_handler(commands=["stats"])
+def stats_cmd(m):
+    stages = metrics.snapshot()
+    if not stages:
+        bot.reply_to(m, "Пока нет ни одного запроса.")
+        return
+    width = max(len(s) for s in stages)
+    lines = [f"{'stage':<{width}} {'n':>5} {'err':>4} {'p50':>7} {'p95':>7} {'p99':>7}  ms"]
+    for name, st in stages.items():
+        lines.append(f"{name:<{width}} {st['count']:>5} {st['errors']:>4} "
+                     f"{st['p50_ms']:>7.1f} {st['p95_ms']:>7.1f} {st['p99_ms']:>7.1f}")
+    c = metrics.counters()
+    # кэши бота — свои счётчики у кэша соединений и префиксов токенов
+    dbs = SPIDER_DBS.stats()
+    caches = [f"spider_db hit={dbs['hits']} miss={dbs['misses']}"]
+    if sqlgen.ready:
+        t = sqlgen().tokens.stats()
+        caches.append(f"prefix_tokens hit={t['hits']} miss={t['misses']}")
+    caches += [f"{k}={v:g}" for k, v in c["cache"].items()]
+    rejected = ", ".join(f"{k}={v:g}" for k, v in c["sql_rejected"].items()) or "0"
+    text = "\n".join(lines)
+    bot.reply_to(m, f"<pre>{text}</pre>\nCaches: {'; '.join(caches)}\nRejected SQL: {rejected}")
 
 @bot.message_handler(commands=["ask"])
 def ask_cmd(m):
@@ -159,15 +330,7 @@ def ask_cmd(m):
     if not q:
         bot.reply_to(m, "Использование: /ask &lt;вопрос&gt;")
         return
-    try:
-        sql = generate_sql(q, db_id)
-        if not is_safe_select(sql):
-            bot.reply_to(m, f"🚫 Небезопасный SQL:\n<code>{sql}</code>")
-            return
-        cols, rows, more = execute_sql(sql, db_id)
-        bot.reply_to(m, f"<b>SQL:</b> <code>{sql}</code>\n\n{render_table(cols, rows, more)}")
-    except Exception as e:
-        bot.reply_to(m, f"Ошибка SQL: <code>{e}</code>")
+    enqueue(m, {"db_id": db_id, "text": q}, TEXT_STEPS)
 
 @bot.message_handler(content_types=["voice","audio","video_note"])
 def handle_voice(m):
@@ -175,35 +338,29 @@ def handle_voice(m):
     if not db_id:
         bot.reply_to(m, "Сначала выбери БД: /db &lt;db_id&gt;")
         return
-    try:
-        file_id = (m.voice or m.audio or m.video_note).file_id
-        info = bot.get_file(file_id)
-        data = bot.download_file(info.file_path)
-        with tempfile.TemporaryDirectory() as td:
-            ogg_path = os.path.join(td, f"{uuid.uuid4()}.ogg")
-            with open(ogg_path, "wb") as f:
-                f.write(data)
-            wav_path = ogg_to_wav(ogg_path)
-            text = transcribe(wav_path, language="ru")  # фиксируем язык для скорости
-        if not text:
-            bot.reply_to(m, "Пустая транскрипция.")
-            return
-        # генерим и исполняем
-        sql = generate_sql(text, db_id)
-        if not is_safe_select(sql):
-            bot.reply_to(m, f"<b>Распознано:</b> {text}\n\n🚫 Небезопасный SQL:\n<code>{sql}</code>")
-            return
-        cols, rows, more = execute_sql(sql, db_id)
-        bot.reply_to(m, f"<b>Распознано:</b> {text}\n\n<b>SQL:</b> <code>{sql}</code>\n\n{render_table(cols, rows, more)}")
-    except FileNotFoundError:
-        bot.reply_to(m, "ffmpeg не найден. Укажи FFMPEG_BIN или добавь ffmpeg в PATH.")
-    except Exception as e:
-        bot.reply_to(m, f"Ошибка распознавания/SQL: <code>{e}</code>")
+    file_id = (m.voice or m.audio or m.video_note).file_id
+    enqueue(m, {"db_id": db_id, "file_id": file_id, "voice": True}, VOICE_STEPS)
+
+# ==================== WARM-UP =====================
+def warm_sql():
+    sp = spider()
+    db_id = next(iter(sp.meta_by_db))
+    sqlgen()
+    with timed("warm-up: generate"):
+        generate_sql_batch([("How many rows are there?", db_id)])
+
+def warm_asr():
+    pool = asr()
+    with timed("warm-up: transcribe"):
+        pool.warm_up()
 
 if __name__ == "__main__":
     try:
         bot.remove_webhook()
     except Exception:
         pass
+    print(timing_report())
+    if BOT_WARMUP:
+        warm_up([warm_sql, warm_asr], on_done=lambda: print(timing_report()))
     print("Bot is up. Send /help")
     bot.infinity_polling(skip_pending=False, timeout=60, long_polling_timeout=60)
@@ -1,7 +1,12 @@
-import os
-from transformers import T5ForConditionalGeneration, T5TokenizerFast
+import os, sys, time
 import telebot
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "text-t-sq", "training_scripts"))
+from sql_engine import inspect_model_dir, load_sql_model
+
+# --load — дополнительно загрузить модель целиком (по умолчанию проверяем только файлы)
+FULL_LOAD = "--load" in sys.argv
+
 # Проверяем токен
 try:
     TELEGRAM_BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
@@ -23,10 +28,20 @@ try:
 except Exception as e:
     print(f"❌ Ошибка инициализации бота: {e}")
 
-# Пробуем инициализировать модель T5
+# Проверяем веса по заголовкам safetensors, не загружая модель
 try:
-    tokenizer = T5TokenizerFast.from_pretrained(MODEL_DIR)
-    model = T5ForConditionalGeneration.from_pretrained(MODEL_DIR)
-    print("✅ T5 модель и токенайзер загружены")
+    info = inspect_model_dir(MODEL_DIR)
+    kind = f"LoRA-адаптер поверх {info['base']}" if info["adapter"] else "полная модель"
+    print(f"✅ Веса на месте: {kind}, {', '.join(info['weights'])}, "
+          f"{info['tensors']} тензоров / {info['params'] / 1e6:.1f}M параметров")
 except Exception as e:
-    print(f"❌ Ошибка загрузки модели: {e}")
+    print(f"❌ Ошибка проверки модели: {e}")
+
+# Полная загрузка — тем же кодом, что и в боте (SQL_ENGINE)
+if FULL_LOAD:
+    try:
+        started = time.perf_counter()
+        tokenizer, model = load_sql_model(MODEL_DIR)
+        print(f"✅ T5 модель и токенайзер загружены за {time.perf_counter() - started:.1f}s")
+    except Exception as e:
+        print(f"❌ Ошибка загрузки модели: {e}")
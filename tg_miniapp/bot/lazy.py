@@ -0,0 +1,107 @@
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable
+
+# Фаза старта -> секунды (импорты, загрузка моделей, прогрев), в порядке выполнения
+TIMINGS: "OrderedDict[str, float]" = OrderedDict()
+_timings_lock = threading.Lock()
+
+
+def record(phase: str, seconds: float):
+    with _timings_lock:
+        TIMINGS[phase] = seconds
+
+
+@contextmanager
+def timed(phase: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started)
+
+
+def timing_report() -> str:
+    with _timings_lock:
+        items = list(TIMINGS.items())
+    if not items:
+        return "startup: nothing loaded yet"
+    width = max(len(p) for p, _ in items)
+    lines = [f"  {p:<{width}}  {s:7.2f}s" for p, s in items]
+    return "startup timings:\n" + "\n".join(lines)
+
+
+class Lazy:
+    """Потокобезопасная ленивая инициализация: factory вызывается один раз,
+    при первом get(); параллельные вызовы ждут ту же загрузку.
+    Если factory упала — ошибка запоминается в status(), следующий get() пробует снова.
+    deps грузятся до запуска таймера, чтобы их время не попадало в эту фазу."""
+
+    def __init__(self, name: str, factory: Callable[[], Any], deps: Iterable["Lazy"] = ()):
+        self.name = name
+        self._factory = factory
+        self._deps = tuple(deps)
+        self._lock = threading.Lock()
+        self._value = None
+        self._state = "not loaded"
+        self._error = None
+        self.seconds = 0.0
+
+    @property
+    def ready(self) -> bool:
+        return self._state == "ready"
+
+    def get(self) -> Any:
+        if self._state == "ready":
+            return self._value
+        for dep in self._deps:
+            dep.get()
+        with self._lock:
+            if self._state != "ready":
+                self._state = "loading"
+                started = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except BaseException as e:
+                    self._state, self._error = "error", e
+                    raise
+                self.seconds = time.perf_counter() - started
+                record(self.name, self.seconds)
+                self._state = "ready"
+        return self._value
+
+    __call__ = get
+
+    def status(self) -> str:
+        # Ничего не грузит — можно звать из /health
+        if self._state == "ready":
+            return f"ready ({self.seconds:.1f}s)"
+        if self._state == "error":
+            return f"error: {self._error}"
+        return self._state
+
+
+def warm_up(steps: Iterable[Callable[[], Any]], background: bool = True,
+            on_done: Callable[[], None] = None) -> threading.Thread:
+    """Прогрев: загрузка моделей + пустой прогон, чтобы первый пользователь
+    не платил за инициализацию. Время пишут сами шаги (Lazy / timed)."""
+
+    def run():
+        for fn in steps:
+            try:
+                fn()
+            except Exception:
+                print(f"warm-up step {getattr(fn, '__name__', fn)!r} failed:")
+                traceback.print_exc()
+        if on_done:
+            on_done()
+
+    t = threading.Thread(target=run, name="warm-up", daemon=True)
+    if background:
+        t.start()
+    else:
+        run()
+    return t
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+
+class PipelineFull(Exception):
+    pass
+
+
+class Stage:
+    """Отдельный пул потоков под один шаг обработки (download / asr / sql / exec)."""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"stage-{name}")
+        self._lock = threading.Lock()
+        self._stats = {"queued": 0, "running": 0, "done": 0, "errors": 0, "busy_s": 0.0}
+
+    def submit(self, fn: Callable[[Any], Any], value: Any, callback: Callable[[bool, Any], None]):
+        with self._lock:
+            self._stats["queued"] += 1
+        self._pool.submit(self._run, fn, value, callback)
+
+    def _run(self, fn, value, callback):
+        with self._lock:
+            self._stats["queued"] -= 1
+            self._stats["running"] += 1
+        started = time.monotonic()
+        try:
+            result, ok = fn(value), True
+        except BaseException as e:
+            result, ok = e, False
+        with self._lock:
+            self._stats["running"] -= 1
+            self._stats["done" if ok else "errors"] += 1
+            self._stats["busy_s"] += time.monotonic() - started
+        callback(ok, result)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"workers": self.workers, **self._stats}
+
+
+Steps = List[Tuple[str, Callable[[Any], Any]]]
+
+
+class Pipeline:
+    """Сообщение проходит цепочку шагов [(stage, fn), ...]: результат одного
+    шага — вход следующего, каждый шаг исполняется в пуле своей стадии.
+
+    - порядок по чату: следующее сообщение чата стартует только после того,
+      как предыдущее полностью обработано (ответы не перепутаются);
+    - очереди ограничены: всего в работе не больше max_inflight сообщений и
+      не больше max_per_chat от одного чата, сверх этого submit кидает PipelineFull;
+    - on_done(result) / on_error(exc) вызываются в потоке последнего шага.
+    """
+
+    def __init__(self, workers: Dict[str, int], max_inflight: int = 64, max_per_chat: int = 5):
+        self.stages = {name: Stage(name, n) for name, n in workers.items()}
+        self.max_inflight = max_inflight
+        self.max_per_chat = max_per_chat
+        self._lock = threading.Lock()
+        self._chats: Dict[Any, deque] = {}
+        self._inflight = 0
+        self._rejected = 0
+
+    def submit(self, chat_id: Any, value: Any, steps: Steps,
+               on_done: Callable[[Any], None], on_error: Callable[[BaseException], None]):
+        job = (value, steps, on_done, on_error)
+        with self._lock:
+            chat = self._chats.get(chat_id)
+            if self._inflight >= self.max_inflight or (chat is not None and len(chat) >= self.max_per_chat):
+                self._rejected += 1
+                raise PipelineFull("too many messages in progress")
+            self._inflight += 1
+            if chat is not None:
+                chat.append(job)  # стартует, когда закончится текущее сообщение чата
+                return
+            self._chats[chat_id] = deque()
+        self._step(chat_id, job, 0, value)
+
+    def _step(self, chat_id, job, i: int, value):
+        _, steps, on_done, on_error = job
+        stage, fn = steps[i]
+
+        def callback(ok: bool, result: Any):
+            if ok and i + 1 < len(steps):
+                self._step(chat_id, job, i + 1, result)
+                return
+            try:
+                (on_done if ok else on_error)(result)
+            finally:
+                self._finish(chat_id)
+
+        self.stages[stage].submit(fn, value, callback)
+
+    def _finish(self, chat_id):
+        with self._lock:
+            self._inflight -= 1
+            chat = self._chats[chat_id]
+            if not chat:
+                del self._chats[chat_id]
+                return
+            job = chat.popleft()
+        self._step(chat_id, job, 0, job[0])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = {"inflight": self._inflight, "chats": len(self._chats), "rejected": self._rejected,
+                 "max_inflight": self.max_inflight}
+        s["stages"] = {name: st.stats() for name, st in self.stages.items()}
+        return s